@@ -9,6 +9,7 @@ import math
 import logging
 import sys
 from SEIRcity.param_parser import convert_legacy_param_names
+from SEIRcity.outcome_handler import decode_params
 
 """ Tools for handling single city SEIR model outputs """
 
@@ -38,9 +39,9 @@ class OutputViewer:
         self.config = convert_legacy_param_names(config)
         self.city = self.config['city']
 
-        # --- get xarray
+        # --- get xarray, with the labels of integer-coded param dims as their coords
         with open(xarray_path, 'rb') as xp:
-            self.data = pickle.load(xp)
+            self.data = decode_params(pickle.load(xp))
 
         # --- check xarray contents
         self.required_coords = {
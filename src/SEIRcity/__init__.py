@@ -14,9 +14,11 @@ import argparse
 
 # SEIRcity modules
 from . import cli
-from .simulate import simulate_multiple
+from .simulate import simulate_multiple, fs_queue, plan
+from .outcome_merge import merge_outcomes
 from .param import aggregate_params_and_data
-from .fit_to_data import fitting_workflow
+from .fit_to_data import fitting_workflow, batch_fitting_workflow, \
+    joint_fitting_workflow
 
 HERE = os.path.dirname(os.path.abspath(__file__))
 
@@ -33,9 +35,45 @@ pd.options.display.float_format = '{:,.8f}'.format
 # ----------------------------------------------------------------------
 
 
-def main(config_yaml, out_fp, threads):
-    """Entrypoint function for the SEIRcity model app."""
+def main(config_yaml=None, out_fp=None, threads=48, mode='run',
+         queue_dir=None, in_fps=None, merge_dim='replicate',
+         stale_after=None, allow_incomplete=False):
+    """Entrypoint function for the SEIRcity model app. In the default
+    `mode` 'run', the workflow in `config_yaml` is run on this host. To
+    run a sweep on more than one host, use mode 'enqueue' to write tasks
+    to shared directory `queue_dir`, then mode 'work' on each host, and
+    finally mode 'reduce' to write outcomes to `out_fp` (see
+    simulate.fs_queue). In mode 'work', tasks claimed more than
+    `stale_after` seconds ago are presumed lost and run again, and mode
+    'reduce' fills pending and claimed tasks with NaN if
+    `allow_incomplete`. Mode 'plan' estimates the cost of the sweep in
+    `config_yaml` without running it, and writes the estimates to
+    `out_fp` as JSON if specified (see simulate.plan). Mode 'merge'
+    concatenates the outcomes of separate runs in `in_fps` along
+    `merge_dim` (see outcome_merge).
+    """
+    if mode == 'work':
+        if queue_dir is None:
+            raise ValueError("--queue-dir is required in mode 'work'")
+        fs_queue.work(queue_dir, threads=threads, stale_after=stale_after)
+        return
+    elif mode == 'reduce':
+        if queue_dir is None or out_fp is None:
+            raise ValueError("--queue-dir and --out-fp are required in " +
+                             "mode 'reduce'")
+        fs_queue.reduce(queue_dir, out_fp=out_fp,
+                        allow_incomplete=allow_incomplete)
+        return
+    elif mode == 'merge':
+        if not in_fps or out_fp is None:
+            raise ValueError("--in-fps and --out-fp are required in " +
+                             "mode 'merge'")
+        merge_outcomes(in_fps, out_fp, dim=merge_dim)
+        return
+
     # ensure YAML file exists
+    if config_yaml is None:
+        raise ValueError("--config-yaml is required in mode '{}'".format(mode))
     if not os.path.isfile(config_yaml):
         raise FileNotFoundError("No config YAML file found at {}".format(config_yaml))
 
@@ -43,14 +81,41 @@ def main(config_yaml, out_fp, threads):
     params = aggregate_params_and_data(yaml_fp=config_yaml)
     print('t_offset = {}'.format(params['t_offset']))
 
+    if params['is_fitting'] and mode in ('plan', 'enqueue'):
+        raise ValueError("Mode '{}' is not supported for fitting ".format(
+            mode) + "workflows")
+    if mode == 'plan':
+        sweep_plan = plan.plan_sweep(params, threads=threads)
+        plan.print_plan(sweep_plan)
+        if out_fp is not None:
+            plan.plan_to_json(sweep_plan, out_fp)
+        return sweep_plan
+    if mode == 'enqueue':
+        if queue_dir is None:
+            raise ValueError("--queue-dir is required in mode 'enqueue'")
+        fs_queue.enqueue(params, queue_dir)
+        return
+    if out_fp is None:
+        raise ValueError("--out-fp is required in mode 'run'")
+
     # determine if user is_fitting, as opposed to simulating
     # TODO: migrate this check to param module
     is_fitting = params['is_fitting']
 
-    if is_fitting:
+    if is_fitting and params.get('fit_joint', None):
+        # one fit of several cities, which share some params
+        fitted_parameters = joint_fitting_workflow(params, out_fp=out_fp,
+                                                   threads=threads)
+    elif is_fitting and params.get('fit_batch', None):
+        # one fit for every value of the keys in fit_batch, e.g. every
+        # start date, written to one table
+        fitted_parameters = batch_fitting_workflow(params, out_fp=out_fp,
+                                                   threads=threads)
+    elif is_fitting:
         # fit model to existing data, returning a fitted beta0 value
         # and a fitted sd_level value
-        fitted_parameters = fitting_workflow(params, out_fp=out_fp)
+        fitted_parameters = fitting_workflow(params, out_fp=out_fp,
+                                             threads=threads)
     else:
         # run model as a as set of simulations across different scenarios
         _ = simulate_multiple(params, out_fp=out_fp, threads=threads)
@@ -59,12 +124,33 @@ def main(config_yaml, out_fp, threads):
 def get_clargs():
     """Get command line arguments `clargs` via argparse"""
     parser = argparse.ArgumentParser()
-    parser.add_argument('--config-yaml', required=True,
+    parser.add_argument('--config-yaml', required=False,
                         help='Config YAML file path')
-    parser.add_argument('--out-fp', required=True,
+    parser.add_argument('--out-fp', required=False,
                         help='Path in which to write outputs')
     parser.add_argument('--threads', type=int, required=False,
                         default=48,
                         help='Number of threads to use in simulation')
+    parser.add_argument('--mode', required=False, default='run',
+                        choices=['run', 'plan', 'enqueue', 'work', 'reduce',
+                                 'merge'],
+                        help='Run on this host (default), estimate the ' +
+                        'cost of a sweep (plan), enqueue, work on, or ' +
+                        'reduce a multi-node sweep, or merge outputs')
+    parser.add_argument('--queue-dir', required=False,
+                        help='Shared work queue directory for modes ' +
+                        'enqueue, work, and reduce')
+    parser.add_argument('--in-fps', required=False, nargs='+',
+                        help='Outputs to merge in mode merge')
+    parser.add_argument('--merge-dim', required=False, default='replicate',
+                        help='Dim to merge outputs along in mode merge: ' +
+                        'replicate (default) or a param, e.g. g_rate')
+    parser.add_argument('--stale-after', type=float, required=False,
+                        help='In mode work, run tasks claimed more than ' +
+                        'this many seconds ago again, e.g. after a node ' +
+                        'was lost')
+    parser.add_argument('--allow-incomplete', action='store_true',
+                        help='In mode reduce, fill tasks that are still ' +
+                        'pending or claimed with NaN instead of raising')
     clargs = vars(parser.parse_args())
     return clargs
@@ -8,3 +8,5 @@ sys.path.append(SEIR_HOME)
 
 
 from .fitting_workflow import fitting_workflow
+from .batch_fit import batch_fitting_workflow
+from .joint_fit import joint_fitting_workflow
@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+"""
+Approximate Bayesian computation (ABC) of the fitted params, by
+sequential Monte Carlo (SMC), for stochastic fits where least squares on
+a single noisy simulation is unreliable. Each generation proposes
+particles from the previous one, simulates them in batches on a
+WorkerPool, and accepts those within a tolerance of the data that
+shrinks from generation to generation. The result is a weighted sample
+of the posterior, which scenario_design.PosteriorDesign turns into the
+scenarios of a forecast.
+"""
+
+import numpy as np
+import pandas as pd
+from scipy import stats
+
+from SEIRcity import utils
+from .fitting_workflow import calc_residuals
+
+# default settings of config key `abc`
+DEFAULT_ABC = {
+    # particles accepted in each generation
+    'n_particles': 100,
+    # maximum number of generations, including the first, from the prior
+    'n_generations': 8,
+    # the tolerance of each generation is this quantile of the distances
+    # of the particles of the previous generation
+    'quantile': 0.5,
+    # proposals simulated at once. Defaults to n_particles
+    'batch_size': None,
+    # stop when the acceptance rate of a generation is below this, or
+    # after this many simulations in total
+    'min_acceptance': 0.01,
+    'max_simulations': 20000,
+    'seed': 0,
+}
+
+
+def distance(residual):
+    """Returns the distance of a simulation from the data: the root mean
+    squared residual (see calc_residual).
+    """
+    return np.sqrt(np.mean(np.square(residual)))
+
+
+def weighted_cov(particles, weights):
+    """Returns the weighted covariance matrix of array `particles` of
+    shape (n, k).
+    """
+    return np.atleast_2d(np.cov(particles, rowvar=False, aweights=weights))
+
+
+def smc_weights(proposed, particles, weights, cov):
+    """Returns the normalized importance weights of array `proposed` of
+    shape (n, k), drawn from the previous generation `particles` with
+    `weights` by normal perturbation kernels of covariance `cov`, under
+    the uniform prior of fit_abc.
+    """
+    kernel = stats.multivariate_normal(mean=np.zeros(particles.shape[1]),
+                                       cov=cov, allow_singular=True)
+    density = np.array([
+        np.sum(weights * kernel.pdf(theta - particles).reshape(-1))
+        for theta in proposed])
+    new_weights = 1. / density
+    return new_weights / new_weights.sum()
+
+
+def fit_abc(fit_var_names, fit_bounds, sim_func, scenario, data, offset,
+            pool=None, abc=None, trace=None):
+    """ABC-SMC (Beaumont et al. 2009) of params `fit_var_names`, with a
+    uniform prior within `fit_bounds`. Settings in dictionary `abc`
+    override DEFAULT_ABC.
+
+    The first generation is drawn from the prior, with no tolerance.
+    Each later generation draws particles of the previous generation by
+    weight, and perturbs them by a normal kernel with twice the
+    weighted covariance of the previous generation. Proposals are
+    simulated in batches of `batch_size` at once, in WorkerPool `pool`
+    if given, and accepted if their distance from `data` (see
+    distance) is within the tolerance of the generation, until
+    `n_particles` are accepted. Simulations are not cached, since each
+    is a different random draw. They are recorded in FitTrace `trace`,
+    if given, as 'proposal', with one iteration per generation.
+
+    Returns the solution dictionary of the fit: the weighted posterior
+    mean of each param, `posterior`, a pandas DataFrame of the particles
+    of the last generation with columns for each param, `weight`, and
+    `distance`, `generations`, a pandas DataFrame of the `tolerance`,
+    `n_simulations`, and `acceptance_rate` of each generation, and the
+    total `n_simulations`.
+    """
+    settings = dict(DEFAULT_ABC, **(abc or dict()))
+    utils.assert_has_keys(fit_bounds, fit_var_names)
+    utils.assert_has_keys(scenario, fit_var_names)
+    low = np.array([fit_bounds[name][0] for name in fit_var_names],
+                   dtype=float)
+    high = np.array([fit_bounds[name][1] for name in fit_var_names],
+                    dtype=float)
+    if not np.all(np.isfinite(low) & np.isfinite(high)):
+        raise ValueError("ABC requires finite fit_bounds for its prior")
+    n_particles = settings['n_particles']
+    batch_size = settings['batch_size'] or n_particles
+    rng = np.random.default_rng(settings['seed'])
+
+    particles = weights = distances = None
+    generations = list()
+    n_simulations = 0
+    for generation in range(settings['n_generations']):
+        if particles is None:
+            tolerance = np.inf
+        else:
+            tolerance = np.quantile(distances, settings['quantile'])
+            cov = 2. * weighted_cov(particles, weights)
+        if trace is not None:
+            trace.new_iteration()
+        accepted, accepted_dist = list(), list()
+        n_gen_sims = n_within = 0
+        while len(accepted) < n_particles and \
+                n_simulations < settings['max_simulations']:
+            n_batch = min(batch_size, settings['max_simulations'] -
+                          n_simulations)
+            if particles is None:
+                proposed = low + rng.random((n_batch, len(low))) * \
+                    (high - low)
+            else:
+                # perturbed particles, redrawn where outside the prior
+                proposed = np.empty((n_batch, len(low)))
+                n_proposed = 0
+                while n_proposed < n_batch:
+                    idx = rng.choice(len(particles), size=n_batch,
+                                     p=weights)
+                    theta = particles[idx] + rng.multivariate_normal(
+                        np.zeros(len(low)), cov, size=n_batch,
+                        check_valid='ignore')
+                    theta = theta[np.all((theta >= low) & (theta <= high),
+                                         axis=1)]
+                    n_new = min(len(theta), n_batch - n_proposed)
+                    proposed[n_proposed:n_proposed + n_new] = theta[:n_new]
+                    n_proposed += n_new
+            residuals = calc_residuals(list(proposed), fit_var_names,
+                                       sim_func, scenario, data, offset,
+                                       pool=pool, trace=trace,
+                                       kind='proposal')
+            n_simulations += n_batch
+            n_gen_sims += n_batch
+            for theta, residual in zip(proposed, residuals):
+                dist = distance(residual)
+                if dist > tolerance:
+                    continue
+                n_within += 1
+                if len(accepted) < n_particles:
+                    accepted.append(theta)
+                    accepted_dist.append(dist)
+
+        if len(accepted) < n_particles:
+            print("ABC stopped in generation {} after {} simulations".format(
+                generation, n_simulations))
+            break
+        accepted = np.array(accepted)
+        if particles is None:
+            new_weights = np.full(n_particles, 1. / n_particles)
+        else:
+            new_weights = smc_weights(accepted, particles, weights, cov)
+        particles, weights = accepted, new_weights
+        distances = np.array(accepted_dist)
+        acceptance_rate = n_within / float(n_gen_sims)
+        generations.append({'generation': generation,
+                            'tolerance': tolerance,
+                            'n_simulations': n_gen_sims,
+                            'acceptance_rate': acceptance_rate})
+        print("ABC generation {}: tolerance {:.6g}, acceptance rate ".format(
+            generation, tolerance) + "{:.1%}".format(acceptance_rate))
+        if generation > 0 and acceptance_rate < settings['min_acceptance']:
+            break
+
+    if particles is None:
+        raise ValueError("ABC did not accept {} particles within ".format(
+            n_particles) + "{} simulations".format(settings['max_simulations']))
+    posterior = pd.DataFrame(particles, columns=fit_var_names)
+    posterior['weight'] = weights
+    posterior['distance'] = distances
+    soln_dict = dict([(name, np.sum(weights * particles[:, i]))
+                      for i, name in enumerate(fit_var_names)])
+    soln_dict['posterior'] = posterior
+    soln_dict['generations'] = pd.DataFrame(generations)
+    soln_dict['n_simulations'] = n_simulations
+    return soln_dict
@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+"""
+Fitting the same model to the same data for many values of a fit
+setting, e.g. every candidate start date of the epidemic, in one process
+"""
+
+import numpy as np
+import pandas as pd
+
+from SEIRcity.scenario_design import GridDesign
+from .fitting_workflow import fit_config
+from .defaults import DEFAULT_FIT_VAR_NAMES, DEFAULT_FIT_GUESS
+from ..simulate import simulate_one
+from ..simulate.worker_pool import get_pool
+
+
+def get_batch_points(config):
+    """Returns list of the points of the batch fit defined by config
+    key `fit_batch`, a dictionary mapping each config key to its list of
+    values (e.g. {'time_begin_sim': [20200208, 20200209]}). Each point
+    is a dictionary of config keys, and points are in the order of
+    nested loops over each key.
+    """
+    batch = config.get('fit_batch', None)
+    if not batch:
+        raise ValueError("config has no `fit_batch` to fit")
+    return list(GridDesign(batch))
+
+
+def split_chains(n_points, n_chains):
+    """Returns list of `n_chains` lists of consecutive point indices, of
+    sizes that differ by at most 1.
+    """
+    n_chains = max(1, min(n_chains, n_points))
+    return [list(chain) for chain in
+            np.array_split(np.arange(n_points), n_chains)]
+
+
+def _fit_chain(args):
+    """Fits each point in list `points` of (index, point) tuples in
+    order, starting each fit from the solution of the previous one.
+    Returns list of (index, solution) tuples. `config` may be a
+    SharedObject.
+    """
+    config, points, case_data, sim_func = args
+    if hasattr(config, 'resolve'):
+        config = config.resolve()
+    fit_var_names = config.get("fit_var_names", DEFAULT_FIT_VAR_NAMES)
+    fit_guess = config.get("fit_guess", DEFAULT_FIT_GUESS)
+    solutions = list()
+    for point_idx, point in points:
+        point_config = dict(config, **point)
+        solution = fit_config(point_config, case_data, fit_guess=fit_guess,
+                              sim_func=sim_func)
+        solutions.append((point_idx, solution))
+        # warm start the next fit
+        fit_guess = dict(fit_guess, **{
+            name: solution[name] for name in fit_var_names})
+    return solutions
+
+
+def batch_fitting_workflow(config, out_fp=None, threads=None, pool=None,
+                           sim_func=simulate_one):
+    """Fits the scenario of `config` once for every point of config key
+    `fit_batch` (see get_batch_points), such as every candidate
+    `time_begin_sim`, sharing the loaded city and hospitalization data
+    between the fits. Returns a pandas DataFrame with one row per point:
+    the value of each key of `fit_batch`, the fitted values, the errors
+    `final_rmsd` and `final_nrmsd_t`, and the `n_simulations` and
+    `cache_hit_rate` of each fit (and its `n_iterations` and
+    `wall_seconds` if config key `fit_trace` is set), which is written
+    to CSV file `out_fp` if specified.
+
+    Points are split into chains of consecutive points. Fits in a chain
+    run one after the other, and each starts from the solution of the
+    previous fit, which is usually close. Chains run in parallel on
+    WorkerPool `pool`, or the process-wide WorkerPool with `threads`
+    workers if `threads` > 1, with the config shared once. There is one
+    chain per worker, unless set by config key `fit_batch_chains`.
+    """
+    points = get_batch_points(config)
+    case_data = pd.read_csv(config['hosp_data_fp'])
+    if pool is None and threads is not None and threads > 1:
+        pool = get_pool(threads)
+    n_chains = config.get('fit_batch_chains', None)
+    if n_chains is None:
+        n_chains = 1 if pool is None else pool.threads
+    chains = split_chains(len(points), n_chains)
+    print("Fitting {} points of fit_batch in {} chains".format(
+        len(points), len(chains)))
+
+    if pool is None:
+        payload_config = config
+    else:
+        payload_config = pool.share(config)
+    payload = [(payload_config, [(idx, points[idx]) for idx in chain],
+                case_data, sim_func) for chain in chains]
+    if pool is None:
+        results = [_fit_chain(args) for args in payload]
+    else:
+        results = pool.map(_fit_chain, payload, chunksize=1)
+
+    # one row per point, in the order of the points
+    fit_var_names = config.get("fit_var_names", DEFAULT_FIT_VAR_NAMES)
+    rows = [None] * len(points)
+    for chain_result in results:
+        for point_idx, solution in chain_result:
+            row = dict(points[point_idx])
+            row.update({name: solution[name] for name in fit_var_names})
+            for key in ('final_rmsd', 'final_nrmsd_t', 'n_simulations',
+                        'cache_hit_rate', 'n_iterations', 'wall_seconds'):
+                if key in solution:
+                    row[key] = solution[key]
+            rows[point_idx] = row
+    table = pd.DataFrame(rows)
+    if out_fp is not None:
+        print("Writing fitted values to: {}".format(out_fp))
+        table.to_csv(out_fp, index=False)
+    return table
@@ -0,0 +1,319 @@
+# -*- coding: utf-8 -*-
+"""
+Calibration on an emulator of the residuals of a fit, for fits where
+each simulation is expensive, e.g. stochastic fits that are averaged
+over many replicates. Gaussian processes emulate the principal
+components of the residuals (see calc_residual) over the bounds of the
+fitted params, from a Latin hypercube of real simulations. The sum of
+squares of the emulated residuals is minimized instead of that of the
+model, refined with real simulations near its minimum, and the result
+is confirmed with a real simulation.
+"""
+
+import numpy as np
+from scipy.linalg import cho_factor, cho_solve
+from scipy.optimize import minimize
+
+from SEIRcity import utils
+from SEIRcity.scenario_design import LatinHypercubeDesign
+from .fitting_workflow import calc_residuals, rmsd_t, nrmsd_t
+
+# default settings of config key `emulator`
+DEFAULT_EMULATOR = {
+    # real simulations of the initial design, per fitted param
+    'n_init_per_param': 5,
+    # rounds of refinement near the best simulation
+    'n_iter': 8,
+    # real simulations per round. Defaults to one more than the number
+    # of fitted params, but at most MAX_BATCH_SIZE
+    'batch_size': None,
+    # seed of the initial design and of the starts of each minimization
+    'seed': 0,
+    # factor of the width of the box after a round without a better
+    # simulation
+    'shrink': 0.5,
+    # stop refining when the box is narrower than this, as a fraction
+    # of the bounds of each param
+    'xtol': 1e-3,
+}
+# largest default batch_size. More simulations per round are mostly
+# spent exploring, so this is not set by the number of workers
+MAX_BATCH_SIZE = 4
+# largest weight of the std in the lower confidence bounds minimized by
+# each round
+MAX_KAPPA = 1.
+# bounds of the log of the length scales and noise of the emulator,
+# with inputs scaled to [0, 1]
+LOG_LENGTH_BOUNDS = (np.log(1e-2), np.log(1e1))
+LOG_NOISE_BOUNDS = (np.log(1e-8), np.log(1e-1))
+
+
+class GaussianProcess(object):
+    """Gaussian process regression with a squared exponential kernel,
+    a length scale per input dim, and a noise variance (nugget) that
+    absorbs the noise of stochastic simulations. Outputs are
+    standardized, and hyperparameters maximize the log marginal
+    likelihood.
+    """
+
+    def __init__(self, n_restarts=3, seed=None):
+        self.n_restarts = n_restarts
+        self.rng = np.random.default_rng(seed)
+        self.log_length = None
+        self.log_noise = None
+
+    def _kernel(self, a, b, log_length):
+        diff = (a[:, None, :] - b[None, :, :]) / np.exp(log_length)
+        return np.exp(-0.5 * np.sum(diff ** 2, axis=-1))
+
+    def _neg_log_likelihood(self, theta, X, y):
+        log_length, log_noise = theta[:-1], theta[-1]
+        K = self._kernel(X, X, log_length) + \
+            np.exp(log_noise) * np.eye(len(X))
+        try:
+            factor = cho_factor(K, lower=True)
+        except np.linalg.LinAlgError:
+            return np.inf
+        alpha = cho_solve(factor, y)
+        return 0.5 * y.dot(alpha) + np.sum(np.log(np.diag(factor[0])))
+
+    def fit(self, X, y):
+        """Fits the emulator to inputs `X` of shape (n, k), scaled to
+        [0, 1], and outputs `y` of shape (n,). Returns self.
+        """
+        X = np.asarray(X, dtype=float)
+        y = np.asarray(y, dtype=float)
+        self.y_mean = y.mean()
+        self.y_std = y.std() or 1.
+        y_scaled = (y - self.y_mean) / self.y_std
+        k = X.shape[1]
+        bounds = [LOG_LENGTH_BOUNDS] * k + [LOG_NOISE_BOUNDS]
+        starts = [np.append(np.full(k, np.log(0.3)), np.log(1e-4))]
+        if self.log_length is not None:
+            starts.append(np.append(self.log_length, self.log_noise))
+        for _ in range(self.n_restarts):
+            starts.append(np.array([self.rng.uniform(*b) for b in bounds]))
+        best = None
+        for theta0 in starts:
+            result = minimize(self._neg_log_likelihood, theta0,
+                              args=(X, y_scaled), method='L-BFGS-B',
+                              bounds=bounds)
+            if best is None or result.fun < best.fun:
+                best = result
+        self.log_length, self.log_noise = best.x[:-1], best.x[-1]
+        K = self._kernel(X, X, self.log_length) + \
+            np.exp(self.log_noise) * np.eye(len(X))
+        self._factor = cho_factor(K, lower=True)
+        self._alpha = cho_solve(self._factor, y_scaled)
+        self.X = X
+        return self
+
+    def predict(self, X):
+        """Returns tuple of the mean and standard deviation of the
+        emulated output at inputs `X` of shape (n, k).
+        """
+        X = np.atleast_2d(X)
+        k_star = self._kernel(X, self.X, self.log_length)
+        mean = k_star.dot(self._alpha)
+        v = cho_solve(self._factor, k_star.T)
+        var = np.maximum(1. - np.sum(k_star.T * v, axis=0), 0.)
+        return (mean * self.y_std + self.y_mean,
+                np.sqrt(var) * self.y_std)
+
+
+class ResidualEmulator(object):
+    """Emulator of residual vectors: a GaussianProcess for each of the
+    principal components of the residuals that together explain all but
+    a fraction `var_tol` of their variance.
+    """
+
+    def __init__(self, var_tol=1e-6, seed=None):
+        self.var_tol = var_tol
+        self.seed = seed
+
+    def fit(self, X, residuals):
+        """Fits the emulator to inputs `X` of shape (n, k), scaled to
+        [0, 1], and `residuals` of shape (n, m). Returns self.
+        """
+        residuals = np.asarray(residuals, dtype=float)
+        self.mean = residuals.mean(axis=0)
+        _, sing, vt = np.linalg.svd(residuals - self.mean,
+                                    full_matrices=False)
+        explained = np.cumsum(sing ** 2) / max(np.sum(sing ** 2), 1e-300)
+        n_comp = int(np.searchsorted(explained, 1. - self.var_tol)) + 1
+        self.components = vt[:min(n_comp, len(vt))]
+        scores = (residuals - self.mean).dot(self.components.T)
+        self.gps = [GaussianProcess(seed=self.seed).fit(X, score)
+                    for score in scores.T]
+        return self
+
+    def predict_sse(self, X):
+        """Returns tuple of the mean and (approximate) standard deviation
+        of the emulated sum of squared residuals at inputs `X` of shape
+        (n, k).
+        """
+        means, variances = list(), list()
+        for gp in self.gps:
+            mean, std = gp.predict(X)
+            means.append(mean)
+            variances.append(std ** 2)
+        means, variances = np.array(means), np.array(variances)
+        residual = self.mean + means.T.dot(self.components)
+        proj = residual.dot(self.components.T)
+        sse = np.sum(residual ** 2, axis=1) + variances.sum(axis=0)
+        sse_std = 2. * np.sqrt(np.sum(variances.T * proj ** 2, axis=1))
+        return sse, sse_std
+
+
+def _minimize_emulator(emulator, starts, scale, kappa=0.):
+    """Returns the point in [0, 1]^k that minimizes the lower confidence
+    bound (mean - `kappa` * std) of the sum of squares of
+    ResidualEmulator `emulator`, divided by `scale`, starting from each
+    of `starts`.
+    """
+    def objective(u):
+        sse, sse_std = emulator.predict_sse(u)
+        return (sse[0] - kappa * sse_std[0]) / scale
+
+    best = None
+    for u0 in starts:
+        result = minimize(objective, u0, method='L-BFGS-B',
+                          bounds=[(0., 1.)] * len(u0))
+        if best is None or result.fun < best.fun:
+            best = result
+    return np.clip(best.x, 0., 1.)
+
+
+def _fit_local(emulator, us, residuals, low, high, n_min):
+    """Fits ResidualEmulator `emulator` to the simulated points `us`
+    within twice box [`low`, `high`], or the `n_min` points nearest its
+    center if there are fewer, with inputs scaled such that the box is
+    [0, 1]^k. Returns `emulator`.
+    """
+    scaled = (np.array(us) - low) / (high - low)
+    dist = np.max(np.abs(scaled - 0.5), axis=1)
+    local = dist <= 1.
+    if local.sum() < n_min:
+        local = np.argsort(dist)[:n_min]
+    return emulator.fit(scaled[local], np.array(residuals)[local])
+
+
+def fit_emulator(fit_var_names, fit_guess, fit_bounds, sim_func, scenario,
+                 data, offset, pool=None, emulator=None, trace=None):
+    """Same as fit_to_data, but minimizes the sum of squares of a
+    ResidualEmulator of the residuals, instead of those of the model
+    itself. Settings in dictionary `emulator` override DEFAULT_EMULATOR:
+
+    1. The initial design is a Latin hypercube of `n_init_per_param`
+       points per fitted param within `fit_bounds`, plus `fit_guess`.
+    2. In each of `n_iter` rounds, the emulator is refitted to the
+       simulations in a box around the best simulation so far, and
+       `batch_size` points in the box are simulated: the minimum of
+       the emulated sum of squares, and minima of its lower confidence
+       bounds, mean - kappa * std for kappa evenly spaced up to
+       MAX_KAPPA, which explore where the emulator is uncertain. The box
+       starts as the whole of `fit_bounds`. It moves to the new best
+       simulation if the round found one, else its width is multiplied
+       by `shrink`, until it is narrower than `xtol`.
+    3. The minimum of the final emulator is simulated, and the best
+       real simulation is returned.
+
+    Each batch of simulations runs at once in WorkerPool `pool`, if
+    given, and is recorded in FitTrace `trace`, if given, as 'design',
+    'refine', or 'confirm', with one iteration per round. A fit of k
+    params takes at most 5k + 2 + n_iter * batch_size
+    simulations. The solution has the same keys as that of fit_to_data,
+    and `n_simulations`.
+    """
+    settings = dict(DEFAULT_EMULATOR, **(emulator or dict()))
+    utils.assert_has_keys(fit_guess, fit_var_names)
+    utils.assert_has_keys(fit_bounds, fit_var_names)
+    utils.assert_has_keys(scenario, fit_var_names)
+    k = len(fit_var_names)
+    lower = np.array([fit_bounds[name][0] for name in fit_var_names],
+                     dtype=float)
+    upper = np.array([fit_bounds[name][1] for name in fit_var_names],
+                     dtype=float)
+    batch_size = settings['batch_size']
+    if batch_size is None:
+        batch_size = min(k + 1, MAX_BATCH_SIZE)
+    rng = np.random.default_rng(settings['seed'])
+
+    # simulated points, scaled to [0, 1], and their residuals
+    us = list()
+    residuals = list()
+
+    def simulate(new_us, kind):
+        fit_vars = [lower + u * (upper - lower) for u in new_us]
+        new_residuals = calc_residuals(
+            fit_vars, fit_var_names, sim_func, scenario, data, offset,
+            pool=pool, trace=trace, kind=kind)
+        us.extend(new_us)
+        residuals.extend(new_residuals)
+
+    def costs():
+        return np.array([np.sum(np.square(r)) for r in residuals])
+
+    # initial space-filling design, and the guess
+    n_init = settings['n_init_per_param'] * k
+    design = LatinHypercubeDesign(
+        dict([(i, {'low': 0., 'high': 1.}) for i in range(k)]), n=n_init,
+        seed=settings['seed'])
+    guess = np.array([fit_guess[name] for name in fit_var_names], dtype=float)
+    init_us = [np.array([point[i] for i in range(k)]) for point in design]
+    init_us.append(np.clip((guess - lower) / (upper - lower), 0., 1.))
+    simulate(init_us, 'design')
+
+    surrogate = ResidualEmulator(seed=settings['seed'])
+    n_min = min(n_init + 1, 2 * k + 2)
+    half_width = 0.5
+    for iteration in range(settings['n_iter']):
+        if 2 * half_width < settings['xtol']:
+            break
+        cost = costs()
+        best = us[int(np.argmin(cost))]
+        low = np.clip(best - half_width, 0., 1.)
+        high = np.clip(best + half_width, 0., 1.)
+        _fit_local(surrogate, us, residuals, low, high, n_min)
+        # start from the best simulation, and a few random points
+        starts = [(best - low) / (high - low)] + list(rng.random((3, k)))
+        new_us = list()
+        for kappa in np.linspace(0., MAX_KAPPA, batch_size):
+            u = low + (high - low) * _minimize_emulator(
+                surrogate, starts, cost.min() or 1., kappa=kappa)
+            # do not simulate the same point twice
+            if min([np.max(np.abs(u - other)) for other in us + new_us]) \
+                    > settings['xtol'] * half_width:
+                new_us.append(u)
+        print("Emulator round {}: {} simulations, best cost {:.6g}".format(
+            iteration, len(us), cost.min()))
+        if trace is not None:
+            trace.new_iteration()
+        if new_us:
+            simulate(new_us, 'refine')
+        # move the box if the round found a better point, else shrink it
+        if costs().min() >= cost.min():
+            half_width *= settings['shrink']
+
+    # confirm the minimum of the final emulator with a real simulation
+    cost = costs()
+    best = us[int(np.argmin(cost))]
+    low = np.clip(best - half_width, 0., 1.)
+    high = np.clip(best + half_width, 0., 1.)
+    _fit_local(surrogate, us, residuals, low, high, n_min)
+    u_min = low + (high - low) * _minimize_emulator(
+        surrogate, [(best - low) / (high - low)], cost.min() or 1.)
+    if min([np.max(np.abs(u_min - other)) for other in us]) > 0.:
+        simulate([u_min], 'confirm')
+    best_idx = int(np.argmin(costs()))
+    best_x = lower + us[best_idx] * (upper - lower)
+
+    soln_dict = dict({
+        name: val for name, val in zip(fit_var_names, best_x)
+    })
+    soln_dict['final_error'] = residuals[best_idx]
+    soln_dict['final_rmsd'] = rmsd_t(soln_dict['final_error'])
+    soln_dict['final_nrmsd_t'] = nrmsd_t(soln_dict['final_rmsd'], data)
+    soln_dict['n_simulations'] = len(us)
+    print("Emulator fit ran {} simulations".format(len(us)))
+    return soln_dict
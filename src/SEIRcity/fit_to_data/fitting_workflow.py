@@ -9,37 +9,88 @@ import pandas as pd
 from scipy.optimize import least_squares
 from scipy import stats
 import os
+import time
 import datetime
 from datetime import timedelta
 import multiprocessing as mp
 import pickle
 import json
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
 
 from SEIRcity.model import SEIR_model_publish_w_risk
 from SEIRcity import param as param_module
 from SEIRcity import get_scenarios, utils
+from SEIRcity.scenario import BaseScenario
 from .defaults import DEFAULT_FIT_VAR_NAMES, DEFAULT_FIT_GUESS, DEFAULT_FIT_BOUNDS
-from ..simulate import simulate_one
+from ..simulate import simulate_one, simulate_hosp
+from ..simulate.worker_pool import get_pool
 
-def fitting_workflow(config, out_fp=None):
+# relative step of the forward differences of the Jacobian, the same as
+# scipy.optimize.least_squares with jac='2-point'
+FD_REL_STEP = np.finfo(np.float64).eps ** 0.5
+# default number of simulations kept by the SimulationCache of each fit
+FIT_CACHE_SIZE = 256
+
+def fitting_workflow(config, out_fp=None, threads=None, pool=None):
     """Recapitulation of fit_to_data.fitting_workflow from branch
-    parameter_fitting. Main handler for fitting.
+    parameter_fitting. Main handler for fitting. If `threads` or a
+    WorkerPool `pool` is given, the simulations of each Jacobian are
+    run in parallel (see ParallelJacobian). Tables of the solution,
+    such as the `posterior` of an ABC fit, are written to CSVs next to
+    `out_fp` (see uncertainty.uncertainty_fp). If config key
+    `fit_uncertainty` is set, the uncertainty of the fit is estimated
+    with uncertainty_workflow, and written next to `out_fp`. The
+    posterior of an ABC fit is its uncertainty, so `fit_uncertainty`
+    with `fit_method` 'abc' raises ValueError.
     """
     # get YAML params
     #config = param_module.aggregate_params_and_data(yaml_fp=yaml_fp)
-
-    # get list of params to float, as well as guesses and bounds,
-    # from the config YAML
-    fit_var_names = config.get("fit_var_names", DEFAULT_FIT_VAR_NAMES)
-    fit_guess = config.get("fit_guess", DEFAULT_FIT_GUESS)
-    fit_bounds = config.get("fit_bounds", DEFAULT_FIT_BOUNDS)
-
-    # TODO: validation on fit_var_* data formats
+    if config.get('fit_uncertainty', None) and \
+            config.get('fit_method', 'least_squares') == 'abc':
+        raise ValueError("fit_uncertainty does not apply to fit_method " +
+                         "'abc': use the posterior of the fit instead")
 
     # get hosp data as pandas df
     case_data = pd.read_csv(config['hosp_data_fp'])
 
+    if pool is None and threads is not None and threads > 1:
+        pool = get_pool(threads)
+
+    # run the solver, returning dictionary containing error
+    # and fitted values
+    solution = fit_config(config, case_data, pool=pool)
+
+    # tables of the fit, such as the posterior sample of fit_abc, are
+    # written to their own CSV next to out_fp
+    tables = dict([(key, solution.pop(key)) for key in list(solution)
+                   if isinstance(solution[key], pd.DataFrame)])
+
+    # pretty logging
+    for var_name in solution.keys():
+        print("{}: {}".format(var_name, solution[var_name]))
+
+    # write solution to a tiny CSV
+    if out_fp is not None:
+        print("Writing fitted values to: {}".format(out_fp))
+        as_df = pd.DataFrame([solution])
+        as_df.to_csv(out_fp, index=False)
+        from .uncertainty import uncertainty_fp
+        for key, table in tables.items():
+            table_fp = uncertainty_fp(out_fp, key)
+            print("Writing {} to: {}".format(key, table_fp))
+            table.to_csv(table_fp, index=False)
+
+    if config.get('fit_uncertainty', None):
+        from .uncertainty import uncertainty_workflow
+        uncertainty_workflow(config, case_data, solution, out_fp=out_fp,
+                             pool=pool)
+    return solution
+
+
+def get_fit_scenario(config):
+    """Returns the one Scenario of the fit defined by `config`, with its
+    `config`. Raises ValueError if `config` defines more than one.
+    """
     # get a list of Scenario instances. similar to gather_params
     scenarios_tup = get_scenarios.get_scenarios(config=config)
     # assert that there is only one Scenario in the list
@@ -48,11 +99,18 @@ def fitting_workflow(config, out_fp=None):
         raise ValueError('{} parameter '.format(len(scenarios_tup)) +
                          'sets generated for fitting, but only one is ' +
                          'allowed. Please check the config file.')
-    else:
-        scenario = scenarios_tup[0]
-        scenario.inject()
-        scenario['config'] = config
+    scenario = scenarios_tup[0]
+    scenario.inject()
+    scenario['config'] = config
+    return scenario
+
 
+def align_data(case_data, scenario):
+    """Returns tuple of (data, offset): the hospitalizations in pandas
+    DataFrame `case_data` (columns `date` and `hospitalized`) from the
+    first day simulated by `scenario`, and the day of the simulation
+    that the first of these is compared to.
+    """
     # Kelly's addition to workflow
     data_start_date = dt.datetime.strptime(np.str(case_data['date'][0]), '%Y-%m-%d')
     data_pts = case_data['hospitalized'].values
@@ -66,33 +124,91 @@ def fitting_workflow(config, out_fp=None):
     else:
         comparison_offset = (data_start_date - date_begin).days
         case_data_values = data_pts
+    return case_data_values, comparison_offset
+
+
+def fit_config(config, case_data, fit_guess=None, sim_func=simulate_one,
+               pool=None):
+    """Fits the one Scenario defined by `config` to the hospitalizations
+    in pandas DataFrame `case_data`, starting from dictionary
+    `fit_guess` (config key `fit_guess` by default). Config key
+    `fit_cache_size` sets the size of the SimulationCache of the fit.
+    Config key `fit_method` is 'least_squares' (default), to fit with
+    fit_to_data, 'emulator', to fit with fit_emulator and the settings
+    in config key `emulator`, 'global', to fit with fit_global and the
+    settings in config key `global_fit`, or 'abc', to sample the
+    posterior with fit_abc and the settings in config key `abc`. If
+    config key `fit_trace` is true, every evaluation is recorded in a
+    FitTrace, and the solution has its summary (see FitTrace.summary),
+    and the table of its records `trace`. Returns the solution
+    dictionary of the fit.
+    """
+    # get list of params to float, as well as guesses and bounds,
+    # from the config YAML
+    fit_var_names = config.get("fit_var_names", DEFAULT_FIT_VAR_NAMES)
+    if fit_guess is None:
+        fit_guess = config.get("fit_guess", DEFAULT_FIT_GUESS)
+    fit_bounds = config.get("fit_bounds", DEFAULT_FIT_BOUNDS)
 
-    # run the solver, returning dictionary containing error
-    # and fitted values
-    solution = fit_to_data(
-        fit_var_names=fit_var_names,
-        fit_guess=fit_guess,
-        fit_bounds=fit_bounds,
-        sim_func=simulate_one, #SEIR_model_publish_w_risk,
-        scenario=scenario,
-        data=case_data_values,
-        offset=comparison_offset)
-
-    # pretty logging
-    for var_name in solution.keys():
-        print("{}: {}".format(var_name, solution[var_name]))
+    # TODO: validation on fit_var_* data formats
 
-    # write solution to a tiny CSV
-    if out_fp is not None:
-        print("Writing fitted values to: {}".format(out_fp))
-        as_df = pd.DataFrame([solution])
-        as_df.to_csv(out_fp, index=False)
+    scenario = get_fit_scenario(config)
+    data, offset = align_data(case_data, scenario)
+    trace = FitTrace() if config.get('fit_trace', False) else None
+    fit_method = config.get('fit_method', 'least_squares')
+    if fit_method == 'emulator':
+        from .emulator import fit_emulator
+        solution = fit_emulator(
+            fit_var_names, fit_guess, fit_bounds, sim_func, scenario, data,
+            offset, pool=pool, emulator=config.get('emulator', None),
+            trace=trace)
+    elif fit_method == 'global':
+        from .global_fit import fit_global
+        solution = fit_global(
+            fit_var_names, fit_guess, fit_bounds, sim_func, scenario, data,
+            offset, pool=pool,
+            cache_size=config.get('fit_cache_size', FIT_CACHE_SIZE),
+            global_fit=config.get('global_fit', None), trace=trace)
+    elif fit_method == 'abc':
+        from .abc import fit_abc
+        solution = fit_abc(fit_var_names, fit_bounds, sim_func, scenario,
+                           data, offset, pool=pool,
+                           abc=config.get('abc', None), trace=trace)
+    elif fit_method == 'least_squares':
+        solution = fit_to_data(
+            fit_var_names=fit_var_names,
+            fit_guess=fit_guess,
+            fit_bounds=fit_bounds,
+            sim_func=sim_func, #SEIR_model_publish_w_risk,
+            scenario=scenario,
+            data=data,
+            offset=offset,
+            pool=pool,
+            cache_size=config.get('fit_cache_size', FIT_CACHE_SIZE),
+            trace=trace)
+    else:
+        raise ValueError("fit_method must be 'least_squares', " +
+                         "'emulator', 'global', or 'abc', not {}".format(
+                             fit_method))
+    if trace is not None:
+        for key, value in trace.summary().items():
+            solution.setdefault(key, value)
+        solution['trace'] = trace.to_frame()
     return solution
 
 
 def fit_to_data(fit_var_names, fit_guess, fit_bounds,
-                sim_func, scenario, data, offset):
-    """Wrapper around scipy.optimize.least_squares"""
+                sim_func, scenario, data, offset, pool=None,
+                cache_size=FIT_CACHE_SIZE, cache=None, trace=None):
+    """Wrapper around scipy.optimize.least_squares. If WorkerPool `pool`
+    is given, the simulations of the forward differences of each
+    Jacobian run in parallel in `pool` (see ParallelJacobian), which
+    gives the same fit as the default serial '2-point' Jacobian.
+    Simulations are kept in SimulationCache `cache`, or a new one of
+    `cache_size` param vectors (none if 0), and the solution has the
+    number of simulations `n_simulations` and `cache_hit_rate` of the
+    cache. Evaluations are recorded in FitTrace `trace`, if given.
+    """
 
     # Ensure that there are guess and bounds values
     # for each floating parameter
@@ -120,13 +236,24 @@ def fit_to_data(fit_var_names, fit_guess, fit_bounds,
         x_scale[beta_idx] = 0.01
 
     # call scipy.optimize.least_squares
+    if cache is None and cache_size:
+        cache = SimulationCache(cache_size)
+    args = (fit_var_names, sim_func, scenario, data, offset)
+    if pool is None and trace is None:
+        fun, jac = calc_residual, '2-point'
+    else:
+        # same as '2-point', but tells Jacobian steps from residuals
+        jac = ParallelJacobian(pool, bounds, *args, cache=cache, trace=trace)
+        fun = jac.residual
     soln_full = least_squares(
-        fun=calc_residual,
+        fun=fun,
         x0=x0,
+        jac=jac,
         #x_scale=x_scale,
         #xtol=1e-8,  # default
         bounds=bounds,
-        args=(fit_var_names, sim_func, scenario, data, offset))
+        args=args,
+        kwargs={'cache': cache})
 
     # convert fitted values to dictionary
     soln_lst = list(soln_full['x'])
@@ -141,15 +268,56 @@ def fit_to_data(fit_var_names, fit_guess, fit_bounds,
     soln_dict['final_rmsd'] = rmsd_t(soln_dict['final_error'])
     soln_dict['final_nrmsd_t'] = nrmsd_t(soln_dict['final_rmsd'], data)
 
+    # savings of the cache
+    if cache is not None:
+        soln_dict['n_simulations'] = cache.misses
+        soln_dict['cache_hit_rate'] = cache.hit_rate
+        print("Ran {} simulations, and reused {} from cache ".format(
+            cache.misses, cache.hits) + "(hit rate {:.1%})".format(
+                cache.hit_rate))
+
     return soln_dict
 
 
-def calc_residual(fit_var, fit_var_names, sim_func, scenario, data, comp_offset):
-    """Callback function for fit_to_data"""
+def calc_residual(fit_var, fit_var_names, sim_func, scenario, data, comp_offset,
+                  cache=None):
+    """Callback function for fit_to_data. Returns the difference between
+    the hospitalizations simulated by simulate_fit_compt (from
+    SimulationCache `cache`, if given) and `data`, from day
+    `comp_offset` of the simulation. `scenario` is not modified, so
+    residuals can be calculated concurrently.
+    """
+    # only the days compared to data are simulated
+    n_days = comp_offset + len(data)
+    if cache is None:
+        fit_compt = simulate_fit_compt(fit_var, fit_var_names, sim_func,
+                                       scenario, n_days=n_days)
+    else:
+        fit_compt = cache.simulate(fit_var, fit_var_names, sim_func,
+                                   scenario, n_days=n_days)
+    return get_residual(fit_compt, data, comp_offset)
+
+
+def get_residual(fit_compt, data, comp_offset):
+    """Returns residual of `data`, given daily hospitalizations
+    `fit_compt` from simulate_fit_compt.
+    """
+    return fit_compt[comp_offset: comp_offset + len(data)] - data
+
+
+def simulate_fit_compt(fit_var, fit_var_names, sim_func, scenario,
+                       n_days=None):
+    """Simulates a copy of `scenario` with params `fit_var_names` set to
+    `fit_var`, using `sim_func`. Returns array of the hospitalizations
+    (Ih) at the start of each of the first `n_days` days (or every
+    day). If `sim_func` is simulate_one, simulate_hosp is used instead,
+    which stops after `n_days` days, and only keeps Ih.
+    """
 
     assert len(fit_var) == len(fit_var_names), \
         "length of fit_var: {}, but expected {}".format(len(fit_var), len(fit_var_names))
     assert hasattr(scenario, 'n_age'), "Scenario instance has no attribute 'n_age'"
+    scenario = BaseScenario(scenario, inject=False)
 
     # Make sure beta0 is array, not float, before running model function
     scenario['beta0'] = scenario['beta0'] * np.ones(scenario['n_age'])
@@ -163,9 +331,6 @@ def calc_residual(fit_var, fit_var_names, sim_func, scenario, data, comp_offset)
         if var_name == 'beta0':
             scenario[var_name] = fit_var[var_idx] * np.ones(scenario['n_age'])
 
-    for var in fit_var_names:
-        print('Variable {} = {}'.format(var, scenario[var]))
-
     # filter to only the params needed for model function
     #scenario_final = filter_params(scenario)
     sim_args = {'scenario': scenario}
@@ -173,15 +338,324 @@ def calc_residual(fit_var, fit_var_names, sim_func, scenario, data, comp_offset)
     # run the model function
     #S, E, Ia, Iy, Ih, R, D, E2Iy, E2I, Iy2Ih, H2D, SchoolCloseTime, \
     #    SchoolReopenTime = \
+    if sim_func is simulate_one:
+        Ih = simulate_hosp(n_days=n_days, **sim_args)
+        return Ih.sum(axis=1).sum(axis=1)
     comp_stack = sim_func(**sim_args)
     Ih = comp_stack[7]
     fit_compt = Ih.sum(axis=1).sum(axis=1)[
         range(0, scenario['total_time'] * scenario['interval_per_day'],
-              scenario['interval_per_day'])]
+              scenario['interval_per_day'])][:n_days]
 
     # TODO: explore ways to make the fitting flexible to extend to other compartments
     #fit_compt = hosp_error(Ih, data, scenario=scenario)
-    return fit_compt[comp_offset: comp_offset + len(data)] - data
+    return fit_compt
+
+
+class SimulationCache(object):
+    """Least recently used cache of the hospitalizations returned by
+    simulate_fit_compt, for the param vectors that least_squares
+    evaluates more than once. Keys are the fitted param vector, rounded
+    to `digits` significant digits, and the fingerprint of the Scenario
+    (see utils.fingerprint) and simulation function. At most `maxsize`
+    simulations are kept. Counts `hits` and `misses`.
+    """
+
+    def __init__(self, maxsize=FIT_CACHE_SIZE, digits=12):
+        assert maxsize > 0, "SimulationCache requires maxsize > 0"
+        self.maxsize = maxsize
+        self.digits = digits
+        self.hits = 0
+        self.misses = 0
+        self._cache = OrderedDict()
+        # (scenario, fingerprint) of the last Scenario, which is the
+        # same for every simulation of a fit
+        self._scenario_key = None
+
+    def __len__(self):
+        return len(self._cache)
+
+    @property
+    def hit_rate(self):
+        n = self.hits + self.misses
+        return self.hits / float(n) if n else 0.
+
+    def key(self, fit_var, fit_var_names, sim_func, scenario, n_days=None):
+        """Returns the cache key of simulate_fit_compt with these args"""
+        if self._scenario_key is None or self._scenario_key[0] is not scenario:
+            self._scenario_key = (scenario, utils.fingerprint(dict(scenario)))
+        rounded = tuple([float('{:.{}g}'.format(v, self.digits))
+                         for v in fit_var])
+        func_name = "{}.{}".format(getattr(sim_func, '__module__', None),
+                                   getattr(sim_func, '__qualname__',
+                                           repr(sim_func)))
+        return (self._scenario_key[1], func_name, tuple(fit_var_names),
+                rounded, n_days)
+
+    def get(self, key):
+        """Returns cached simulation of `key`, or None"""
+        if key in self._cache:
+            self._cache.move_to_end(key)
+            self.hits += 1
+            return self._cache[key]
+        self.misses += 1
+        return None
+
+    def put(self, key, fit_compt):
+        self._cache[key] = fit_compt
+        self._cache.move_to_end(key)
+        while len(self._cache) > self.maxsize:
+            self._cache.popitem(last=False)
+
+    def simulate(self, fit_var, fit_var_names, sim_func, scenario,
+                 n_days=None):
+        """Same as simulate_fit_compt, from the cache if possible"""
+        key = self.key(fit_var, fit_var_names, sim_func, scenario, n_days)
+        fit_compt = self.get(key)
+        if fit_compt is None:
+            fit_compt = simulate_fit_compt(fit_var, fit_var_names, sim_func,
+                                           scenario, n_days=n_days)
+            self.put(key, fit_compt)
+        return fit_compt
+
+
+class FitTrace(object):
+    """Record of every evaluation of the residuals of a fit: its index
+    `evaluation`, the optimizer `iteration` it belongs to, its `kind`
+    ('residual', or 'jacobian' for the steps of a Jacobian, or the
+    stage of other fit methods), the value of each fitted param, the
+    norm of the residuals `residual_norm`, whether it was `cached`, and
+    the wall time of its simulation `seconds` (0 if cached). Counts
+    optimizer iterations with `new_iteration`.
+    """
+
+    def __init__(self):
+        self.records = list()
+        self.n_iterations = 0
+        self._start = time.time()
+
+    def new_iteration(self):
+        self.n_iterations += 1
+
+    def record(self, fit_var, fit_var_names, residual, seconds=None,
+               kind='residual'):
+        """Records an evaluation of param vector `fit_var`, with
+        residuals `residual`, that took `seconds` to simulate, or None
+        if it was cached.
+        """
+        record = {'evaluation': len(self.records),
+                  'iteration': self.n_iterations, 'kind': kind,
+                  'cached': seconds is None,
+                  'seconds': 0. if seconds is None else seconds,
+                  'residual_norm': np.sqrt(np.sum(np.square(residual)))}
+        for name, value in zip(fit_var_names, fit_var):
+            record[name] = value
+        self.records.append(record)
+
+    def summary(self):
+        """Returns dictionary of the totals of the fit: `n_evaluations`,
+        `n_simulations`, `n_cache_hits`, `n_iterations`, the wall time of
+        the simulations `simulation_seconds`, and of the whole fit so
+        far `wall_seconds`.
+        """
+        n_cache_hits = sum([record['cached'] for record in self.records])
+        return {
+            'n_evaluations': len(self.records),
+            'n_simulations': len(self.records) - n_cache_hits,
+            'n_cache_hits': n_cache_hits,
+            'n_iterations': self.n_iterations,
+            'simulation_seconds': sum([record['seconds']
+                                       for record in self.records]),
+            'wall_seconds': time.time() - self._start,
+        }
+
+    def to_frame(self):
+        """Returns pandas DataFrame with one row per record"""
+        return pd.DataFrame(self.records)
+
+
+def _simulate_fit_compt_shared(args):
+    """Runs simulate_fit_compt in a worker process. `args` is a tuple of
+    the args of simulate_fit_compt, with a SharedObject referencing the
+    Scenario in place of the Scenario. Returns tuple of its result, and
+    the wall time of the simulation in seconds.
+    """
+    fit_var, fit_var_names, sim_func, shared_scenario, n_days = args
+    scenario = shared_scenario.resolve()
+    start = time.time()
+    fit_compt = simulate_fit_compt(fit_var, fit_var_names, sim_func,
+                                   scenario, n_days=n_days)
+    return fit_compt, time.time() - start
+
+
+def fd_steps(x0, bounds):
+    """Returns array of the steps of the forward difference of each
+    param in `x0`, given `bounds` in the format of least_squares. These
+    are the steps of scipy.optimize.least_squares with jac='2-point':
+    relative to max(1, abs(x0)), and reversed, or shortened to the
+    farthest bound, where a step would leave `bounds`.
+    """
+    x0 = np.asarray(x0, dtype=float)
+    sign_x0 = (x0 >= 0).astype(float) * 2 - 1
+    h = FD_REL_STEP * sign_x0 * np.maximum(1.0, np.abs(x0))
+    lb, ub = [np.resize(np.asarray(b, dtype=float), x0.shape)
+              for b in bounds]
+    lower_dist = x0 - lb
+    upper_dist = ub - x0
+    violated = (x0 + h < lb) | (x0 + h > ub)
+    fitting = np.abs(h) <= np.maximum(lower_dist, upper_dist)
+    h[violated & fitting] *= -1
+    forward = (upper_dist >= lower_dist) & ~fitting
+    h[forward] = upper_dist[forward]
+    backward = (upper_dist < lower_dist) & ~fitting
+    h[backward] = -lower_dist[backward]
+    return h
+
+
+class ParallelJacobian(object):
+    """Forward difference Jacobian of calc_residual, for arg `jac` of
+    scipy.optimize.least_squares. Simulations at every param vector of
+    the Jacobian are run at once in WorkerPool `pool`, so that a fit of
+    k params takes about 2 instead of k + 1 simulations of wall time
+    per iteration. The Scenario is shared with the workers once (see
+    WorkerPool.share), not pickled with every simulation. Param vectors
+    in SimulationCache `cache` are not simulated again.
+
+    Uses the same steps (see fd_steps) and differences as
+    least_squares with jac='2-point', so the fit is the same. Use
+    `residual` as arg `fun` of least_squares, which keeps the last
+    residual, since it is the unperturbed simulation of the next
+    Jacobian. If `pool` is None, simulations run one after the other.
+    Evaluations are recorded in FitTrace `trace`, if given, where each
+    Jacobian starts a new iteration.
+    """
+
+    def __init__(self, pool, bounds, fit_var_names, sim_func, scenario,
+                 data, offset, cache=None, trace=None):
+        self.pool = pool
+        self.bounds = bounds
+        self.cache = cache
+        self.trace = trace
+        self._args = (fit_var_names, sim_func, scenario, data, offset)
+        # (fit_var, residual) of the last call to `residual`
+        self._last = None
+
+    def residual(self, fit_var, *args, **kwargs):
+        """Same as calc_residual. `args` and `kwargs` are ignored, since
+        the args of calc_residual are those passed to __init__.
+        """
+        residual = calc_residuals([fit_var], *self._args, cache=self.cache,
+                                  trace=self.trace)[0]
+        self._last = (np.array(fit_var, dtype=float), residual)
+        return residual
+
+    def __call__(self, fit_var, *args, **kwargs):
+        """Returns Jacobian of calc_residual at `fit_var`. `args` and
+        `kwargs` are ignored, since the args of calc_residual are those
+        passed to __init__.
+        """
+        if self.trace is not None:
+            self.trace.new_iteration()
+        x0 = np.asarray(fit_var, dtype=float)
+        h = fd_steps(x0, self.bounds)
+        h_vecs = np.diag(h)
+        xs = [x0 + h_vecs[i] for i in range(x0.size)]
+        kinds = ['jacobian'] * x0.size
+        if self._last is not None and np.array_equal(self._last[0], x0):
+            f0 = self._last[1]
+        else:
+            f0 = None
+            xs.append(x0)
+            kinds.append('residual')
+        residuals = self._residuals(xs, kinds)
+        if f0 is None:
+            f0 = residuals.pop()
+            self._last = (x0.copy(), f0)
+        jac = np.empty((np.size(f0), x0.size))
+        for i, residual in enumerate(residuals):
+            # recompute dx as exactly representable number
+            dx = xs[i][i] - x0[i]
+            jac[:, i] = (residual - f0) / dx
+        return jac
+
+    def _residuals(self, xs, kinds):
+        """Returns list of the residual at each param vector in list
+        `xs`, simulated at once in the pool, and traced as `kinds`.
+        """
+        return calc_residuals(xs, *self._args, pool=self.pool,
+                              cache=self.cache, trace=self.trace, kind=kinds)
+
+
+def calc_residuals(fit_vars, fit_var_names, sim_func, scenario, data,
+                   comp_offset, pool=None, cache=None, trace=None,
+                   kind='residual'):
+    """Same as calc_residual, for each param vector in list `fit_vars`.
+    Those that are not in SimulationCache `cache` are simulated at once
+    in WorkerPool `pool`, or one after the other if `pool` is None (see
+    simulate_fit_compts). Each evaluation is recorded in FitTrace
+    `trace`, if given, as `kind`, or the kind of each param vector if
+    `kind` is a list. Returns list of residuals.
+    """
+    n_days = comp_offset + len(data)
+    fit_compts, seconds = simulate_fit_compts(
+        [(x, fit_var_names, scenario, n_days) for x in fit_vars], sim_func,
+        pool=pool, cache=cache, return_seconds=True)
+    residuals = [get_residual(fit_compt, data, comp_offset)
+                 for fit_compt in fit_compts]
+    if trace is not None:
+        kinds = [kind] * len(fit_vars) if isinstance(kind, str) else kind
+        for x, residual, sim_seconds, x_kind in zip(fit_vars, residuals,
+                                                    seconds, kinds):
+            trace.record(x, fit_var_names, residual, seconds=sim_seconds,
+                         kind=x_kind)
+    return residuals
+
+
+def simulate_fit_compts(tasks, sim_func, pool=None, cache=None,
+                        return_seconds=False):
+    """Returns list of the results of simulate_fit_compt for each task in
+    list `tasks` of (fit_var, fit_var_names, scenario, n_days) tuples,
+    which may be of different Scenarios. Tasks that are not in
+    SimulationCache `cache` are simulated at once in WorkerPool `pool`,
+    with each Scenario shared once, or one after the other if `pool` is
+    None. If `return_seconds`, returns tuple of the results, and list of
+    the wall time of the simulation of each task in seconds, or None if
+    it was cached.
+    """
+    fit_compts = [None] * len(tasks)
+    seconds = [None] * len(tasks)
+    keys = [None] * len(tasks)
+    if cache is not None:
+        for i, (x, fit_var_names, scenario, n_days) in enumerate(tasks):
+            keys[i] = cache.key(x, fit_var_names, sim_func, scenario, n_days)
+            fit_compts[i] = cache.get(keys[i])
+    todo = [i for i in range(len(tasks)) if fit_compts[i] is None]
+    if pool is None:
+        simulated = list()
+        for x, fit_var_names, scenario, n_days in [tasks[i] for i in todo]:
+            start = time.time()
+            fit_compt = simulate_fit_compt(x, fit_var_names, sim_func,
+                                           scenario, n_days=n_days)
+            simulated.append((fit_compt, time.time() - start))
+    else:
+        # share each Scenario once
+        shared = dict()
+        for i in todo:
+            scenario = tasks[i][2]
+            if id(scenario) not in shared:
+                shared[id(scenario)] = pool.share(scenario)
+        simulated = pool.map(_simulate_fit_compt_shared, [
+            (x, fit_var_names, sim_func, shared[id(scenario)], n_days)
+            for x, fit_var_names, scenario, n_days
+            in [tasks[i] for i in todo]])
+    for i, (fit_compt, sim_seconds) in zip(todo, simulated):
+        fit_compts[i] = fit_compt
+        seconds[i] = sim_seconds
+        if cache is not None:
+            cache.put(keys[i], fit_compt)
+    if return_seconds:
+        return fit_compts, seconds
+    return fit_compts
 
 
 def hosp_error(hosp_model, hosp_observed, scenario):
@@ -199,10 +673,22 @@ def rmsd_t(error):
     return sum([i**2 for i in error])/len(error)
 
 
+def data_scale(data):
+    """Range of `data`, or its largest magnitude if `data` is flat, or
+    1 if `data` is all zero, so that dividing by it is always finite
+    """
+    scale = np.max(data) - np.min(data)
+    if not scale > 0:
+        scale = np.max(np.abs(data))
+    if not scale > 0:
+        return 1.
+    return scale
+
+
 def nrmsd_t(rmsd, data):
     """Normalised root mean squared deviation"""
 
-    return rmsd/(max(data) - min(data))
+    return rmsd/data_scale(data)
 
 
 def filter_params(param_dict):
@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+"""
+Global fits, which do not depend on the initial guess of the fitted
+params: a differential evolution search of the whole of the fit bounds,
+whose best candidate is polished by the least squares fit of
+fit_to_data.
+"""
+
+import numpy as np
+from scipy.optimize import differential_evolution
+
+from SEIRcity import utils
+from SEIRcity.scenario_design import LatinHypercubeDesign
+from .fitting_workflow import calc_residual, calc_residuals, fit_to_data, \
+    SimulationCache, FIT_CACHE_SIZE
+
+# default settings of config key `global_fit`, which are args of
+# scipy.optimize.differential_evolution
+DEFAULT_GLOBAL_FIT = {
+    # candidates in the population, per fitted param
+    'popsize': 10,
+    # generations of the population
+    'maxiter': 30,
+    # relative tolerance of the spread of the population
+    'tol': 0.01,
+    'mutation': (0.5, 1.),
+    'recombination': 0.7,
+    'seed': 0,
+}
+
+
+def _sse(fit_var, *args):
+    """Returns the sum of squared residuals of calc_residual"""
+    return np.sum(np.square(calc_residual(fit_var, *args)))
+
+
+class PopulationEvaluator(object):
+    """Map-like callable for arg `workers` of
+    scipy.optimize.differential_evolution. Evaluates _sse for every
+    candidate of a generation at once with calc_residuals, i.e. in
+    WorkerPool `pool` if given, keeps the simulations in
+    SimulationCache `cache`, and records them in FitTrace `trace` as
+    'population', with one iteration per generation.
+    """
+
+    def __init__(self, args, pool=None, cache=None, trace=None):
+        self.args = args
+        self.pool = pool
+        self.cache = cache
+        self.trace = trace
+        self.n_generations = 0
+
+    def __call__(self, func, population):
+        self.n_generations += 1
+        if self.trace is not None:
+            self.trace.new_iteration()
+        residuals = calc_residuals(list(population), *self.args,
+                                   pool=self.pool, cache=self.cache,
+                                   trace=self.trace, kind='population')
+        return [np.sum(np.square(residual)) for residual in residuals]
+
+
+def fit_global(fit_var_names, fit_guess, fit_bounds, sim_func, scenario,
+               data, offset, pool=None, cache_size=FIT_CACHE_SIZE,
+               global_fit=None, trace=None):
+    """Same as fit_to_data, but starts the least squares fit from the
+    best candidate of a differential evolution search within
+    `fit_bounds`, instead of from `fit_guess`, which is only added to
+    the initial population. Settings in dictionary `global_fit` override
+    DEFAULT_GLOBAL_FIT, and are passed to
+    scipy.optimize.differential_evolution.
+
+    The candidates of each generation are simulated at once in
+    WorkerPool `pool`, if given, and the least squares polish uses the
+    same SimulationCache. The solution has the keys of that of
+    fit_to_data, where `n_simulations` counts both stages, and
+    `global_n_simulations` and `global_n_generations` of the search.
+    Both stages are recorded in FitTrace `trace`, if given.
+    """
+    settings = dict(DEFAULT_GLOBAL_FIT, **(global_fit or dict()))
+    utils.assert_has_keys(fit_guess, fit_var_names)
+    utils.assert_has_keys(fit_bounds, fit_var_names)
+    bounds = [tuple(fit_bounds[name]) for name in fit_var_names]
+    if not np.all(np.isfinite(bounds)):
+        raise ValueError("global fits require finite fit_bounds, not " +
+                         "{}".format(bounds))
+
+    # Latin hypercube population, with the guess in place of the first
+    # candidate
+    n_pop = settings['popsize'] * len(fit_var_names)
+    design = LatinHypercubeDesign(
+        dict([(name, {'low': float(low), 'high': float(high)})
+              for name, (low, high) in zip(fit_var_names, bounds)]),
+        n=n_pop, seed=settings['seed'])
+    init = np.array([[point[name] for name in fit_var_names]
+                     for point in design])
+    init[0] = np.clip([fit_guess[name] for name in fit_var_names],
+                      *np.array(bounds, dtype=float).T)
+
+    cache = SimulationCache(max(cache_size, n_pop)) if cache_size else None
+    args = (fit_var_names, sim_func, scenario, data, offset)
+    evaluator = PopulationEvaluator(args, pool=pool, cache=cache,
+                                    trace=trace)
+    search = differential_evolution(
+        _sse, bounds, args=args, init=init, polish=False,
+        updating='deferred', workers=evaluator,
+        maxiter=settings['maxiter'], tol=settings['tol'],
+        mutation=settings['mutation'],
+        recombination=settings['recombination'], seed=settings['seed'])
+    n_search = search.nfev if cache is None else cache.misses
+    print("Differential evolution ran {} generations, and {} ".format(
+        evaluator.n_generations, n_search) + "simulations")
+
+    best_guess = dict(zip(fit_var_names, search.x))
+    soln_dict = fit_to_data(fit_var_names, best_guess, fit_bounds, sim_func,
+                            scenario, data, offset, pool=pool, cache=cache,
+                            trace=trace)
+    soln_dict['global_n_simulations'] = n_search
+    soln_dict['global_n_generations'] = evaluator.n_generations
+    return soln_dict
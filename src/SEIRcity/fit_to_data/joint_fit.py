@@ -0,0 +1,297 @@
+# -*- coding: utf-8 -*-
+"""
+Joint fits of several cities, which share some fitted params (e.g.
+PROP_TRANS_IN_E) and fit others for each city (e.g. beta0). The
+residuals of every city are stacked into one vector for least_squares,
+and the simulations of all cities at each param vector, or of each
+Jacobian, run at once on a WorkerPool.
+"""
+
+import numpy as np
+import pandas as pd
+from scipy.optimize import least_squares
+
+from SEIRcity import param as param_module
+from SEIRcity import utils
+from .fitting_workflow import get_fit_scenario, align_data, fd_steps, \
+    get_residual, simulate_fit_compts, rmsd_t, nrmsd_t, SimulationCache, \
+    FitTrace, FIT_CACHE_SIZE, data_scale
+from .uncertainty import uncertainty_fp
+from .defaults import DEFAULT_FIT_VAR_NAMES, DEFAULT_FIT_GUESS, \
+    DEFAULT_FIT_BOUNDS
+from ..simulate import simulate_one
+from ..simulate.worker_pool import get_pool
+
+
+def joint_name(city, var_name):
+    """Returns the name of city-specific param `var_name` of `city` in a
+    joint fit, e.g. 'houston.beta0'.
+    """
+    return "{}.{}".format(city, var_name)
+
+
+def data_weight(data):
+    """Returns the weight of the residuals of a city with `data` in a
+    normalized joint fit: 1 over the range of `data`, or over its
+    largest magnitude if `data` is flat, or 1 if `data` is all zero
+    (see data_scale).
+    """
+    return 1. / data_scale(data)
+
+
+class JointProblem(object):
+    """Residuals and Jacobian of a joint fit of `cities`, a list of
+    dictionaries with keys `name`, `scenario`, `data`, `offset` (see
+    align_data), and `fit_var_names`, the params fitted for that city
+    alone. Params `shared` are fitted for all cities. The param vector
+    is the shared params, followed by those of each city in turn (see
+    `names`).
+
+    The residuals of each city are divided by the range of its data if
+    `normalize` (see data_weight), so that large cities do not dominate
+    the fit, and stacked. Simulations run in WorkerPool `pool`, if
+    given, are kept in SimulationCache `cache`, and are recorded in
+    FitTrace `trace`, with the params of their city, where each
+    Jacobian starts a new iteration.
+    """
+
+    def __init__(self, cities, shared, sim_func, pool=None, cache=None,
+                 normalize=True, trace=None):
+        self.cities = list(cities)
+        self.shared = list(shared)
+        self.sim_func = sim_func
+        self.pool = pool
+        self.cache = cache
+        self.trace = trace
+        self.names = list(self.shared)
+        # indices of the params of each city in the param vector
+        self.indices = list()
+        for city in self.cities:
+            utils.assert_has_keys(city, ('name', 'scenario', 'data',
+                                         'offset', 'fit_var_names'))
+            overlap = set(city['fit_var_names']) & set(self.shared)
+            if overlap:
+                raise ValueError("{} are both shared and fitted for city "
+                                 .format(sorted(overlap)) +
+                                 "{}".format(city['name']))
+            idx = list(range(len(self.shared)))
+            for var_name in city['fit_var_names']:
+                idx.append(len(self.names))
+                self.names.append(joint_name(city['name'], var_name))
+            self.indices.append(idx)
+        self.weights = [data_weight(city['data']) if normalize else 1.
+                        for city in self.cities]
+        self._last = None
+
+    def _city_task(self, c, x):
+        """Returns the task of simulate_fit_compts of city `c` at param
+        vector `x`.
+        """
+        city = self.cities[c]
+        return (np.asarray(x)[self.indices[c]],
+                self.shared + list(city['fit_var_names']), city['scenario'],
+                city['offset'] + len(city['data']))
+
+    def _city_residuals(self, pairs, kind='residual'):
+        """Returns list of the weighted residuals of each (city index,
+        param vector) in list `pairs`, simulated at once, and traced as
+        `kind`, or the kind of each pair if `kind` is a list.
+        """
+        fit_compts, seconds = simulate_fit_compts(
+            [self._city_task(c, x) for c, x in pairs], self.sim_func,
+            pool=self.pool, cache=self.cache, return_seconds=True)
+        residuals = [self.weights[c] * get_residual(
+                         fit_compt, self.cities[c]['data'],
+                         self.cities[c]['offset'])
+                     for (c, _), fit_compt in zip(pairs, fit_compts)]
+        if self.trace is not None:
+            kinds = [kind] * len(pairs) if isinstance(kind, str) else kind
+            for (c, x), residual, sim_seconds, pair_kind in zip(
+                    pairs, residuals, seconds, kinds):
+                idx = self.indices[c]
+                self.trace.record(np.asarray(x)[idx],
+                                  [self.names[i] for i in idx], residual,
+                                  seconds=sim_seconds, kind=pair_kind)
+        return residuals
+
+    def _base(self, x):
+        """Returns list of the weighted residuals of each city at `x`,
+        which are kept for the Jacobian at `x`.
+        """
+        x = np.array(x, dtype=float)
+        if self._last is None or not np.array_equal(self._last[0], x):
+            self._last = (x, self._city_residuals(
+                [(c, x) for c in range(len(self.cities))]))
+        return self._last[1]
+
+    def residual(self, x):
+        """Returns the stacked weighted residuals of every city at `x`"""
+        return np.concatenate(self._base(x))
+
+    def city_residuals(self, x):
+        """Returns list of the residuals of each city at `x`, without
+        weights.
+        """
+        return [residual / weight for residual, weight
+                in zip(self._base(x), self.weights)]
+
+    def jacobian(self, x, bounds):
+        """Returns the Jacobian of residual at `x`, by forward differences
+        with the steps of fd_steps within `bounds` (see fd_steps). A
+        shared param changes the residuals of every city, while a city's
+        own param only changes its own, so only those are simulated. The
+        simulations of every step, and of `x` itself if needed, run at
+        once.
+        """
+        if self.trace is not None:
+            self.trace.new_iteration()
+        x = np.array(x, dtype=float)
+        h = fd_steps(x, bounds)
+        pairs, columns = list(), list()
+        for j in range(x.size):
+            x_step = x.copy()
+            x_step[j] += h[j]
+            for c, idx in enumerate(self.indices):
+                if j in idx:
+                    pairs.append((c, x_step))
+                    columns.append(j)
+        kinds = ['jacobian'] * len(pairs)
+        if self._last is None or not np.array_equal(self._last[0], x):
+            pairs += [(c, x) for c in range(len(self.cities))]
+            kinds += ['residual'] * len(self.cities)
+            residuals = self._city_residuals(pairs, kinds)
+            self._last = (x, residuals[len(columns):])
+        else:
+            residuals = self._city_residuals(pairs, kinds)
+        base = self._last[1]
+        starts = np.cumsum([0] + [len(r) for r in base])
+        jac = np.zeros((starts[-1], x.size))
+        for (c, x_step), j, residual in zip(pairs, columns, residuals):
+            # recompute dx as exactly representable number
+            dx = x_step[j] - x[j]
+            jac[starts[c]:starts[c + 1], j] = (residual - base[c]) / dx
+        return jac
+
+
+def fit_joint(cities, shared, fit_guess, fit_bounds, sim_func, pool=None,
+              cache_size=FIT_CACHE_SIZE, normalize=True, trace=None):
+    """Joint fit of `cities` (see JointProblem) with least_squares.
+    `fit_guess` and `fit_bounds` map the name of each param (see
+    JointProblem.names) to its guess and bounds. Returns dictionary of
+    the fitted value of each param, the sum of squared (weighted)
+    residuals `final_cost`, the `final_rmsd` and `final_nrmsd_t` of
+    each city (e.g. 'houston.final_rmsd'), and `n_simulations` and
+    `cache_hit_rate`. Simulations are recorded in FitTrace `trace`, if
+    given.
+    """
+    cache = SimulationCache(cache_size) if cache_size else None
+    problem = JointProblem(cities, shared, sim_func, pool=pool, cache=cache,
+                           normalize=normalize, trace=trace)
+    utils.assert_has_keys(fit_guess, problem.names)
+    utils.assert_has_keys(fit_bounds, problem.names)
+    x0 = [fit_guess[name] for name in problem.names]
+    bounds = np.stack([fit_bounds[name] for name in problem.names], axis=1)
+    soln_full = least_squares(
+        fun=problem.residual,
+        x0=x0,
+        jac=lambda x: problem.jacobian(x, bounds),
+        bounds=bounds)
+
+    soln_dict = dict(zip(problem.names, soln_full['x']))
+    soln_dict['final_cost'] = np.sum(np.square(soln_full['fun']))
+    for city, residual in zip(cities, problem.city_residuals(soln_full['x'])):
+        rmsd = rmsd_t(residual)
+        soln_dict[joint_name(city['name'], 'final_rmsd')] = rmsd
+        soln_dict[joint_name(city['name'], 'final_nrmsd_t')] = \
+            nrmsd_t(rmsd, city['data'])
+    if cache is not None:
+        soln_dict['n_simulations'] = cache.misses
+        soln_dict['cache_hit_rate'] = cache.hit_rate
+        print("Ran {} simulations, and reused {} from cache ".format(
+            cache.misses, cache.hits) + "(hit rate {:.1%})".format(
+                cache.hit_rate))
+    return soln_dict
+
+
+def get_joint_cities(config):
+    """Returns tuple of the list of cities of the joint fit defined by
+    config key `fit_joint` (see JointProblem), the shared params, and
+    the guess and bounds of every param. `fit_joint` is a dictionary
+    with keys `cities`, mapping the name of each city to the path of
+    its fitting config YAML, and `shared`, the list of shared params.
+    Each city fits the params of its own config key `fit_var_names`
+    that are not shared, from its own `fit_guess` and `fit_bounds`.
+    Guesses and bounds of shared params are those of `config`, or else
+    of the first city.
+    """
+    spec = config.get('fit_joint', None)
+    if not spec or not spec.get('cities', None):
+        raise ValueError("config has no `fit_joint` cities to fit")
+    shared = list(spec.get('shared', list()))
+    cities, fit_guess, fit_bounds = list(), dict(), dict()
+    shared_guess = config.get('fit_guess', dict())
+    shared_bounds = config.get('fit_bounds', dict())
+    for name, yaml_fp in spec['cities'].items():
+        city_config = param_module.aggregate_params_and_data(yaml_fp=yaml_fp)
+        city_guess = city_config.get('fit_guess', DEFAULT_FIT_GUESS)
+        city_bounds = city_config.get('fit_bounds', DEFAULT_FIT_BOUNDS)
+        var_names = [var_name for var_name in
+                     city_config.get('fit_var_names', DEFAULT_FIT_VAR_NAMES)
+                     if var_name not in shared]
+        scenario = get_fit_scenario(city_config)
+        case_data = pd.read_csv(city_config['hosp_data_fp'])
+        data, offset = align_data(case_data, scenario)
+        cities.append({'name': name, 'scenario': scenario, 'data': data,
+                       'offset': offset, 'fit_var_names': var_names})
+        for var_name in var_names:
+            fit_guess[joint_name(name, var_name)] = city_guess[var_name]
+            fit_bounds[joint_name(name, var_name)] = city_bounds[var_name]
+        for var_name in shared:
+            if var_name not in shared_guess and var_name in city_guess:
+                shared_guess = dict(shared_guess, **{
+                    var_name: city_guess[var_name]})
+            if var_name not in shared_bounds and var_name in city_bounds:
+                shared_bounds = dict(shared_bounds, **{
+                    var_name: city_bounds[var_name]})
+    for var_name in shared:
+        fit_guess[var_name] = shared_guess[var_name]
+        fit_bounds[var_name] = shared_bounds[var_name]
+    return cities, shared, fit_guess, fit_bounds
+
+
+def joint_fitting_workflow(config, out_fp=None, threads=None, pool=None,
+                           sim_func=simulate_one):
+    """Joint fit of the cities of config key `fit_joint` (see
+    get_joint_cities), with the residuals of each city divided by the
+    range of its data, unless `fit_joint` has `normalize: False`.
+    Simulations of all cities run at once on WorkerPool `pool`, or the
+    process-wide WorkerPool with `threads` workers if `threads` > 1.
+    Returns the solution of fit_joint, which is written to a one-row
+    CSV file `out_fp` if specified. If config key `fit_trace` is true,
+    the solution has the summary of the FitTrace of the fit, and the
+    trace is written next to `out_fp` (see uncertainty.uncertainty_fp).
+    """
+    cities, shared, fit_guess, fit_bounds = get_joint_cities(config)
+    if pool is None and threads is not None and threads > 1:
+        pool = get_pool(threads)
+    print("Fitting {} cities jointly, with shared params {}".format(
+        len(cities), shared))
+    trace = FitTrace() if config.get('fit_trace', False) else None
+    solution = fit_joint(
+        cities, shared, fit_guess, fit_bounds, sim_func, pool=pool,
+        cache_size=config.get('fit_cache_size', FIT_CACHE_SIZE),
+        normalize=config['fit_joint'].get('normalize', True), trace=trace)
+    if trace is not None:
+        for key, value in trace.summary().items():
+            solution.setdefault(key, value)
+
+    for var_name in solution.keys():
+        print("{}: {}".format(var_name, solution[var_name]))
+    if out_fp is not None:
+        print("Writing fitted values to: {}".format(out_fp))
+        pd.DataFrame([solution]).to_csv(out_fp, index=False)
+        if trace is not None:
+            trace_fp = uncertainty_fp(out_fp, 'trace')
+            print("Writing trace to: {}".format(trace_fp))
+            trace.to_frame().to_csv(trace_fp, index=False)
+    return solution
@@ -0,0 +1,264 @@
+# -*- coding: utf-8 -*-
+"""
+Uncertainty of the fitted params of a fit: bootstrap refits to
+resampled data, and profile likelihoods of each fitted param. Every
+refit starts from the point estimate, and refits run in parallel on a
+WorkerPool.
+"""
+
+import os
+import numpy as np
+import pandas as pd
+from scipy import stats
+
+from SEIRcity.scenario import BaseScenario
+from .fitting_workflow import fit_to_data, calc_residual, get_fit_scenario, \
+    align_data
+from .defaults import DEFAULT_FIT_VAR_NAMES, DEFAULT_FIT_BOUNDS
+from ..simulate import simulate_one
+
+# default settings of config key `fit_uncertainty`
+DEFAULT_UNCERTAINTY = {
+    # bootstrap refits, and how data is resampled: 'residual', to add
+    # resampled residuals of the fit to the fitted hospitalizations, or
+    # 'parametric', to add normal noise of the same variance
+    'n_bootstrap': 100,
+    'bootstrap': 'residual',
+    # values of each fitted param in its profile, and the half width of
+    # the profile of each param (10% of its bounds by default)
+    'n_profile': 11,
+    'profile_width': None,
+    # confidence level of the intervals
+    'level': 0.95,
+    'seed': 0,
+}
+
+
+def bootstrap_datasets(residual, data, n_bootstrap, method='residual',
+                       seed=None):
+    """Returns array of shape (n_bootstrap, len(data)) of datasets
+    resampled from the fit with residuals `residual` (see calc_residual)
+    of `data`: the fitted hospitalizations, plus the residuals of the
+    fit resampled with replacement ('residual' `method`), or normal
+    noise with the variance of the residuals ('parametric').
+    """
+    residual = np.asarray(residual, dtype=float)
+    fitted = np.asarray(data, dtype=float) + residual
+    rng = np.random.default_rng(seed)
+    shape = (n_bootstrap, len(residual))
+    if method == 'residual':
+        noise = -residual[rng.integers(len(residual), size=shape)]
+    elif method == 'parametric':
+        noise = rng.normal(scale=np.sqrt(np.mean(residual ** 2)), size=shape)
+    else:
+        raise ValueError("bootstrap must be 'residual' or 'parametric', " +
+                         "not {}".format(method))
+    return fitted + noise
+
+
+def _refit(args):
+    """Fits the params `fit_var_names` of `scenario` to `data`, from
+    `fit_guess`, with params `fixed` (a dictionary) set in the Scenario.
+    Returns the solution dictionary of fit_to_data, with the fixed
+    params and the sum of squared residuals `sse`. `scenario` may be a
+    SharedObject.
+    """
+    (fit_var_names, fit_guess, fit_bounds, sim_func, scenario, data,
+     offset, fixed) = args
+    if hasattr(scenario, 'resolve'):
+        scenario = scenario.resolve()
+    if fixed:
+        scenario = BaseScenario(scenario, inject=False)
+        scenario.update(fixed)
+    if fit_var_names:
+        solution = fit_to_data(fit_var_names, fit_guess, fit_bounds,
+                               sim_func, scenario, data, offset)
+    else:
+        # nothing left to fit
+        solution = {'final_error': calc_residual(
+            [], [], sim_func, scenario, data, offset)}
+    solution.update(fixed)
+    solution['sse'] = np.sum(np.square(solution['final_error']))
+    return solution
+
+
+def _run_refits(tasks, scenario, pool=None):
+    """Returns list of the solutions of _refit for each task in list
+    `tasks` of its args without `scenario`, in parallel on WorkerPool
+    `pool` if given.
+    """
+    if pool is None:
+        return [_refit(task[:4] + (scenario,) + task[4:]) for task in tasks]
+    shared = pool.share(scenario)
+    return pool.map(_refit, [task[:4] + (shared,) + task[4:]
+                             for task in tasks], chunksize=1)
+
+
+def bootstrap(solution, fit_var_names, fit_bounds, sim_func, scenario, data,
+              offset, pool=None, n_bootstrap=100, method='residual',
+              seed=None):
+    """Refits `n_bootstrap` datasets resampled from `solution` of the fit
+    to `data` (see bootstrap_datasets), starting from `solution`.
+    Returns pandas DataFrame with one row per refit: its index
+    `replicate`, fitted values, and `final_rmsd`.
+    """
+    datasets = bootstrap_datasets(solution['final_error'], data, n_bootstrap,
+                                  method=method, seed=seed)
+    guess = dict([(name, solution[name]) for name in fit_var_names])
+    tasks = [(fit_var_names, guess, fit_bounds, sim_func, dataset, offset,
+              dict()) for dataset in datasets]
+    refits = _run_refits(tasks, scenario, pool=pool)
+    return pd.DataFrame([
+        dict([('replicate', i)] + [(name, refit[name])
+                                   for name in fit_var_names] +
+             [('final_rmsd', refit['final_rmsd'])])
+        for i, refit in enumerate(refits)])
+
+
+def profile_values(estimate, bounds, n_points, width=None):
+    """Returns array of `n_points` evenly spaced values from `estimate`
+    - `width` to `estimate` + `width` (10% of the width of `bounds` by
+    default), clipped to `bounds`, including `estimate`.
+    """
+    low, high = bounds
+    if width is None:
+        width = 0.1 * (high - low)
+    values = np.linspace(estimate - width, estimate + width, n_points)
+    return np.unique(np.clip(np.append(values, estimate), low, high))
+
+
+def profile(solution, fit_var_names, fit_bounds, sim_func, scenario, data,
+            offset, pool=None, n_points=11, width=None):
+    """Profile likelihood of each fitted param around `solution` of the
+    fit to `data`: the other params are refitted with the param fixed at
+    each of the values of profile_values, starting from `solution`.
+    `width` is a dictionary of the half width of the profile of each
+    param. Returns pandas DataFrame with one row per refit: the profiled
+    param `var` and its `value`, the fitted values of the other params,
+    the sum of squared residuals `sse`, and the likelihood ratio
+    statistic `lr_stat` relative to `solution`, for normal errors of
+    unknown variance.
+    """
+    width = width or dict()
+    tasks, rows = list(), list()
+    for name in fit_var_names:
+        others = [other for other in fit_var_names if other != name]
+        guess = dict([(other, solution[other]) for other in others])
+        for value in profile_values(solution[name], fit_bounds[name],
+                                    n_points, width.get(name, None)):
+            tasks.append((others, guess, fit_bounds, sim_func, data, offset,
+                          {name: value}))
+            rows.append({'var': name, 'value': value})
+    refits = _run_refits(tasks, scenario, pool=pool)
+    sse_min = np.sum(np.square(solution['final_error']))
+    for row, refit in zip(rows, refits):
+        row.update([(name, refit[name]) for name in fit_var_names])
+        row['sse'] = refit['sse']
+    table = pd.DataFrame(rows)
+    # refits may find a better fit than the solution
+    sse_min = min(sse_min, table['sse'].min())
+    table['lr_stat'] = len(data) * np.log(table['sse'] / sse_min)
+    return table
+
+
+def profile_interval(values, lr_stat, level=0.95):
+    """Returns tuple of the lowest and highest value of a profile within
+    which the likelihood ratio statistic `lr_stat` is below the
+    chi-squared quantile of `level`, interpolated linearly between
+    values. The end of the interval is NaN if the profile does not reach
+    the quantile on that side.
+    """
+    values = np.asarray(values, dtype=float)
+    lr_stat = np.asarray(lr_stat, dtype=float)
+    threshold = stats.chi2.ppf(level, df=1)
+    best = int(np.argmin(lr_stat))
+    ends = list()
+    for step in (-1, 1):
+        end = np.nan
+        i = best
+        while 0 <= i + step < len(values):
+            if lr_stat[i + step] > threshold:
+                frac = (threshold - lr_stat[i]) / \
+                    (lr_stat[i + step] - lr_stat[i])
+                end = values[i] + frac * (values[i + step] - values[i])
+                break
+            i += step
+        ends.append(end)
+    return tuple(ends)
+
+
+def summarize(solution, fit_var_names, boot_table=None, profile_table=None,
+              level=0.95):
+    """Returns pandas DataFrame with one row per fitted param `var`: its
+    `estimate`, and the bounds of its `level` confidence intervals from
+    the percentiles of `boot_table` (`boot_low`, `boot_high`, and
+    standard error `boot_se`), and from `profile_table` (`profile_low`
+    and `profile_high`).
+    """
+    alpha = (1. - level) / 2.
+    rows = list()
+    for name in fit_var_names:
+        row = {'var': name, 'estimate': solution[name]}
+        if boot_table is not None:
+            row['boot_low'], row['boot_high'] = np.quantile(
+                boot_table[name], [alpha, 1. - alpha])
+            row['boot_se'] = boot_table[name].std(ddof=1)
+        if profile_table is not None:
+            var_profile = profile_table[profile_table['var'] == name]
+            row['profile_low'], row['profile_high'] = profile_interval(
+                var_profile['value'], var_profile['lr_stat'], level=level)
+        rows.append(row)
+    return pd.DataFrame(rows)
+
+
+def uncertainty_fp(out_fp, suffix):
+    """Returns path of the CSV of table `suffix` next to the fit CSV
+    `out_fp`, e.g. fit_houston_bootstrap.csv for fit_houston.csv.
+    """
+    stem, ext = os.path.splitext(out_fp)
+    return "{}_{}{}".format(stem, suffix, ext or '.csv')
+
+
+def uncertainty_workflow(config, case_data, solution, out_fp=None,
+                         pool=None, sim_func=simulate_one):
+    """Bootstrap and profile likelihood of `solution`, the fit of the
+    Scenario of `config` to the hospitalizations in pandas DataFrame
+    `case_data`, with the settings of config key `fit_uncertainty`
+    (see DEFAULT_UNCERTAINTY). Set `n_bootstrap` or `n_profile` to 0 to
+    skip either. Refits run in parallel on WorkerPool `pool`, if given.
+    Returns a dictionary of pandas DataFrames 'bootstrap' (see
+    bootstrap), 'profile' (see profile), and 'summary' (see summarize),
+    each written to a CSV next to `out_fp` (see uncertainty_fp), if
+    specified.
+    """
+    settings = dict(DEFAULT_UNCERTAINTY,
+                    **(config.get('fit_uncertainty', None) or dict()))
+    fit_var_names = config.get("fit_var_names", DEFAULT_FIT_VAR_NAMES)
+    fit_bounds = config.get("fit_bounds", DEFAULT_FIT_BOUNDS)
+    scenario = get_fit_scenario(config)
+    data, offset = align_data(case_data, scenario)
+    args = (solution, fit_var_names, fit_bounds, sim_func, scenario, data,
+            offset)
+
+    tables = dict()
+    if settings['n_bootstrap']:
+        print("Running {} bootstrap refits".format(settings['n_bootstrap']))
+        tables['bootstrap'] = bootstrap(
+            *args, pool=pool, n_bootstrap=settings['n_bootstrap'],
+            method=settings['bootstrap'], seed=settings['seed'])
+    if settings['n_profile']:
+        print("Profiling {} fitted params".format(len(fit_var_names)))
+        tables['profile'] = profile(
+            *args, pool=pool, n_points=settings['n_profile'],
+            width=settings['profile_width'])
+    tables['summary'] = summarize(
+        solution, fit_var_names, boot_table=tables.get('bootstrap', None),
+        profile_table=tables.get('profile', None), level=settings['level'])
+    print(tables['summary'])
+
+    if out_fp is not None:
+        for suffix, table in tables.items():
+            table_fp = uncertainty_fp(out_fp, suffix)
+            print("Writing {} to: {}".format(suffix, table_fp))
+            table.to_csv(table_fp, index=False)
+    return tables
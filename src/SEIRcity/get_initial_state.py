@@ -1,8 +1,9 @@
 import numpy as np
-import pickle
 import os
 from datetime import datetime, timedelta
 import pandas as pd
+from .outcome_handler import select, get_label_table
+from .outcome_io import open_outcomes
 # todo: this fxn is duplicated in io_support -- reorganize so it gets a single def that is easily imported where needed
 
 class InitialModelState:
@@ -41,22 +42,25 @@ class InitialModelState:
         # todo: implement checks to make sure the deterministic solution read in is actually the one you want
         # todo: for example, is it the right city? the right params?
         # todo: this might require packaging the config with the outputs so a few things can be checked easily after loading this file
-        with open(self.initial_i, 'rb') as xp:
-            data = pickle.load(xp)
+        # Zarr stores are opened lazily, so only the chunks of the
+        # selected point are read
+        data = open_outcomes(self.initial_i)
 
         if len(data.c_reduction.values) > 1:
             raise ValueError('Instantaneous states are currently only supported for deterministic runs with fixed contact reduction levels.')
 
         dataset = data.to_dataset('compartment')
 
+        # select by position, which works for both label-indexed and
+        # integer-coded param dims (see outcome_handler.OutcomeStore)
+        labels = get_label_table(data)
+        point = {dim: labels[dim][0] for dim in
+                 ('beta0', 'c_reduction', 'reopen_trigger', 'close_trigger')}
+        point['g_rate'] = 'high'
+
         # todo: this syntax can replace compartment_stack() where resolution == 'point'
-        hosp_slice = dataset['Iy'].sel({
-            'beta0': dataset['beta0'].values.item(),
-            'c_reduction': dataset['c_reduction'].values.item(),
-            'g_rate': 'high',
-            'reopen_trigger': dataset['reopen_trigger'].values.item(),
-            'close_trigger': dataset['close_trigger'].values.item()
-        }).sum(dim=['age_group', 'risk_group']).to_dataframe().reset_index()
+        hosp_slice = select(dataset['Iy'], **point).sum(
+            dim=['age_group', 'risk_group']).to_dataframe().reset_index()
 
         # assume the first date's HH:MM:SS is always 00:00:00
         hosp_slice_daily = hosp_slice.iloc[::self.interval_per_day, :]
@@ -74,15 +78,9 @@ class InitialModelState:
         # instead, drop day fraction to begin at zero hours of day 
         self.start_day = datetime(start_slice.year, start_slice.month, start_slice.day)
 
-        compartment_slices = {i: dataset[i].sel({
-            'beta0': dataset['beta0'].values.item(),
-            'c_reduction': dataset['c_reduction'].values.item(),
-            'g_rate': 'high',
-            'reopen_trigger': dataset['reopen_trigger'].values.item(),
-            'close_trigger': dataset['close_trigger'].values.item(),
-            'time': start_slice,
-            'replicate': 0  # possibly irrelevant for deterministic runs
-        }).values for i in data.compartment.values}
+        point_dataset = select(dataset, replicate=0, **point)  # replicate possibly irrelevant for deterministic runs
+        compartment_slices = {i: point_dataset[i].sel({'time': start_slice}).values
+                              for i in data.compartment.values}
 
         return compartment_slices
 
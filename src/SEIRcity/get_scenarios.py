@@ -5,7 +5,8 @@ import numpy as np
 import pickle
 import datetime as dt
 
-from .scenario import BaseScenario as Scenario
+from .scenario import BaseScenario as Scenario, get_template_keys
+from .scenario_design import get_design
 from .simulate import simulate_one
 from . import param_parser, utils
 from . import param as param_module
@@ -14,13 +15,10 @@ from . import param as param_module
 from . import dev_utils
 
 
-def get_scenarios(config, verbosity=0):
-    # list of Scenario instances
-    # converted to tuple when returned
-    scenarios = list()
-
-    # params that are same for all Scenarios
-    # only here because the model function needs them
+def get_consistent_params(config):
+    """Returns dictionary of the params in `config` that are the same
+    for every Scenario, but that the model function needs.
+    """
     consistent_params_keys = (
         'city',
         'NUM_SIM',
@@ -63,31 +61,51 @@ def get_scenarios(config, verbosity=0):
         'n_age', 'n_risk', 'deterministic',
     ])
     utils.assert_has_keys(config, get_param_arg_names)
-    get_param_kwargs = {
-        k: config[k] for k in config.keys()
-        if k in get_param_arg_names
-    }
+    return consistent_params
+
 
-    # ------------------------------------------------------------------
+def make_scenario(point, config, consistent_params, template_keys=None):
+    """Returns Scenario for `point` of a Design (see scenario_design),
+    i.e. dictionary of swept params. Swept params override
+    `consistent_params` from get_consistent_params, and `beta0` is
+    looked up in config key `beta0_dict` by growth rate, unless it is
+    swept. If `template_keys` of `consistent_params` are given (see
+    scenario.get_template_keys), only those and the swept params are
+    injected, instead of searching every param for templates.
+    """
+    unique_params = dict(point)
+    if 'beta0' not in unique_params:
+        unique_params['beta0'] = config['beta0_dict'][point['g_rate']]
+    swept_keys = tuple(unique_params)
+    # add all the params that are consistent between Scenarios, but
+    # need to be passed as args to the model function
+    for k, v in consistent_params.items():
+        unique_params.setdefault(k, v)
+    if template_keys is None:
+        return Scenario(unique_params)
+    keys = [k for k in template_keys if k not in swept_keys]
+    keys.extend(get_template_keys({k: unique_params[k] for k in swept_keys}))
+    return Scenario(unique_params, inject=False).inject(keys=keys)
 
-    # generate one Scenario for each unique combination of
-    # growth rate, contact reduction, close trigger, and reopen trigger
-    for g_rate in config['GROWTH_RATE_LIST']:
-        beta0 = config['beta0_dict'][g_rate]
-        for c_reduction in config['CONTACT_REDUCTION']:
-            for close_trigger in config['CLOSE_TRIGGER_LIST']:
-                for reopen_trigger in config['REOPEN_TRIGGER_LIST']:
-                    unique_params = {
-                        'close_trigger': close_trigger,
-                        'reopen_trigger': reopen_trigger,
-                        'g_rate': g_rate,
-                        'c_reduction': c_reduction,
-                        'beta0': beta0,
-                    }
-                    # add all the params that are consistent between
-                    # Scenarios, but need to be passed as args to the
-                    # model function
-                    unique_params.update(consistent_params)
-                    # add this unique Scenario to the list
-                    scenarios.append(Scenario(unique_params))
-    return tuple(scenarios)
+
+def iter_scenarios(config, design=None):
+    """Yields one Scenario for each point of Design `design`, or of the
+    design of `config` (see scenario_design.get_design), one at a time.
+    """
+    if design is None:
+        design = get_design(config)
+    consistent_params = get_consistent_params(config)
+    # the same for every Scenario, so found once
+    template_keys = get_template_keys(consistent_params)
+    for point in design:
+        yield make_scenario(point, config, consistent_params,
+                            template_keys=template_keys)
+
+
+def get_scenarios(config, verbosity=0):
+    """Returns tuple of one Scenario for each unique combination of
+    growth rate, contact reduction, close trigger, and reopen trigger,
+    or for each point of config key `scenario_design` if it has one.
+    Use iter_scenarios for large designs.
+    """
+    return tuple(iter_scenarios(config))
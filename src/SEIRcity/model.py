@@ -27,7 +27,7 @@ def SEIR_model_publish_w_risk(metro_pop, school_calendar, beta0,
                               shift_week, time_begin, time_begin_sim,
                               initial_state, c_reduction_date, c_reduction, trigger_type, close_trigger,
                               reopen_trigger, monitor_lag, report_rate, t_offset,
-                              deterministic=True, print_vals=False):
+                              deterministic=True, print_vals=False, n_steps=None):
     """
     :param metro_pop: np.array of shape (n_age, n_risk)
     :param school_calendar: np.array of shape(), school calendar from data
@@ -58,9 +58,21 @@ def SEIR_model_publish_w_risk(metro_pop, school_calendar, beta0,
     :param monitor_lag: int, time lag between surveillance and real time in (Days)
     :param report_rate: float, proportion Y can seen
     :param deterministic: boolean, whether to remove poisson stochasticity
+    :param n_steps: int, number of time steps to simulate, if fewer than \
+    total_time * interval_per_day. Compartments are returned up to this step
     :return: compt_s, compt_e, compt_ia, compt_ih, compt_ih, compt_r, compt_d, compt_e2compt_iy
     """
 
+    # a shorter simulation, e.g. of the days fitted to data, only
+    # allocates the steps it simulates, starting from the first step of
+    # initial_state
+    truncated = n_steps is not None and n_steps < total_time * interval_per_day
+    if truncated:
+        initial_state = dict([(name, _first_steps(compt, n_steps))
+                              for name, compt in initial_state.items()])
+    else:
+        n_steps = total_time * interval_per_day
+
     compt_s = initial_state['S']
     compt_e = initial_state['E']
     compt_ia = initial_state['Ia']
@@ -161,8 +173,9 @@ def SEIR_model_publish_w_risk(metro_pop, school_calendar, beta0,
 
     ## -- Start simulation
 
-    # Iterate over intervals
-    for t in range(1, total_time * interval_per_day):
+    # Iterate over intervals. The first steps of a shorter simulation
+    # are the same as those of a full one
+    for t in range(1, n_steps):
         days_from_t0 = np.floor((t + 0.1) / interval_per_day)
         if t_offset:
             t_date = date_begin + t_offset + dt.timedelta(days=days_from_t0)
@@ -395,6 +408,16 @@ def SEIR_model_publish_w_risk(metro_pop, school_calendar, beta0,
             compt_h2compt_d, school_close_arr, school_reopen_arr)
 
 
+def _first_steps(compt, n_steps):
+    """Returns array of `n_steps` time steps of compartment `compt`,
+    with the first step of `compt` and zeros after it
+    """
+    compt = np.asarray(compt)
+    steps = np.zeros((n_steps,) + compt.shape[1:], dtype=compt.dtype)
+    steps[0] = compt[0]
+    return steps
+
+
 def compute_R0(compt_e2compt_i, interval_per_day, para, growth_rate):
     """
     :param: np.array containing new symptomatic cases in each time step
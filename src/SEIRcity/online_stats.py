@@ -0,0 +1,258 @@
+#!/usr/bin/env python
+"""Streaming, mergeable summary statistics of replicate outcomes. Each
+accumulator summarizes a sequence of numpy arrays of the same shape
+element-wise, in memory that does not grow (or grows logarithmically)
+with the number of arrays added, and two accumulators of the same shape
+can be merged, e.g. to combine the replicates of a sweep that was split
+across jobs.
+"""
+import numpy as np
+import pandas as pd
+
+# quantiles of the percentile bands in analysis/io_support.summary_stats
+DEFAULT_QUANTILES = (0.025, 0.05, 0.25, 0.5, 0.75, 0.95, 0.975)
+# number of items kept at each level of QuantileSketch. Quantiles are
+# exact for up to this many replicates. A sketch of more replicates
+# than this keeps fewer arrays than there are replicates
+DEFAULT_SKETCH_SIZE = 32
+
+
+class RunningStats(object):
+    """Element-wise count, mean, variance, min and max of the arrays
+    passed to `add`, using Welford's algorithm. `merge` combines two
+    RunningStats using the parallel form of the same update (Chan et
+    al.), so the result does not depend on how replicates were split.
+    """
+
+    def __init__(self, shape):
+        self.shape = tuple(shape)
+        self.count = 0
+        self.mean = np.zeros(self.shape, dtype=float)
+        self._m2 = np.zeros(self.shape, dtype=float)
+        self.min = np.full(self.shape, np.inf)
+        self.max = np.full(self.shape, -np.inf)
+
+    def add(self, arr):
+        self.count += 1
+        delta = arr - self.mean
+        self.mean += delta / self.count
+        self._m2 += delta * (arr - self.mean)
+        np.minimum(self.min, arr, out=self.min)
+        np.maximum(self.max, arr, out=self.max)
+
+    def merge(self, other):
+        """Adds the arrays summarized by RunningStats `other`"""
+        if other.count == 0:
+            return
+        count = self.count + other.count
+        delta = other.mean - self.mean
+        self.mean += delta * (float(other.count) / count)
+        self._m2 += other._m2 + delta ** 2 * \
+            (float(self.count) * other.count / count)
+        self.count = count
+        np.minimum(self.min, other.min, out=self.min)
+        np.maximum(self.max, other.max, out=self.max)
+
+    @property
+    def var(self):
+        """Sample variance (ddof=1), NaN for fewer than 2 arrays"""
+        if self.count < 2:
+            return np.full(self.shape, np.nan)
+        return self._m2 / (self.count - 1)
+
+    @property
+    def std(self):
+        return np.sqrt(self.var)
+
+
+class QuantileSketch(object):
+    """Element-wise approximate quantiles of the arrays passed to `add`,
+    using a KLL-style compactor. Items are kept at levels of up to
+    `size` items each, where an item at level h stands for 2**h arrays.
+    When a level overflows, it is sorted element-wise and every other item
+    is promoted to the next level, so memory is O(size * log(n / size))
+    arrays for n arrays added. The rank error of each quantile is about
+    1 / size. Since every element is compacted at the same time, the
+    weight of each item is the same for every element.
+
+    Quantiles are exact (same as numpy.quantile) until more than `size`
+    arrays have been added.
+    """
+
+    def __init__(self, shape, size=DEFAULT_SKETCH_SIZE):
+        assert size >= 2 and size % 2 == 0, \
+            "sketch size must be an even integer >= 2, not {}".format(size)
+        self.shape = tuple(shape)
+        self.size = size
+        self.count = 0
+        # items at each level, as lists of arrays
+        self._levels = [list()]
+        # alternates which half of the sorted items is promoted, so that
+        # compaction does not bias quantiles up or down
+        self._offsets = [0]
+
+    def add(self, arr):
+        self.count += 1
+        self._levels[0].append(np.array(arr, dtype=float))
+        self._compact()
+
+    def merge(self, other):
+        """Adds the arrays summarized by QuantileSketch `other`"""
+        assert other.shape == self.shape, \
+            "cannot merge sketches of shape {} and {}".format(
+                self.shape, other.shape)
+        for level, items in enumerate(other._levels):
+            self._grow(level)
+            self._levels[level].extend(items)
+        self.count += other.count
+        self._compact()
+
+    def _grow(self, level):
+        while len(self._levels) <= level:
+            self._levels.append(list())
+            self._offsets.append(0)
+
+    def _compact(self):
+        level = 0
+        while level < len(self._levels):
+            if len(self._levels[level]) > self.size:
+                items = np.sort(np.stack(self._levels[level]), axis=0)
+                n_keep = len(items) - len(items) % 2
+                offset = self._offsets[level]
+                self._offsets[level] = 1 - offset
+                self._grow(level + 1)
+                self._levels[level + 1].extend(
+                    list(items[offset:n_keep:2]))
+                # an odd item out stays at this level
+                self._levels[level] = list(items[n_keep:])
+            level += 1
+
+    @property
+    def is_exact(self):
+        return len(self._levels) == 1
+
+    def quantile(self, q):
+        """Returns array of quantiles `q` (list of floats in [0, 1])
+        along a new first axis.
+        """
+        q = np.asarray(q, dtype=float)
+        if self.count == 0:
+            return np.full((len(q),) + self.shape, np.nan)
+        if self.is_exact:
+            return np.quantile(np.stack(self._levels[0]), q, axis=0)
+        items = np.stack([item for items in self._levels for item in items])
+        weights = np.concatenate([
+            np.full(len(items), 2. ** level)
+            for level, items in enumerate(self._levels)])
+        order = np.argsort(items, axis=0)
+        items = np.take_along_axis(items, order, axis=0)
+        cum = np.cumsum(weights[order], axis=0)
+        cum /= cum[-1]
+        result = np.empty((len(q),) + self.shape)
+        for i, quantile in enumerate(q):
+            # first item whose cumulative weight reaches the quantile
+            pos = np.argmax(cum >= quantile - 1e-12, axis=0)
+            result[i] = np.take_along_axis(items, pos[np.newaxis], axis=0)[0]
+        return result
+
+
+class ReplicateSummary(object):
+    """RunningStats and QuantileSketch of the replicates at one point
+    in parameter space.
+    """
+
+    def __init__(self, shape, sketch_size=DEFAULT_SKETCH_SIZE):
+        self.stats = RunningStats(shape)
+        self.sketch = QuantileSketch(shape, size=sketch_size)
+
+    @property
+    def count(self):
+        return self.stats.count
+
+    def add(self, arr):
+        self.stats.add(arr)
+        self.sketch.add(arr)
+
+    def merge(self, other):
+        self.stats.merge(other.stats)
+        self.sketch.merge(other.sketch)
+
+    def summarize(self, quantiles=DEFAULT_QUANTILES):
+        """Returns array of the mean, std, min, max, and each of
+        `quantiles`, along a new first axis (see get_statistic_labels).
+        """
+        return np.concatenate([
+            np.stack([self.stats.mean, self.stats.std, self.stats.min,
+                      self.stats.max]),
+            self.sketch.quantile(quantiles)])
+
+
+def get_statistic_labels(quantiles=DEFAULT_QUANTILES):
+    """Returns labels of the statistics returned by
+    ReplicateSummary.summarize, e.g. 'q0.5' for the median.
+    """
+    return ['mean', 'std', 'min', 'max'] + \
+        ["q{:g}".format(q) for q in quantiles]
+
+
+def fixed_freq(freq):
+    """Returns pandas frequency string `freq` as a pandas.Timedelta,
+    with weeks of 7 days, to resample timedeltas. Raises ValueError for
+    periods of varying length, such as months.
+    """
+    from pandas.tseries.frequencies import to_offset
+    from pandas.tseries.offsets import Week
+    offset = to_offset(freq)
+    if isinstance(offset, Week):
+        return pd.Timedelta(days=7 * offset.n)
+    try:
+        return pd.Timedelta(offset)
+    except ValueError:
+        raise ValueError("times since the start of the simulation can " +
+                         "only be aggregated to periods of fixed " +
+                         "length (e.g. '1D' or '1W'), not {}".format(freq))
+
+
+class TimeAggregator(object):
+    """Aggregates the `axis` of an array with datetime64 coords `times`
+    to periods of pandas frequency string `freq` (e.g. '1D' or '1W'),
+    reduced by `how` (one of HOWS). Periods are computed once, so
+    aggregating each array is a single numpy reduction.
+
+    `times` may also be timedelta64, as when the start date is swept
+    (see multiple_pool.get_tasks). Periods then start at the first of
+    `times`, and `freq` must have a fixed length (see fixed_freq).
+    """
+    HOWS = ('first', 'last', 'mean', 'sum', 'min', 'max')
+
+    def __init__(self, times, freq, how='first', axis=0):
+        if how not in self.HOWS:
+            raise ValueError("time aggregation must be one of {}, not {}"
+                             .format(self.HOWS, how))
+        self.how = how
+        self.axis = axis
+        if np.issubdtype(np.asarray(times).dtype, np.timedelta64):
+            index = pd.TimedeltaIndex(times)
+            freq = fixed_freq(freq)
+        else:
+            index = pd.DatetimeIndex(times)
+        groups = pd.Series(np.arange(len(times)), index=index).resample(freq)
+        starts = groups.first().dropna()
+        self.times = starts.index
+        self._starts = starts.values.astype(int)
+        self._ends = groups.last().dropna().values.astype(int) + 1
+
+    def __call__(self, arr):
+        if self.how == 'first':
+            return np.take(arr, self._starts, axis=self.axis)
+        if self.how == 'last':
+            return np.take(arr, self._ends - 1, axis=self.axis)
+        if self.how in ('sum', 'mean'):
+            reduced = np.add.reduceat(arr, self._starts, axis=self.axis)
+            if self.how == 'mean':
+                shape = [1] * arr.ndim
+                shape[self.axis] = len(self._starts)
+                reduced = reduced / (self._ends - self._starts).reshape(shape)
+            return reduced
+        ufunc = np.minimum if self.how == 'min' else np.maximum
+        return ufunc.reduceat(arr, self._starts, axis=self.axis)
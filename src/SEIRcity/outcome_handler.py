@@ -4,6 +4,7 @@ import os
 from attrdict import AttrDict
 import numpy as np
 import datetime
+import json
 import pickle
 import yaml
 from time import time
@@ -13,6 +14,116 @@ import pandas as pd
 import xarray as xr
 from .dev_utils import base_decorator
 
+# suffix of the coordinate that holds the labels of an integer-coded
+# param dim, e.g. 'g_rate_label' for param dim 'g_rate'
+LABEL_SUFFIX = '_label'
+
+
+def sorted_unique(values):
+    """Returns sorted list of the unique elements of `values`. Values
+    that cannot be compared, such as a mix of str and float, are sorted
+    by their repr.
+    """
+    unique = list(set(values))
+    try:
+        return sorted(unique)
+    except TypeError:
+        return sorted(unique, key=repr)
+
+
+def get_label_table(outcomes):
+    """Returns a dictionary mapping each dim of xarray.DataArray (or
+    Dataset) `outcomes` to the list of its labels, in positional order.
+    For integer-coded param dims (see OutcomeStore), these are the
+    labels in coord `<dim>_label`; for every other dim, they are the
+    coords of the dim.
+    """
+    table = dict()
+    for dim in outcomes.dims:
+        if dim + LABEL_SUFFIX in outcomes.coords:
+            table[dim] = list(outcomes.coords[dim + LABEL_SUFFIX].values)
+        else:
+            table[dim] = list(outcomes.get_index(dim))
+    return table
+
+
+def select(outcomes, **labels):
+    """Positional selection from xarray.DataArray (or Dataset)
+    `outcomes` by label, e.g. `select(da, g_rate='high', c_reduction=0.5)`.
+    Works on integer-coded param dims (see OutcomeStore) as well as
+    label-indexed ones. Each label may be a single label, which drops
+    the dim like .sel does, or a list of labels. Params of a
+    SparseOutcomeStore select the matching scenarios, and keep the
+    'scenario' dim.
+    """
+    indexers = dict()
+    for dim, label in labels.items():
+        if dim not in outcomes.dims:
+            if dim in outcomes.coords and len(outcomes.coords[dim].dims) == 1:
+                # param coord along the 'scenario' dim of a
+                # SparseOutcomeStore: select every matching scenario
+                values = outcomes.coords[dim].values
+                if isinstance(label, (list, tuple, np.ndarray)):
+                    mask = np.isin(values, label)
+                else:
+                    mask = values == label
+                if not mask.any():
+                    raise KeyError("No label {} in coord {}".format(label, dim))
+                outcomes = outcomes.isel(
+                    {outcomes.coords[dim].dims[0]: np.nonzero(mask)[0]})
+                continue
+            raise ValueError("{} is not a dim of outcomes, which has dims "
+                             .format(dim) + "{}".format(outcomes.dims))
+        if dim + LABEL_SUFFIX in outcomes.coords:
+            index = pd.Index(outcomes.coords[dim + LABEL_SUFFIX].values)
+        else:
+            index = outcomes.get_index(dim)
+        try:
+            if isinstance(label, (list, tuple, np.ndarray)):
+                indexers[dim] = [index.get_loc(l) for l in label]
+            else:
+                indexers[dim] = index.get_loc(label)
+        except KeyError as key_err:
+            raise KeyError("No label {} in dim {}".format(label, dim)) \
+                from key_err
+    return outcomes.isel(indexers)
+
+
+def decode_params(outcomes):
+    """Returns xarray.DataArray (or Dataset) `outcomes` with the labels
+    of each integer-coded param dim as its coords, so that it can be
+    indexed with .sel as in OutcomeHandler.
+    """
+    for label_coord in list(outcomes.coords):
+        dim = label_coord[:-len(LABEL_SUFFIX)]
+        if not label_coord.endswith(LABEL_SUFFIX) or dim not in outcomes.coords:
+            continue
+        # dims dropped by selection have scalar coords
+        labels = outcomes.coords[label_coord].values
+        if dim in outcomes.dims:
+            outcomes = outcomes.assign_coords({dim: labels})
+        else:
+            outcomes = outcomes.assign_coords({dim: labels.item()})
+        outcomes = outcomes.drop_vars(label_coord)
+    return outcomes
+
+
+def new_scalar_array(shape, dtype):
+    """Returns array of `shape` for per-task scalars of `dtype`, filled
+    with NaT for dates and times, -1 for integers, False for booleans,
+    and NaN (as float) otherwise.
+    """
+    dtype = np.dtype(dtype)
+    if dtype.kind in 'mM':
+        fill = np.array('NaT', dtype=dtype)
+    elif dtype.kind in 'iu':
+        fill = -1
+    elif dtype.kind == 'b':
+        fill = False
+    else:
+        dtype, fill = np.dtype(float), np.nan
+    return np.full(shape, fill, dtype=dtype)
+
 
 class OutcomeHandler(object):
     """Base class for OutcomeHandler. The OutcomeHandler's purpose is
@@ -42,6 +153,11 @@ class OutcomeHandler(object):
         self._outcomes_flat_lst = list()
         self.scenarios = list()
         self.verbosity = verbosity
+        # manifest of tasks that failed to run (see multiple_pool)
+        self.failures = list()
+        # config of the sweep, stored with the outcomes (see
+        # get_metadata). Defaults to the `config` of the first scenario
+        self.config = None
 
     def log(self, *args, level=1, **kwargs):
         if self.verbosity >= level:
@@ -155,10 +271,11 @@ class OutcomeHandler(object):
         return da
 
     def _get_param_coords(self, dim):
-        """Given a dimension `dim`, return the list of unique Scenario[dim]
-        values for each Scenario.
+        """Given a dimension `dim`, return the sorted list of unique
+        Scenario[dim] values for each Scenario. Sorting makes the layout
+        of the outcomes the same between runs.
         """
-        return list(set([s[dim] for s in self.scenarios]))
+        return sorted_unique([s[dim] for s in self.scenarios])
 
     def _get_unique_scenarios(self):
         """Returns list of unique Scenarios. Unique is defined as
@@ -281,9 +398,61 @@ class OutcomeHandler(object):
         with open(out_fp, 'wb') as f:
             pickle.dump(da, f)
 
+    def failures_to_json(self, out_fp):
+        """Writes the manifest of failed tasks as JSON to output
+        filepath `out_fp`.
+        """
+        print("Writing manifest of {} failed tasks to: {}".format(
+            len(self.failures), out_fp))
+        with open(out_fp, 'w') as f:
+            json.dump(self.failures, f, indent=2, default=utils.to_builtin)
+
+    def to_zarr(self, out_fp):
+        """Writes compiled xarray.DataArray as a chunked, compressed
+        Zarr store at output filepath `out_fp` (see outcome_io).
+        """
+        from .outcome_io import write_zarr
+        print("Writing outcomes as Zarr store to: {}".format(out_fp))
+        write_zarr(self.outcomes, out_fp, attrs=self.get_metadata())
+
+    def to_file(self, out_fp):
+        """Writes compiled outcomes to `out_fp`, as a Zarr store if
+        `out_fp` ends with '.zarr', or as a pickle otherwise.
+        """
+        from .outcome_io import is_zarr
+        if is_zarr(out_fp):
+            self.to_zarr(out_fp)
+        else:
+            self.to_pickle(out_fp)
+
+    def get_metadata(self):
+        """Returns dictionary of JSON serializable metadata, which is
+        stored with the outcomes in formats that support it.
+        """
+        from .version import version
+        metadata = {'param_dims': list(self.param_dims),
+                    'SEIRcity_version': version}
+        config = self.config
+        if config is None and self.scenarios:
+            config = self.scenarios[0].get('config', None)
+        if config is not None:
+            metadata['config'] = json.dumps({
+                k: v for k, v in config.items()
+                if isinstance(v, (str, int, float, bool, type(None)))},
+                sort_keys=True)
+        return metadata
+
+    def to_parquet(self, out_fp, **kwargs):
+        """Writes compiled xarray.DataArray in long format to Parquet
+        file `out_fp`, one scenario at a time. See
+        outcome_table.write_parquet for `kwargs`.
+        """
+        from .outcome_table import write_parquet
+        return write_parquet(self.outcomes, out_fp, **kwargs)
+
     def to_dataframe(self, out_fp):
         """Writes compiled xarray.DataArray as a pandas DataFrame to
-        output filepath `out_fp`.
+        output filepath `out_fp`. Slow for large sweeps; see to_parquet.
         """
         da = self.outcomes
         df = da.to_dataframe(name='value').reset_index()
@@ -384,3 +553,498 @@ class OutcomeHandler(object):
         #     # 'ReopenDate_dict': ReopenDate_dict,
         #     # 'R0_baseline': R0_baseline
         # }
+
+
+class OutcomeStore(OutcomeHandler):
+    """OutcomeHandler that allocates the N-D outcomes array once, and
+    writes each outcome into it in place as it is added. Given the list
+    of `scenarios` in the sweep, the coordinates of each param dim, and
+    the mapping from each coordinate to its integer position, are
+    computed once at construction. The array itself is allocated when
+    the first outcome is added, since that is when the shape of an
+    outcome is known. Dims and coords of the outcome are validated once,
+    at the first call to add_outcome; subsequent outcomes only need to
+    have the same shape.
+
+    Unlike OutcomeHandler, no flat copy of the outcomes is kept, so
+    peak memory is a single copy of the compiled outcomes, and
+    `outcomes` is available at any time (slots that have not been added
+    are NaN).
+
+    If `encode_params` (default), the coords of each param dim are the
+    integer codes 0..n-1, i.e. positions in the sorted list of unique
+    values, and the values themselves are in coord `<dim>_label`. Use
+    `select` to index these by label, or `decode_params` to convert
+    them to the label-indexed layout of OutcomeHandler. Note that codes
+    are positions, so compare outcomes from different sweeps by label.
+    """
+
+    def __init__(self, scenarios, param_dims=None, verbosity=2,
+                 encode_params=True):
+        super(OutcomeStore, self).__init__(param_dims=param_dims,
+                                           verbosity=verbosity)
+        self.encode_params = encode_params
+        assert scenarios, "OutcomeStore requires at least one Scenario"
+        # validate once, instead of per outcome as in OutcomeHandler
+        self.scenarios = list(scenarios)
+        self._n_sim = super(OutcomeStore, self).n_sim
+        self._param_coords = dict()
+        self._param_index = dict()
+        for dim in self.param_dims:
+            self._param_coords[dim] = self._get_param_coords(dim)
+            self._param_index[dim] = dict([
+                (value, i) for i, value in enumerate(self._param_coords[dim])])
+        self._data = None
+        self._filled = self._new_filled()
+        # number of replicates added at each point in parameter space
+        self._replicate_ct = np.zeros(self._get_point_shape(), dtype=int)
+        self._outcome_dims = None
+        self._outcome_shape = None
+        self._outcome_coords = None
+        # per-task scalars, with the shape of _filled (see add_outcome)
+        self._scalars = dict()
+
+    def _new_filled(self):
+        """Returns boolean array of whether each replicate at each point
+        has an outcome, initially False
+        """
+        return np.zeros(self._get_point_shape() + (self._n_sim,),
+                        dtype=bool)
+
+    @property
+    def n_sim(self):
+        return self._n_sim
+
+    @property
+    def outcomes_flat(self):
+        raise NotImplementedError("OutcomeStore does not keep a flat " +
+                                  "copy of the outcomes")
+
+    @property
+    def outcomes(self):
+        if self._data is None:
+            raise ValueError("OutcomeStore has no outcomes")
+        # a new DataArray on each read, so that coords include the
+        # scalars added since the last read. The data are not copied
+        return xr.DataArray(
+            self._data, dims=self._get_dims(), coords=self._get_coords())
+
+    @property
+    def n_filled(self):
+        """Number of outcomes added to the store"""
+        return int(self._filled.sum())
+
+    def _get_param_shape(self):
+        return tuple([len(self._param_coords[dim])
+                      for dim in self.param_dims])
+
+    def _get_point_shape(self):
+        """Shape of the array of points in parameter space"""
+        return self._get_param_shape()
+
+    def _get_dims(self):
+        return tuple(self.param_dims) + ('replicate',) + \
+            tuple(self._outcome_dims)
+
+    def _get_coords(self):
+        if self.encode_params:
+            coords = dict()
+            for dim in self.param_dims:
+                labels = self._param_coords[dim]
+                coords[dim] = np.arange(len(labels))
+                coords[dim + LABEL_SUFFIX] = (dim, labels)
+        else:
+            coords = dict(self._param_coords)
+        coords['replicate'] = list(range(self._n_sim))
+        coords.update(self._outcome_coords)
+        return self._add_scalar_coords(coords)
+
+    def _add_scalar_coords(self, coords):
+        """Adds per-task scalars to dictionary `coords`, as coords along
+        the dims of each point and replicate.
+        """
+        dims = self._get_dims()
+        dims = dims[:dims.index('replicate') + 1]
+        for name, arr in self._scalars.items():
+            coords[name] = (dims, arr)
+        return coords
+
+    def _write_scalars(self, point, scalars):
+        for name, value in scalars.items():
+            if name not in self._scalars:
+                self._scalars[name] = new_scalar_array(
+                    self._filled.shape, np.asarray(value).dtype)
+            self._scalars[name][point] = value
+
+    def get_index(self, scenario):
+        """Returns the tuple of integer positions of Scenario `scenario`
+        along each param dim.
+        """
+        try:
+            return tuple([self._param_index[dim][scenario[dim]]
+                          for dim in self.param_dims])
+        except KeyError as key_err:
+            raise ValueError("Scenario is not in the parameter space " +
+                             "of this OutcomeStore: {}".format(
+                                 {dim: scenario.get(dim, None)
+                                  for dim in self.param_dims})) from key_err
+
+    def add_outcome(self, scenario, outcome, dims, coords=None,
+                    replicate=None, scalars=None):
+        """Writes numpy array `outcome` in place, at the point in
+        parameter space of `scenario`. If `replicate` is None, the next
+        replicate at that point is used. `scalars` is an optional
+        dictionary of per-task scalars, e.g. the date of an event, which
+        are stored as coords along the param dims and 'replicate'. Slots
+        without a scalar are NaN (NaT for dates, -1 for integers).
+        """
+        assert isinstance(outcome, np.ndarray)
+        if isinstance(dims, str):
+            dims = list([dims])
+        if self._outcome_dims is None:
+            self._allocate(outcome, dims, coords)
+        elif tuple(dims) != self._outcome_dims:
+            raise ValueError("dims {} do not match dims {} of the first "
+                             .format(dims, self._outcome_dims) + "outcome")
+        if outcome.shape != self._outcome_shape:
+            raise ValueError("Shape {} of outcome does not match ".format(
+                outcome.shape) + "shape {} of the first outcome".format(
+                self._outcome_shape))
+
+        index = self.get_index(scenario)
+        if replicate is None:
+            replicate = self._replicate_ct[index]
+        if replicate >= self._n_sim:
+            raise ValueError("replicate {} is out of range for ".format(
+                replicate) + "NUM_SIM == {}".format(self._n_sim))
+        point = index + (replicate,)
+        self._check_empty(point)
+        if scalars:
+            self._write_scalars(point, scalars)
+        self._write(point, outcome)
+        self._set_filled(point)
+        self._replicate_ct[index] += 1
+
+    def _set_filled(self, point):
+        self._filled[point] = True
+
+    def _check_empty(self, point):
+        """Raises ValueError if integer index `point` has an outcome"""
+        if self._filled[point]:
+            raise ValueError("OutcomeStore.add_outcome: matrix point " +
+                             "{} is already populated. ".format(point) +
+                             "Continuing with this operation would " +
+                             "overwrite existing data.")
+
+    def _write(self, point, outcome):
+        """Writes `outcome` at integer index `point` of the N-D array"""
+        self._data[point] = outcome
+
+    def _allocate(self, outcome, dims, coords=None):
+        """Allocates the N-D array, given the first `outcome` and its
+        `dims` and `coords`.
+        """
+        self._set_outcome_schema(outcome, dims, coords)
+        self._data = np.full(self._filled.shape + outcome.shape, np.nan,
+                             dtype=float)
+
+    def _set_outcome_schema(self, outcome, dims, coords=None):
+        """Validates and sets the dims and coords of each outcome, given
+        the first `outcome` and its `dims` and `coords`.
+        """
+        if len(dims) != len(outcome.shape):
+            raise ValueError("len(dims) == {} but ".format(len(dims)) +
+                             "len(outcome.shape) == {}. ".format(len(outcome.shape)) +
+                             "Must be same length. Shape of passed outcome " +
+                             "is : {}".format(outcome.shape))
+        if coords is None:
+            coords = dict()
+        self._outcome_dims = tuple(dims)
+        self._outcome_shape = outcome.shape
+        self._outcome_coords = dict()
+        for dim, size in zip(dims, outcome.shape):
+            if dim in coords:
+                if len(coords[dim]) != size:
+                    raise ValueError("{} coords for dim {} but ".format(
+                        len(coords[dim]), dim) + "outcome has size {}"
+                        .format(size))
+                self._outcome_coords[dim] = coords[dim]
+            else:
+                # integer index for dims without coords, as in _flat_to_da
+                self._outcome_coords[dim] = pd.RangeIndex(size)
+
+    def _compile(self):
+        """Outcomes are compiled as they are added, so this only returns
+        the N-D xarray.DataArray.
+        """
+        return self.outcomes
+
+
+class SparseOutcomeStore(OutcomeStore):
+    """OutcomeStore that allocates only the points in parameter space
+    that are in `scenarios`, instead of the dense Cartesian product of
+    the unique values of every param dim. This is much smaller for
+    sweeps that sample combinations of params, e.g. where beta0 is
+    fitted for each g_rate, or for Latin hypercube designs.
+
+    Outcomes have dims ('scenario', 'replicate', ...), where 'scenario'
+    is an integer index of the unique points, in sorted order. The value
+    of each param dim at each point is stored in a coordinate along
+    'scenario', so `select(outcomes, g_rate='high')` selects every
+    scenario with g_rate 'high'. Use `to_dense` to get the same layout
+    as OutcomeStore.
+    """
+
+    def _get_points(self):
+        """Returns sorted list of unique points in parameter space, as
+        tuples of the values of each param dim.
+        """
+        return sorted_unique([tuple([s[dim] for dim in self.param_dims])
+                              for s in self.scenarios])
+
+    def _get_point_shape(self):
+        if not hasattr(self, '_points'):
+            self._points = self._get_points()
+            self._point_index = dict([
+                (point, i) for i, point in enumerate(self._points)])
+        return (len(self._points),)
+
+    def get_index(self, scenario):
+        """Returns the tuple of the integer scenario index of Scenario
+        `scenario`.
+        """
+        point = tuple([scenario.get(dim, None) for dim in self.param_dims])
+        if point not in self._point_index:
+            raise ValueError("Scenario is not in the parameter space " +
+                             "of this SparseOutcomeStore: {}".format(
+                                 dict(zip(self.param_dims, point))))
+        return (self._point_index[point],)
+
+    def _get_dims(self):
+        return ('scenario', 'replicate') + tuple(self._outcome_dims)
+
+    def _get_coords(self):
+        coords = dict()
+        coords['scenario'] = np.arange(len(self._points))
+        for i, dim in enumerate(self.param_dims):
+            coords[dim] = ('scenario', [point[i] for point in self._points])
+        coords['replicate'] = list(range(self._n_sim))
+        coords.update(self._outcome_coords)
+        return self._add_scalar_coords(coords)
+
+    @property
+    def is_full(self):
+        """True if the points in `scenarios` span the full Cartesian
+        product of the unique values of every param dim.
+        """
+        return len(self._points) == int(np.prod(self._get_param_shape()))
+
+    def to_dense(self, allow_missing=False):
+        """Returns the outcomes in the dense layout of OutcomeStore,
+        with integer-coded param dims. Raises ValueError if the grid is
+        not full (see `is_full`), unless `allow_missing`, in which case
+        the missing points are NaN.
+        """
+        if not self.is_full and not allow_missing:
+            raise ValueError(
+                "{} scenarios do not fill the dense grid of {} points. "
+                .format(len(self._points), int(np.prod(
+                    self._get_param_shape()))) +
+                "Pass allow_missing=True to fill the missing points with NaN")
+        if self._data is None:
+            raise ValueError("SparseOutcomeStore has no outcomes")
+        # integer codes of each point along each param dim
+        codes = tuple([
+            np.array([self._param_index[dim][point[i]]
+                      for point in self._points], dtype=int)
+            for i, dim in enumerate(self.param_dims)])
+        if self.is_full:
+            dense = np.empty(self._get_param_shape() +
+                             self._data.shape[1:], dtype=self._data.dtype)
+        else:
+            dense = np.full(self._get_param_shape() + self._data.shape[1:],
+                            np.nan, dtype=self._data.dtype)
+        dense[codes] = self._data[...]
+        coords = OutcomeStore._get_coords(self)
+        for name, arr in self._scalars.items():
+            dense_arr = new_scalar_array(dense.shape[:len(codes) + 1],
+                                         arr.dtype)
+            dense_arr[codes] = arr
+            coords[name] = (OutcomeStore._get_dims(self)[:len(codes) + 1],
+                            dense_arr)
+        return xr.DataArray(dense, dims=OutcomeStore._get_dims(self),
+                            coords=coords)
+
+
+class SummaryStoreMixin(object):
+    """Mixin for OutcomeStore classes that keeps streaming summary
+    statistics of the replicates at each point in parameter space,
+    instead of every replicate. Each outcome is reduced to the
+    `compartments` of interest (all if None), and optionally aggregated
+    to periods of pandas frequency `time_freq` (e.g. '1D' or '1W') by
+    `time_how` (see online_stats.TimeAggregator), then added to the
+    online_stats.ReplicateSummary of its point. Memory is proportional
+    to the number of points, and to the number of replicates only up
+    to `sketch_size`: nothing is kept per replicate, and per-task
+    scalars are dropped.
+
+    Outcomes have dims (<param dims>, 'statistic', ...), where
+    'statistic' has labels 'mean', 'std', 'min', 'max', and a label
+    'q<quantile>' for each of `quantiles`, e.g. 'q0.5' for the median.
+    Quantiles are exact for up to `sketch_size` replicates, and
+    approximate (rank error of a few percent for the default size of
+    32, smaller for larger sizes) for more. Coord
+    'n_replicates' holds the number of replicates summarized at each
+    point.
+    """
+
+    def __init__(self, scenarios, compartments=None, time_freq=None,
+                 time_how='first', quantiles=None, sketch_size=None,
+                 **kwargs):
+        from . import online_stats
+        super(SummaryStoreMixin, self).__init__(scenarios, **kwargs)
+        self.compartments = compartments
+        self.time_freq = time_freq
+        self.time_how = time_how
+        if quantiles is None:
+            quantiles = online_stats.DEFAULT_QUANTILES
+        self.quantiles = tuple(quantiles)
+        if sketch_size is None:
+            sketch_size = online_stats.DEFAULT_SKETCH_SIZE
+        self.sketch_size = sketch_size
+        self._summaries = dict()
+        self._reduce = None
+        self._summary_coords = None
+        self._summary_shape = None
+
+    def _allocate(self, outcome, dims, coords=None):
+        """Sets up the reduction of each outcome to the compartments
+        and periods that are summarized. Summaries are allocated as the
+        first outcome at each point is added.
+        """
+        from .online_stats import TimeAggregator
+        self._set_outcome_schema(outcome, dims, coords)
+        self._summary_coords = dict(self._outcome_coords)
+        steps = list()
+        if self.compartments is not None:
+            if 'compartment' not in self._outcome_dims:
+                raise ValueError("outcomes have no 'compartment' dim to " +
+                                 "select compartments from")
+            axis = self._outcome_dims.index('compartment')
+            index = pd.Index(self._outcome_coords['compartment'])
+            positions = [index.get_loc(c) for c in self.compartments]
+            self._summary_coords['compartment'] = list(self.compartments)
+            steps.append(lambda arr: np.take(arr, positions, axis=axis))
+        if self.time_freq is not None:
+            if 'time' not in self._outcome_dims:
+                raise ValueError("outcomes have no 'time' dim to aggregate")
+            aggregate = TimeAggregator(
+                self._outcome_coords['time'], freq=self.time_freq,
+                how=self.time_how, axis=self._outcome_dims.index('time'))
+            self._summary_coords['time'] = aggregate.times
+            steps.append(aggregate)
+
+        def reduce(arr):
+            for step in steps:
+                arr = step(arr)
+            return arr
+        self._reduce = reduce
+        self._summary_shape = reduce(outcome).shape
+
+    def _new_filled(self):
+        # replicates are not kept, so neither is whether each is filled
+        return None
+
+    def _set_filled(self, point):
+        pass
+
+    def _check_empty(self, point):
+        """Raises ValueError if the point of `point` already has
+        NUM_SIM replicates
+        """
+        if self._replicate_ct[point[:-1]] >= self._n_sim:
+            raise ValueError("OutcomeStore.add_outcome: point {} already "
+                             .format(point[:-1]) + "has {} replicates"
+                             .format(self._n_sim))
+
+    def _write_scalars(self, point, scalars):
+        # per-task scalars are dropped along with the replicates
+        pass
+
+    @property
+    def n_filled(self):
+        """Number of outcomes added to the store"""
+        return int(self._replicate_ct.sum())
+
+    def _write(self, point, outcome):
+        from .online_stats import ReplicateSummary
+        index = point[:-1]
+        if index not in self._summaries:
+            self._summaries[index] = ReplicateSummary(
+                self._summary_shape, sketch_size=self.sketch_size)
+        self._summaries[index].add(self._reduce(outcome))
+
+    def merge(self, other):
+        """Adds the replicates summarized by `other`, a summary store
+        of the same compartments and periods, e.g. of the same
+        scenarios run with another seed. Points of `other` that are not
+        in this store raise ValueError.
+        """
+        from .online_stats import ReplicateSummary
+        if other._summary_shape != self._summary_shape:
+            raise ValueError("Cannot merge summaries of shape {} and {}"
+                             .format(other._summary_shape,
+                                     self._summary_shape))
+        # position of each point of `other` in this store
+        index_map = dict()
+        for scenario in other.scenarios:
+            index_map[other.get_index(scenario)] = self.get_index(scenario)
+        for other_index, summary in other._summaries.items():
+            index = index_map[other_index]
+            if index not in self._summaries:
+                self._summaries[index] = ReplicateSummary(
+                    self._summary_shape, sketch_size=self.sketch_size)
+            self._summaries[index].merge(summary)
+            self._replicate_ct[index] += summary.count
+
+    @property
+    def outcomes(self):
+        from .online_stats import get_statistic_labels
+        if self._summary_shape is None:
+            raise ValueError("OutcomeStore has no outcomes")
+        labels = get_statistic_labels(self.quantiles)
+        point_shape = self._get_point_shape()
+        data = np.full(point_shape + (len(labels),) + self._summary_shape,
+                       np.nan)
+        counts = np.zeros(point_shape, dtype=int)
+        for index, summary in self._summaries.items():
+            data[index] = summary.summarize(self.quantiles)
+            counts[index] = summary.count
+        # per-task scalars are dropped along with the replicates
+        coords = dict([(name, coord) for name, coord
+                       in self._get_coords().items()
+                       if not (isinstance(coord, tuple) and
+                               'replicate' in coord[0])])
+        del coords['replicate']
+        coords['statistic'] = labels
+        coords.update(self._summary_coords)
+        dims = self._get_dims()
+        dims = dims[:dims.index('replicate')]
+        coords['n_replicates'] = (dims, counts)
+        return xr.DataArray(
+            data, dims=dims + ('statistic',) + tuple(self._outcome_dims),
+            coords=coords)
+
+
+class SummaryOutcomeStore(SummaryStoreMixin, OutcomeStore):
+    """OutcomeStore that keeps summary statistics of the replicates at
+    each point, instead of every replicate
+    """
+    pass
+
+
+class SparseSummaryOutcomeStore(SummaryStoreMixin, SparseOutcomeStore):
+    """SparseOutcomeStore that keeps summary statistics of the
+    replicates at each scenario, instead of every replicate
+    """
+    pass
@@ -0,0 +1,290 @@
+#!/usr/bin/env python
+"""Chunked, compressed on-disk format for outcomes, using Zarr. Outcomes
+are written as a single array, chunked so that each chunk holds one
+compartment of one replicate at one point in parameter space, i.e. the
+time series of every age and risk group. Param coords (integer codes and
+labels), outcome coords, and the config of the sweep are stored as
+metadata in the same store, in the layout that xarray reads with
+`xarray.open_zarr`.
+
+Outcomes of a large sweep need not fit in memory: ZarrOutcomeStore and
+SparseZarrOutcomeStore write each outcome to disk from a background
+thread as it is added, and `open_outcomes` reads the chunks of a
+selection only when its values are accessed.
+
+Requires the optional dependency zarr.
+"""
+import queue
+import pickle
+import threading
+
+import numpy as np
+import xarray as xr
+
+from .outcome_handler import OutcomeStore, SparseOutcomeStore
+
+try:
+    import zarr
+    from numcodecs import Blosc
+except ImportError:
+    zarr = None
+
+# name of the outcomes array in the Zarr store
+OUTCOMES_VAR = 'outcomes'
+# extension of output filepaths that are written as Zarr stores
+ZARR_EXT = '.zarr'
+# maximum number of outcomes waiting to be written by the background
+# writer, before add_outcome blocks
+MAX_PENDING = 64
+
+
+def _require_zarr():
+    if zarr is None:
+        raise ImportError("Writing outcomes in Zarr format requires the " +
+                          "zarr package: pip install zarr")
+
+
+def get_compressor():
+    """Returns the compressor for the outcomes array. Byte shuffle
+    suits the smooth float64 time series of each compartment.
+    """
+    return Blosc(cname='zstd', clevel=3, shuffle=Blosc.SHUFFLE)
+
+
+def is_zarr(fp):
+    """True if filepath `fp` is written or read as a Zarr store"""
+    return str(fp).rstrip('/').endswith(ZARR_EXT)
+
+
+def get_chunks(dims, shape):
+    """Returns the chunk shape of an outcomes array with `dims` and
+    `shape`: one element along 'replicate' (or 'statistic', for summary
+    stores), every dim before it, and the dim after it (the
+    compartment), and the full extent of the rest.
+    """
+    dims = list(dims)
+    axis = dims.index('replicate' if 'replicate' in dims else 'statistic')
+    n_point = axis + 2
+    return (1,) * n_point + tuple(shape[n_point:])
+
+
+def _to_zarr(ds, out_fp, encoding=None):
+    """Writes Dataset `ds` to a new Zarr store at `out_fp`. Datetime
+    (and timedelta) coords are stored as datetime64[ns], instead of the
+    CF encoding of xarray, which rounds the sub-second times of
+    simulate_one.
+    """
+    times = [name for name, coord in ds.coords.items()
+             if coord.dtype.kind in 'mM']
+    ds.drop_vars(times).to_zarr(out_fp, mode='w', encoding=encoding)
+    group = zarr.open_group(out_fp, mode='r+')
+    for name in times:
+        arr = group.array(name, ds[name].values, fill_value=None)
+        arr.attrs['_ARRAY_DIMENSIONS'] = list(ds[name].dims)
+    return group
+
+
+def write_zarr(outcomes, out_fp, attrs=None):
+    """Writes xarray.DataArray `outcomes` to Zarr store `out_fp`, which
+    is overwritten if it exists. `attrs` are stored as metadata of the
+    outcomes array.
+    """
+    _require_zarr()
+    ds = outcomes.to_dataset(name=OUTCOMES_VAR)
+    ds[OUTCOMES_VAR].attrs.update(attrs or dict())
+    encoding = {OUTCOMES_VAR: {
+        'chunks': get_chunks(outcomes.dims, outcomes.shape),
+        'compressor': get_compressor()}}
+    _to_zarr(ds, out_fp, encoding=encoding)
+
+
+def create_zarr_outcomes(out_fp, dims, shape, coords, attrs=None):
+    """Creates a Zarr store at `out_fp` with dictionary of `coords`,
+    and an outcomes array with `dims` and `shape` that is NaN until
+    written to. Returns the zarr group and the outcomes array.
+    """
+    _require_zarr()
+    # coords are written by xarray, in the layout that xarray.open_zarr
+    # expects
+    ds = xr.Dataset(coords=coords)
+    group = _to_zarr(ds, out_fp)
+    arr = group.create_dataset(
+        OUTCOMES_VAR, shape=shape, chunks=get_chunks(dims, shape),
+        dtype=float, fill_value=np.nan, compressor=get_compressor())
+    attrs = dict(attrs or dict())
+    attrs['_ARRAY_DIMENSIONS'] = list(dims)
+    # non-index coords, e.g. '<dim>_label' or the params of each
+    # scenario in SparseZarrOutcomeStore
+    attrs['coordinates'] = " ".join(
+        [name for name in ds.coords if name not in ds.dims])
+    arr.attrs.update(attrs)
+    return group, arr
+
+
+def write_zarr_coords(group, coords):
+    """Writes (or overwrites) coords in the Zarr store of `group`, from
+    dictionary of `coords` mapping each name to a tuple of (dims,
+    numpy.ndarray), e.g. per-task scalars added after the store was
+    created.
+    """
+    arr = group[OUTCOMES_VAR]
+    coord_names = arr.attrs['coordinates'].split()
+    for name, (dims, values) in coords.items():
+        # no fill value, which xarray would decode as missing, e.g.
+        # step 0 of an event
+        zarr_arr = group.array(name, values, overwrite=True,
+                               fill_value=None)
+        zarr_arr.attrs['_ARRAY_DIMENSIONS'] = list(dims)
+        if name not in coord_names:
+            coord_names.append(name)
+    arr.attrs['coordinates'] = " ".join(coord_names)
+
+
+def open_outcomes(fp):
+    """Opens the outcomes at filepath `fp`. Zarr stores are opened
+    lazily: no outcomes are read until the values of a selection are
+    accessed, and then only the chunks that the selection spans.
+    Otherwise, `fp` is read as a pickled xarray.DataArray.
+    """
+    if is_zarr(fp):
+        _require_zarr()
+        outcomes = xr.open_zarr(fp, chunks=None)[OUTCOMES_VAR]
+        # same as the unnamed DataArray of OutcomeHandler.outcomes
+        outcomes.name = None
+        return outcomes
+    with open(fp, 'rb') as f:
+        return pickle.load(f)
+
+
+class _BackgroundWriter(object):
+    """Writes items to a Zarr array from a background thread, so that
+    compression and disk I/O overlap with simulation. An error in the
+    thread is raised at the next call to `write` or `flush`.
+    """
+
+    def __init__(self, array, max_pending=MAX_PENDING):
+        self.array = array
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._error = None
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                self._queue.task_done()
+                break
+            if self._error is None:
+                point, value = item
+                try:
+                    self.array[point] = value
+                except Exception as err:
+                    self._error = err
+            self._queue.task_done()
+
+    def _raise(self):
+        if self._error is not None:
+            raise RuntimeError("Writing outcomes to Zarr store failed") \
+                from self._error
+
+    def write(self, point, value):
+        """Queues `value` to be written at integer index `point`"""
+        self._raise()
+        self._queue.put((point, value))
+
+    def flush(self):
+        """Blocks until every queued item has been written"""
+        self._queue.join()
+        self._raise()
+
+    def close(self):
+        self.flush()
+        self._queue.put(None)
+        self._thread.join()
+
+
+class ZarrStoreMixin(object):
+    """Mixin for OutcomeStore classes that writes outcomes to a Zarr
+    store at `out_fp` instead of an array in memory. The store is
+    created when the first outcome is added, and each outcome is written
+    by a background writer. Call `close` when done adding outcomes; the
+    store is valid, and can be opened with `open_outcomes`, afterwards.
+    """
+
+    def __init__(self, scenarios, out_fp, **kwargs):
+        _require_zarr()
+        super(ZarrStoreMixin, self).__init__(scenarios, **kwargs)
+        self.out_fp = out_fp
+        self._writer = None
+        self._group = None
+
+    def _allocate(self, outcome, dims, coords=None):
+        """Creates the Zarr store, with every coord and the metadata of
+        the outcomes, but no outcomes.
+        """
+        self._set_outcome_schema(outcome, dims, coords)
+        self._group, self._data = create_zarr_outcomes(
+            self.out_fp, self._get_dims(), self._filled.shape + outcome.shape,
+            self._get_coords(), attrs=self.get_metadata())
+        self._writer = _BackgroundWriter(self._data)
+        self.log("Writing outcomes to Zarr store: {}".format(self.out_fp))
+
+    def _write(self, point, outcome):
+        self._writer.write(point, outcome)
+
+    def flush(self):
+        """Blocks until every outcome added so far is on disk"""
+        if self._writer is not None:
+            self._writer.flush()
+        self._write_scalar_coords()
+
+    def _write_scalar_coords(self):
+        """Writes per-task scalars (see OutcomeStore.add_outcome), which
+        are held in memory as outcomes are added.
+        """
+        if not self._scalars or self._group is None:
+            return
+        dims = self._get_dims()[:self._filled.ndim]
+        write_zarr_coords(self._group, dict([
+            (name, (dims, arr)) for name, arr in self._scalars.items()]))
+
+    def close(self):
+        """Writes every pending outcome, and stops the background
+        writer. No more outcomes can be added afterwards.
+        """
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+        self._write_scalar_coords()
+
+    @property
+    def outcomes(self):
+        """Lazily loaded xarray.DataArray of the outcomes on disk"""
+        if self._data is None:
+            raise ValueError("OutcomeStore has no outcomes")
+        self.flush()
+        return open_outcomes(self.out_fp)
+
+    def to_file(self, out_fp):
+        if out_fp == self.out_fp:
+            self.close()
+        else:
+            super(ZarrStoreMixin, self).to_file(out_fp)
+
+    def to_dense(self, allow_missing=False):
+        self.flush()
+        return super(ZarrStoreMixin, self).to_dense(
+            allow_missing=allow_missing)
+
+
+class ZarrOutcomeStore(ZarrStoreMixin, OutcomeStore):
+    """OutcomeStore that writes outcomes to a Zarr store at `out_fp`"""
+    pass
+
+
+class SparseZarrOutcomeStore(ZarrStoreMixin, SparseOutcomeStore):
+    """SparseOutcomeStore that writes outcomes to a Zarr store at
+    `out_fp`
+    """
+    pass
@@ -0,0 +1,322 @@
+#!/usr/bin/env python
+"""Merging of outcomes that were written in shards, e.g. by one job per
+city, growth rate, or start date, into a single output. Shards are
+concatenated along a param dim, along the 'scenario' dim of sparse
+outcomes (see SparseOutcomeStore), or along 'replicate'.
+
+Shards are merged in two passes. First, the schema of each shard (its
+dims, the labels of each dim, and the dims of its other coords, see
+`read_schema`) is read, and shards are checked for compatibility with
+`plan_merge`. For Zarr stores, this reads metadata and coords only.
+Then each shard is opened in turn, and copied into the output one
+replicate at one point in parameter space at a time. At most one shard
+is open at a time, so merging N shards never needs memory for N
+shards: a pickled shard is loaded whole, but a Zarr shard is read one
+chunk at a time. When writing a pickle, the merged outcomes are held
+in memory; merging into a Zarr store (see outcome_io) needs memory for
+neither.
+"""
+import pickle
+
+import numpy as np
+import xarray as xr
+
+from .outcome_handler import get_label_table, new_scalar_array, \
+    sorted_unique, LABEL_SUFFIX
+from .outcome_io import open_outcomes, is_zarr, create_zarr_outcomes, \
+    write_zarr_coords, _BackgroundWriter
+from .outcome_table import get_group_dims
+
+
+def read_schema(fp):
+    """Returns a dictionary describing the outcomes at filepath `fp`,
+    without their values: 'dims', 'sizes', 'group_dims' (see
+    outcome_table.get_group_dims), 'labels' of each dim (see
+    get_label_table), 'encoded' param dims (that have a `<dim>_label`
+    coord), 'point_coords' (params of each scenario of sparse outcomes,
+    as lists), 'aux_coords' (dims and dtype of every other coord, such
+    as per-task scalars), and 'attrs'.
+    """
+    outcomes = open_outcomes(fp)
+    schema = {
+        'fp': fp,
+        'dims': tuple(outcomes.dims),
+        'sizes': dict(outcomes.sizes),
+        'group_dims': tuple(get_group_dims(outcomes)),
+        'labels': get_label_table(outcomes),
+        'encoded': [dim for dim in outcomes.dims
+                    if dim + LABEL_SUFFIX in outcomes.coords],
+        'point_coords': dict(),
+        'aux_coords': dict(),
+        'attrs': dict(outcomes.attrs),
+    }
+    # params of sparse outcomes are ordered as in the 'param_dims' attr
+    # of Zarr stores, since SparseOutcomeStore sorts scenarios by them
+    order = list(schema['attrs'].get('param_dims', list()))
+    names = sorted(list(outcomes.coords), key=lambda name: order.index(
+        name) if name in order else len(order))
+    for name in names:
+        coord = outcomes.coords[name]
+        if name in outcomes.dims or (name.endswith(LABEL_SUFFIX) and
+                                     name[:-len(LABEL_SUFFIX)] in
+                                     outcomes.dims):
+            continue
+        if coord.dims == ('scenario',):
+            schema['point_coords'][name] = list(coord.values)
+        else:
+            schema['aux_coords'][name] = (coord.dims, coord.dtype)
+    return schema
+
+
+def _check_same(schemas, get, what):
+    """Raises ValueError unless `get(schema)` is the same for every
+    schema in `schemas`.
+    """
+    first = schemas[0]
+    for schema in schemas[1:]:
+        if get(schema) != get(first):
+            raise ValueError(
+                "Cannot merge shards with different {}: {} in {}, but {} "
+                .format(what, get(schema), schema['fp'], get(first)) +
+                "in {}".format(first['fp']))
+
+
+def _merge_labels(schemas, dim):
+    """Returns sorted union of the labels of `dim` in each shard, and
+    the positions of each shard's labels in the union. Raises
+    ValueError if a label is in more than one shard.
+    """
+    seen = dict()
+    for schema in schemas:
+        for label in schema['labels'][dim]:
+            if label in seen:
+                raise ValueError(
+                    "Label {} of {} is in shards {} and {}. Shards must "
+                    .format(label, dim, seen[label], schema['fp']) +
+                    "not overlap along the dim they are merged along")
+            seen[label] = schema['fp']
+    merged = sorted_unique(list(seen))
+    index = dict([(label, i) for i, label in enumerate(merged)])
+    positions = [np.array([index[label] for label in schema['labels'][dim]],
+                          dtype=int) for schema in schemas]
+    return merged, positions
+
+
+def _merge_points(schemas):
+    """Same as _merge_labels, for the points in parameter space along
+    the 'scenario' dim of sparse outcomes.
+    """
+    names = list(schemas[0]['point_coords'])
+    seen = dict()
+    shard_points = list()
+    for schema in schemas:
+        points = list(zip(*[schema['point_coords'][name]
+                            for name in names]))
+        for point in points:
+            if point in seen:
+                raise ValueError(
+                    "Scenario {} is in shards {} and {}. Shards must not "
+                    .format(dict(zip(names, point)), seen[point],
+                            schema['fp']) + "overlap along the dim they " +
+                    "are merged along")
+            seen[point] = schema['fp']
+        shard_points.append(points)
+    merged = sorted_unique(list(seen))
+    index = dict([(point, i) for i, point in enumerate(merged)])
+    positions = [np.array([index[point] for point in points], dtype=int)
+                 for points in shard_points]
+    coords = dict([(name, ('scenario', [point[i] for point in merged]))
+                   for i, name in enumerate(names)])
+    return merged, positions, coords
+
+
+def plan_merge(schemas, dim='replicate'):
+    """Checks that the shards with `schemas` (see read_schema) can be
+    concatenated along `dim`, which is 'replicate', 'scenario', or a
+    param dim, and returns a dictionary of the 'dim' they are merged
+    along, and the 'dims', 'shape', 'coords', and 'attrs' of the merged
+    outcomes. Its 'positions' are, for each shard, a dictionary of the
+    positions of the shard along each dim in the merged outcomes.
+
+    Every dim other than `dim` must have the same labels in each shard,
+    except 'replicate', which is padded with NaN to the largest number
+    of replicates. Labels (or scenarios) along `dim` must not overlap.
+    Raises ValueError if the shards cannot be merged.
+    """
+    if not schemas:
+        raise ValueError("No shards to merge")
+    first = schemas[0]
+    dims = first['dims']
+    if dim not in dims and dim in first['point_coords']:
+        # param of sparse outcomes
+        dim = 'scenario'
+    if dim not in first['group_dims'] + ('replicate',):
+        raise ValueError("Can only merge along 'replicate' or one of " +
+                         "dims {}, not {}".format(first['group_dims'], dim))
+    if dim == 'replicate' and 'replicate' not in dims:
+        raise ValueError("Cannot concatenate summary statistics along " +
+                         "replicates; merge the SummaryOutcomeStores " +
+                         "instead (see SummaryStoreMixin.merge)")
+    _check_same(schemas, lambda schema: schema['dims'], 'dims')
+    _check_same(schemas, lambda schema: schema['encoded'],
+                'integer-coded dims')
+    _check_same(schemas, lambda schema: list(schema['point_coords']),
+                'scenario params')
+    _check_same(schemas, lambda schema: dict([
+        (name, dims_) for name, (dims_, dtype)
+        in schema['aux_coords'].items()]), 'coords')
+    for other in dims:
+        if other in (dim, 'replicate'):
+            continue
+        if other == 'scenario':
+            # labels of the 'scenario' dim are positions
+            for schema in schemas[1:]:
+                if schema['point_coords'] != first['point_coords']:
+                    raise ValueError(
+                        "Cannot merge shards with different scenarios: "
+                        "{} and {}".format(schema['fp'], first['fp']))
+            continue
+        for schema in schemas[1:]:
+            if list(schema['labels'][other]) != \
+                    list(first['labels'][other]):
+                raise ValueError(
+                    "Cannot merge shards with different labels of {}: "
+                    .format(other) + "{} in {}, but {} in {}".format(
+                        schema['labels'][other], schema['fp'],
+                        first['labels'][other], first['fp']))
+
+    coords = dict()
+    for d in dims:
+        labels = first['labels'][d]
+        if d in first['encoded']:
+            coords[d] = np.arange(len(labels))
+            coords[d + LABEL_SUFFIX] = (d, labels)
+        else:
+            coords[d] = labels
+    coords.update(dict([(name, ('scenario', values))
+                        for name, values in first['point_coords'].items()]))
+    if dim == 'scenario':
+        merged, shard_positions, point_coords = _merge_points(schemas)
+        coords['scenario'] = np.arange(len(merged))
+        coords.update(point_coords)
+    elif dim == 'replicate':
+        offsets = np.cumsum([0] + [schema['sizes']['replicate']
+                                   for schema in schemas])
+        coords['replicate'] = np.arange(offsets[-1])
+        shard_positions = [np.arange(offsets[i], offsets[i + 1])
+                           for i in range(len(schemas))]
+    else:
+        merged, shard_positions = _merge_labels(schemas, dim)
+        if dim in first['encoded']:
+            coords[dim] = np.arange(len(merged))
+            coords[dim + LABEL_SUFFIX] = (dim, merged)
+        else:
+            coords[dim] = merged
+    if dim != 'replicate' and 'replicate' in dims:
+        coords['replicate'] = np.arange(max([
+            schema['sizes']['replicate'] for schema in schemas]))
+    positions = list()
+    for schema, pos in zip(schemas, shard_positions):
+        shard = dict([(d, np.arange(schema['sizes'][d])) for d in dims])
+        shard[dim] = pos
+        positions.append(shard)
+
+    # attrs that every shard has in common, such as param_dims
+    attrs = dict([(key, value) for key, value in first['attrs'].items()
+                  if all([schema['attrs'].get(key, None) == value
+                          for schema in schemas])])
+    attrs['merged_from'] = [str(schema['fp']) for schema in schemas]
+    return {
+        'dim': dim,
+        'dims': dims,
+        'shape': tuple([len(coords[d]) for d in dims]),
+        'coords': coords,
+        'attrs': attrs,
+        'positions': positions,
+    }
+
+
+def _new_coord_array(shape, dtype):
+    """Returns array of `shape` for a merged coord of `dtype`, filled as
+    in new_scalar_array, or with None for labels.
+    """
+    if np.dtype(dtype).kind in 'OUS':
+        return np.full(shape, None, dtype=object)
+    return new_scalar_array(shape, dtype)
+
+
+def _copy_shard(outcomes, schema, positions, write, aux):
+    """Copies xarray.DataArray `outcomes` of the shard with `schema` to
+    the merged outcomes, by calling `write(index, block)` for each
+    replicate (or statistic) at each point in parameter space, and
+    copies its per-point coords into the arrays in dictionary `aux`.
+    Blocks that are entirely NaN, such as tasks that were not run, are
+    not written.
+    """
+    for name, (dims, arr) in aux.items():
+        index = np.ix_(*[positions[dim] for dim in dims])
+        arr[index] = outcomes.coords[name].values
+    block_dims = schema['group_dims'] + (schema['dims'][
+        len(schema['group_dims'])],)
+    block_shape = tuple([schema['sizes'][dim] for dim in block_dims])
+    for point in np.ndindex(*block_shape):
+        block = outcomes.isel(dict(zip(block_dims, point))).values
+        if np.isnan(block).all():
+            continue
+        index = tuple([int(positions[dim][i])
+                       for dim, i in zip(block_dims, point)])
+        write(index, block)
+
+
+def merge_outcomes(fps, out_fp, dim='replicate'):
+    """Concatenates the outcomes in list of filepaths `fps` (Zarr stores
+    or pickles, see outcome_io.open_outcomes) along `dim`, and writes
+    them to `out_fp`, as a Zarr store if it ends with '.zarr', or as a
+    pickle otherwise. `dim` is 'replicate', or a param dim, e.g. one
+    shard for each g_rate (sparse outcomes are merged along 'scenario'
+    for any param). Compatibility of the shards is checked before
+    any outcomes are read (see plan_merge). Returns the merged outcomes,
+    which are opened lazily if written to a Zarr store.
+    """
+    schemas = [read_schema(fp) for fp in fps]
+    merged = plan_merge(schemas, dim=dim)
+    dims, shape = merged['dims'], merged['shape']
+    first = schemas[0]
+    aux = dict()
+    for name, (coord_dims, dtype) in first['aux_coords'].items():
+        aux[name] = (coord_dims, _new_coord_array(
+            tuple([shape[dims.index(d)] for d in coord_dims]), dtype))
+    print("Merging {} shards along {} into: {}".format(
+        len(schemas), merged['dim'], out_fp))
+
+    if is_zarr(out_fp):
+        group, arr = create_zarr_outcomes(out_fp, dims, shape,
+                                          merged['coords'],
+                                          attrs=merged['attrs'])
+        writer = _BackgroundWriter(arr)
+        try:
+            for schema, positions in zip(schemas, merged['positions']):
+                _copy_shard(open_outcomes(schema['fp']), schema, positions,
+                            writer.write, aux)
+        finally:
+            writer.close()
+        write_zarr_coords(group, aux)
+        return open_outcomes(out_fp)
+
+    data = np.full(shape, np.nan, dtype=float)
+
+    def write(index, block):
+        data[index] = block
+
+    for schema, positions in zip(schemas, merged['positions']):
+        _copy_shard(open_outcomes(schema['fp']), schema, positions, write,
+                    aux)
+    coords = dict(merged['coords'])
+    coords.update(aux)
+    outcomes = xr.DataArray(data, dims=dims, coords=coords,
+                            attrs=merged['attrs'])
+    print("Writing outcomes as pickled xarray.DataArray to: {}".format(
+        out_fp))
+    with open(out_fp, 'wb') as f:
+        pickle.dump(outcomes, f)
+    return outcomes
@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+"""Long-format (one row per value) export of outcomes to Parquet. Rows
+are written one point in parameter space at a time, as one row group
+each, so that the full table is never held in memory, and lazily
+opened outcomes (see outcome_io.open_outcomes) are read one scenario at
+a time. Params, compartments, and groups are dictionary-encoded columns
+of their labels, and times are native timestamp columns, so the file is
+small and loads quickly in pandas, pyarrow, or DuckDB.
+
+Requires the optional dependency pyarrow.
+"""
+import numpy as np
+
+from .outcome_handler import get_label_table, select, sorted_unique, \
+    LABEL_SUFFIX
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+# name of the column that holds the outcome values
+VALUE_COL = 'value'
+# reductions that can be applied to each period when aggregating time
+TIME_HOWS = ('mean', 'sum', 'min', 'max', 'first', 'last')
+
+
+def _require_pyarrow():
+    if pa is None:
+        raise ImportError("Writing outcomes to Parquet requires the " +
+                          "pyarrow package: pip install pyarrow")
+
+
+def _dictionary(labels):
+    """Returns pyarrow.Array of `labels`, as strings if their types are
+    mixed (see outcome_handler.sorted_unique).
+    """
+    try:
+        return pa.array(labels)
+    except (pa.ArrowInvalid, pa.ArrowTypeError, TypeError):
+        return pa.array([str(label) for label in labels])
+
+
+def _encoded(indices, labels):
+    """Returns pyarrow.DictionaryArray with integer `indices` into the
+    list of `labels`.
+    """
+    return pa.DictionaryArray.from_arrays(
+        pa.array(indices, type=pa.int32()), _dictionary(labels))
+
+
+def get_group_dims(outcomes):
+    """Returns the dims of xarray.DataArray `outcomes` that each index
+    a point in parameter space, i.e. every dim before 'replicate' (or
+    'statistic', for summary stores). These are the param dims of
+    OutcomeStore, or 'scenario' for SparseOutcomeStore.
+    """
+    dims = list(outcomes.dims)
+    for dim in ('replicate', 'statistic'):
+        if dim in dims:
+            return dims[:dims.index(dim)]
+    raise ValueError("outcomes have no 'replicate' dim: {}".format(dims))
+
+
+def _get_point_columns(outcomes, group_dims):
+    """Returns list of the columns that are constant within each point
+    along `group_dims`, as tuples of (name, position of the dim in
+    `group_dims`, codes of each position or None, labels).
+    """
+    table = get_label_table(outcomes)
+    columns = list()
+    for i, dim in enumerate(group_dims):
+        columns.append((dim, i, None, table[dim]))
+        # param coords along the 'scenario' dim of SparseOutcomeStore
+        for name, coord in outcomes.coords.items():
+            if coord.dims == (dim,) and name != dim and \
+                    not name.endswith(LABEL_SUFFIX):
+                values = list(coord.values)
+                labels = sorted_unique(values)
+                index = dict([(label, j) for j, label in enumerate(labels)])
+                codes = [index[value] for value in values]
+                columns.append((name, i, codes, labels))
+    return columns
+
+
+def _block_to_table(block, point, point_columns):
+    """Returns long-format pyarrow.Table of the outcomes in
+    xarray.DataArray `block` at `point`.
+    """
+    shape = block.shape
+    n_rows = int(np.prod(shape))
+    table = get_label_table(block)
+    arrays = list()
+    names = list()
+    for name, i, codes, labels in point_columns:
+        code = point[i] if codes is None else codes[point[i]]
+        names.append(name)
+        arrays.append(_encoded(np.full(n_rows, code, dtype=np.int32),
+                               labels))
+    for k, dim in enumerate(block.dims):
+        # position along dim k of each row, in C order
+        indices = np.tile(np.repeat(np.arange(shape[k], dtype=np.int32),
+                                    int(np.prod(shape[k + 1:]))),
+                          int(np.prod(shape[:k])))
+        names.append(dim)
+        index = block.get_index(dim)
+        if np.issubdtype(index.dtype, np.datetime64):
+            arrays.append(pa.array(index.values[indices]))
+        else:
+            arrays.append(_encoded(indices, table[dim]))
+    names.append(VALUE_COL)
+    arrays.append(pa.array(np.asarray(block.values).ravel()))
+    return pa.Table.from_arrays(arrays, names=names)
+
+
+def write_parquet(outcomes, out_fp, compartments=None, time_freq=None,
+                  time_how='mean', compression='zstd'):
+    """Writes xarray.DataArray `outcomes` to Parquet file `out_fp` in
+    long format, with a column for each dim (labels of integer-coded
+    param dims, see OutcomeStore), and column 'value'. Each point in
+    parameter space is written, and read from `outcomes`, as one row
+    group. Optionally, only writes `compartments` (list of labels), and
+    aggregates time to periods of pandas frequency string `time_freq`
+    (e.g. '1D'), reduced by `time_how` (one of TIME_HOWS). Returns the
+    number of rows written.
+    """
+    _require_pyarrow()
+    if time_how not in TIME_HOWS:
+        raise ValueError("time_how must be one of {}, not {}".format(
+            TIME_HOWS, time_how))
+    if compartments is not None:
+        outcomes = select(outcomes, compartment=list(compartments))
+    group_dims = get_group_dims(outcomes)
+    point_columns = _get_point_columns(outcomes, group_dims)
+    group_shape = tuple([outcomes.sizes[dim] for dim in group_dims])
+
+    print("Writing outcomes to Parquet file at: {}".format(out_fp))
+    writer = None
+    n_rows = 0
+    try:
+        for point in np.ndindex(*group_shape):
+            block = outcomes.isel(dict(zip(group_dims, point))).load()
+            if time_freq is not None:
+                block = getattr(block.resample(time=time_freq), time_how)()
+            # drop scalar coords of the point, which are in point_columns
+            block = block.reset_coords(drop=True)
+            table = _block_to_table(block, point, point_columns)
+            if writer is None:
+                # format version 2.6 keeps nanosecond timestamps
+                writer = pq.ParquetWriter(out_fp, table.schema,
+                                          compression=compression,
+                                          version='2.6')
+            writer.write_table(table)
+            n_rows += table.num_rows
+    finally:
+        if writer is not None:
+            writer.close()
+    return n_rows
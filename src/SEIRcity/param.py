@@ -6,10 +6,20 @@ import os
 import numpy as np
 import pandas as pd
 import datetime as dt
-from . import param_parser
+from copy import deepcopy
+from collections import OrderedDict
+from . import param_parser, utils
 from .get_initial_state import InitialModelState
 from datetime import datetime
 
+# results of SEIR_get_data, keyed by get_data_cache_key. Lets repeated
+# calls to aggregate_params_and_data in the same process (notebooks,
+# batch fits) skip re-reading the city data files. At most
+# CITY_DATA_CACHE_SIZE results are kept, least recently used first out,
+# so that long-lived workers of sweeps over many cities do not grow.
+CITY_DATA_CACHE_SIZE = 16
+_CITY_DATA_CACHE = OrderedDict()
+
 
 def aggregate_params_and_data(yaml_fp):
     """Aggregates all run parameters. Reads from a config YAML file
@@ -39,7 +49,7 @@ def aggregate_params_and_data(yaml_fp):
     # get demographics, school calendar, and transmission data from Excel files
     AgeGroupDict, metro_pop, school_calendar, \
         time_begin, FallStartDate, Phi, symp_h_ratio_overall, \
-        symp_h_ratio, hosp_f_ratio = SEIR_get_data(config=config)
+        symp_h_ratio, hosp_f_ratio = get_data_cached(config=config)
 
     config.update({
         "AgeGroupDict": AgeGroupDict,
@@ -78,6 +88,35 @@ def aggregate_params_and_data(yaml_fp):
     return config
 
 
+def get_data_cache_key(config):
+    """Returns a key that identifies the result of SEIR_get_data for
+    configuration dictionary `config`: the config values that
+    SEIR_get_data reads, and the modification times of the data files
+    in `data_folder`.
+    """
+    used_keys = ('data_folder', 'city', 'n_age', 'n_risk',
+                 'age_group_dict') + RATIO_PARAM_KEYS
+    data_folder = config['data_folder']
+    mtimes = dict()
+    if os.path.isdir(data_folder):
+        for fname in os.listdir(data_folder):
+            mtimes[fname] = os.path.getmtime(os.path.join(data_folder, fname))
+    return utils.fingerprint([{k: config[k] for k in used_keys}, mtimes])
+
+
+def get_data_cached(config):
+    """Same as SEIR_get_data, but memoized in this process. Returns a
+    copy of the cached result, so that callers may modify it freely.
+    """
+    key = get_data_cache_key(config)
+    if key not in _CITY_DATA_CACHE:
+        _CITY_DATA_CACHE[key] = SEIR_get_data(config=config)
+        while len(_CITY_DATA_CACHE) > CITY_DATA_CACHE_SIZE:
+            _CITY_DATA_CACHE.popitem(last=False)
+    _CITY_DATA_CACHE.move_to_end(key)
+    return deepcopy(_CITY_DATA_CACHE[key])
+
+
 def SEIR_get_data(config):
     """ Gets input data from Excel files. Takes a configuration
     dictionary `config` that must minimally contain the following keys:
@@ -192,6 +231,43 @@ def SEIR_get_data(config):
            Symp_H_Ratio, Symp_H_Ratio_w_risk, Hosp_F_Ratio_w_risk
 
 
+# keys of the config that SEIR_get_data reads to derive the ratios
+# symp_h_ratio_overall, symp_h_ratio, and hosp_f_ratio
+RATIO_PARAM_KEYS = (
+    'H_RELATIVE_RISK_IN_HIGH', 'D_RELATIVE_RISK_IN_HIGH',
+    'HIGH_RISK_RATIO', 'H_FATALITY_RATIO', 'INFECTION_FATALITY_RATIO',
+    'OVERALL_H_RATIO', 'ASYMP_RATE',
+)
+# keys of the config that SEIR_get_param reads, or that the ratios are
+# derived from. A Scenario that sweeps any of these (see
+# scenario_design) overrides the value in the config. R0 and
+# DOUBLE_TIME are not among them: transmission is set by beta0, and
+# they are only reported
+EPI_PARAM_KEYS = (
+    'symp_h_ratio_overall', 'symp_h_ratio', 'hosp_f_ratio', 'n_age',
+    'n_risk', 'deterministic', 'PROP_TRANS_IN_E', 'T_ONSET_TO_H',
+    'T_H_TO_D', 'T_EXPOSED_PARA', 'T_Y_TO_R_PARA', 'T_H_TO_R',
+) + RATIO_PARAM_KEYS
+
+
+def override_epi_params(config, overrides):
+    """Returns copy of configuration dictionary `config` with the values
+    of dictionary `overrides`. If any of RATIO_PARAM_KEYS is overridden,
+    the ratios derived from them by SEIR_get_data are recomputed, unless
+    they are overridden too.
+    """
+    config = dict(config, **overrides)
+    if any([k in overrides for k in RATIO_PARAM_KEYS]):
+        symp_h_ratio_overall, symp_h_ratio, hosp_f_ratio = \
+            get_data_cached(config=config)[-3:]
+        for k, v in (('symp_h_ratio_overall', symp_h_ratio_overall),
+                     ('symp_h_ratio', symp_h_ratio),
+                     ('hosp_f_ratio', hosp_f_ratio)):
+            if k not in overrides:
+                config[k] = v
+    return config
+
+
 def SEIR_get_param(config):
     """ Get epidemiological parameters from configuration dictionary
     `config`. `config` must minimally have the following keys:
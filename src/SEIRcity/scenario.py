@@ -1,6 +1,8 @@
 #!/usr/bin/env python
 
 import os
+import functools
+from collections.abc import Mapping
 from attrdict import AttrDict
 from jinja2 import Template
 import numbers
@@ -10,6 +12,9 @@ import yaml
 from copy import deepcopy
 from . import param_parser
 
+# number of compiled Jinja2 templates kept by _get_template
+TEMPLATE_CACHE_SIZE = 1024
+
 
 class BaseScenario(AttrDict):
     """Base class for Scenarios. Inherits from attrdict.AttrDict."""
@@ -26,6 +31,15 @@ class BaseScenario(AttrDict):
         if inject:
             self.inject()
 
+    def clone(self, **kwargs):
+        """Returns a copy of self, updated with `kwargs`, without
+        injecting it again. Use for replicates of a Scenario that was
+        already injected.
+        """
+        new = BaseScenario(self, inject=False)
+        new.update(kwargs)
+        return new
+
     def update_from_yaml(self, yaml_fp):
         """Update self with values in config YAML file `yaml_fp`, using
         SEIRcity.param_parser.load.
@@ -39,10 +53,13 @@ class BaseScenario(AttrDict):
         self.update(new_params)
         return self
 
-    def inject(self):
+    def inject(self, keys=None):
         """Inject Jinja2-formatted template strings with values from
         self. This is done recursively as the algorithm walks through
-        dictionary and sequence objects.
+        dictionary and sequence objects. Only the values of `keys` are
+        injected, if specified, e.g. the template keys of many Scenarios
+        with the same params from get_template_keys. By default, these
+        are found by walking through every value of self.
 
         Example:
 
@@ -73,17 +90,122 @@ class BaseScenario(AttrDict):
 
         Returns modified self, but also modifies self in place.
         """
+        if keys is None:
+            keys = get_template_keys(self)
+        if not keys:
+            return self
+        # values are injected with the values of self before injection
+        templates = {k: self[k] for k in keys}
         try:
-            return _inject(self, self.copy(), max_depth=10, inplace=True,
+            _inject(templates, self.copy(), max_depth=10, inplace=True,
                     try_convert=True, verbose=False)
         except RecursionError as recur_err:
             raise recur_err
+        self.update(templates)
+        return self
 
     def to_dict(self):
         """Returns self as 'vanilla' Python dictionary."""
         return dict(self)
 
 
+class Task(Mapping):
+    """Read-only view of one replicate of a Scenario, for the sweeps of
+    many thousands of tasks in multiple_pool. Every replicate of a
+    Scenario shares it, instead of holding a copy, and only the `seed`
+    (key 'seed') and `replicate` number differ. Setting a key other
+    than 'seed' sets it in the shared Scenario, e.g. the `config` of
+    every task. Use to_scenario to simulate the task.
+    """
+    __slots__ = ('scenario', 'replicate', 'seed')
+
+    def __init__(self, scenario, replicate=0, seed=None):
+        self.scenario = scenario
+        self.replicate = replicate
+        self.seed = seed
+
+    def __getitem__(self, key):
+        if key == 'seed':
+            return self.seed
+        return self.scenario[key]
+
+    def __setitem__(self, key, value):
+        if key == 'seed':
+            self.seed = value
+        else:
+            self.scenario[key] = value
+
+    def __iter__(self):
+        for key in self.scenario:
+            if key != 'seed':
+                yield key
+        yield 'seed'
+
+    def __len__(self):
+        return len(self.scenario) + int('seed' not in self.scenario)
+
+    def __repr__(self):
+        return "Task(replicate={}, seed={}, scenario={})".format(
+            self.replicate, self.seed, self.scenario)
+
+    def __getstate__(self):
+        return (self.scenario, self.replicate, self.seed)
+
+    def __setstate__(self, state):
+        self.scenario, self.replicate, self.seed = state
+
+    def to_scenario(self):
+        """Returns a new BaseScenario of this task, with its seed"""
+        if isinstance(self.scenario, BaseScenario):
+            return self.scenario.clone(seed=self.seed)
+        return BaseScenario(self.scenario, seed=self.seed, inject=False)
+
+
+def to_scenario(task):
+    """Returns BaseScenario of `task`, a Task or a Scenario. Scenarios
+    are returned as is.
+    """
+    if isinstance(task, Task):
+        return task.to_scenario()
+    if isinstance(task, BaseScenario):
+        return task
+    return BaseScenario(task, inject=False)
+
+
+def has_template(data, max_depth=10):
+    """Returns True if `data`, or any string in the dictionaries and
+    sequences nested in `data`, might be a Jinja2 template, i.e.
+    contains '{'. Strings without one render to themselves, so do not
+    need to be injected.
+    """
+    if max_depth <= 0:
+        raise RecursionError("scenario.has_template called itself >= " +
+                             "max_depth times. Halting recursion.")
+    if isinstance(data, str):
+        return '{' in data
+    elif isinstance(data, dict):
+        return any(has_template(v, max_depth - 1) for v in data.values())
+    elif isinstance(data, (list, set, tuple)):
+        return any(has_template(v, max_depth - 1) for v in data)
+    return False
+
+
+def get_template_keys(data):
+    """Returns tuple of the keys of dictionary `data` with values that
+    contain Jinja2 templates (see has_template).
+    """
+    return tuple([k for k, v in data.items() if has_template(v)])
+
+
+@functools.lru_cache(maxsize=TEMPLATE_CACHE_SIZE)
+def _get_template(source):
+    """Returns compiled jinja2.Template of string `source`. Compiled
+    templates are cached, since the same templates are injected into
+    every Scenario of a sweep.
+    """
+    return Template(source)
+
+
 def _inject(data, populate_with, max_depth=10, inplace=False,
             try_convert=False, verbose=False,
             only_convert_to=(numbers.Number)):
@@ -130,7 +252,10 @@ def _inject(data, populate_with, max_depth=10, inplace=False,
         raise RecursionError("scenario._inject called itself >= " +
                              "max_depth times. Halting recursion.")
     elif isinstance(data, str):
-        t = Template(data)
+        if '{' not in data:
+            # not a template
+            return data
+        t = _get_template(data)
         pop_keys = [k for k in populate_with.keys() if k in data]
         pop_filtered = {k: populate_with[k] for k in pop_keys}
         injected = t.render(**pop_filtered)
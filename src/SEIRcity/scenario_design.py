@@ -0,0 +1,319 @@
+#!/usr/bin/env python
+"""Designs of the points in parameter space that a sweep simulates.
+A design is a sequence of points, each a dictionary mapping the swept
+keys to their values, that computes each point on demand: len(design)
+and design[i] do not build the other points, so that a design with
+millions of points can be iterated, or split between jobs by index,
+in constant memory.
+
+Designs are combined with ProductDesign, e.g. every combination of the
+growth rates and contact reductions of a config, and each point of a
+Latin hypercube of epidemiological params. See get_design for the
+config format.
+"""
+import numpy as np
+import pandas as pd
+
+# sweep keys of a config, in the order get_scenarios loops over them,
+# and the key of each in a Scenario
+LEGACY_SWEEP_KEYS = (
+    ('g_rate', 'GROWTH_RATE_LIST'),
+    ('c_reduction', 'CONTACT_REDUCTION'),
+    ('close_trigger', 'CLOSE_TRIGGER_LIST'),
+    ('reopen_trigger', 'REOPEN_TRIGGER_LIST'),
+)
+# keys that determine the shape of each outcome, which must be the same
+# for every scenario in a sweep
+UNSWEEPABLE_KEYS = ('NUM_SIM', 'n_age', 'n_risk', 'total_time',
+                    'interval_per_day')
+# keys of the config that do not change the simulation, so sweeping
+# them would simulate the same epidemic at every point: transmission is
+# set by beta0 (see get_scenarios.make_scenario)
+INERT_KEYS = ('R0', 'DOUBLE_TIME')
+# number of points of LatinHypercubeDesign that share a random jitter
+# block, so that any point can be computed without the others
+LHS_BLOCK_SIZE = 4096
+
+
+class Design(object):
+    """Base class for designs. Subclasses set `keys`, the tuple of swept
+    keys in every point, and implement `__len__` and `_point`.
+    """
+    keys = tuple()
+    # True if the points are the Cartesian product of the values of
+    # each key, such that a dense OutcomeStore has no empty points
+    is_grid = True
+
+    def __len__(self):
+        raise NotImplementedError()
+
+    def _point(self, i):
+        raise NotImplementedError()
+
+    def __getitem__(self, i):
+        n = len(self)
+        if i < 0:
+            i += n
+        if not 0 <= i < n:
+            raise IndexError("point {} is out of range for a design of "
+                             .format(i) + "{} points".format(n))
+        return self._point(i)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self._point(i)
+
+
+class ListDesign(Design):
+    """Design of an explicit list of `points`, each a dictionary with
+    the same keys.
+    """
+
+    def __init__(self, points):
+        self.points = [dict(point) for point in points]
+        assert self.points, "ListDesign requires at least one point"
+        self.keys = tuple(self.points[0])
+        for point in self.points:
+            if set(point) != set(self.keys):
+                raise ValueError("Every point of a ListDesign must have " +
+                                 "keys {}, not {}".format(self.keys,
+                                                          tuple(point)))
+        self.is_grid = len(self.keys) <= 1
+
+    def __len__(self):
+        return len(self.points)
+
+    def _point(self, i):
+        return dict(self.points[i])
+
+
+class ProductDesign(Design):
+    """Cartesian product of `designs`, which must not share keys. Points
+    are ordered as in nested loops over each design, with the last
+    design varying fastest.
+    """
+
+    def __init__(self, designs):
+        self.designs = list(designs)
+        keys = list()
+        for design in self.designs:
+            for key in design.keys:
+                if key in keys:
+                    raise ValueError("{} is swept by more than one ".format(
+                        key) + "design")
+                keys.append(key)
+        self.keys = tuple(keys)
+        self.is_grid = all([design.is_grid for design in self.designs])
+        self._sizes = [len(design) for design in self.designs]
+
+    def __len__(self):
+        return int(np.prod(self._sizes, dtype=np.int64))
+
+    def _point(self, i):
+        point = dict()
+        for design, size in zip(reversed(self.designs),
+                                reversed(self._sizes)):
+            i, j = divmod(i, size)
+            point.update(design._point(j))
+        # same key order as self.keys
+        return dict([(key, point[key]) for key in self.keys])
+
+
+class GridDesign(ProductDesign):
+    """Every combination of the values of each key in `axes`, a list of
+    (key, list of values) tuples (or a dictionary), in the order of
+    nested loops over each key.
+    """
+
+    def __init__(self, axes):
+        if isinstance(axes, dict):
+            axes = list(axes.items())
+        super(GridDesign, self).__init__([
+            ListDesign([{key: value} for value in values])
+            for key, values in axes])
+
+
+class LatinHypercubeDesign(Design):
+    """Latin hypercube sample of `n` points. `ranges` maps each key to
+    either a dictionary with keys 'low' and 'high', sampled uniformly
+    from [low, high) (as integers if both are ints), or a list of
+    values, sampled with equal probability. Along each key, each of the
+    `n` equal strata of the range holds exactly one point.
+
+    The stratum of each point along each key is a random permutation,
+    held as n integers per key. Its position within the stratum is drawn
+    from a block of LHS_BLOCK_SIZE points seeded by `seed` and the index
+    of the block, so any point can be computed without the others, and
+    the design is the same for the same `seed`.
+    """
+    is_grid = False
+
+    def __init__(self, ranges, n, seed=None):
+        assert n > 0, "LatinHypercubeDesign requires n > 0"
+        self.n = int(n)
+        self.keys = tuple(ranges)
+        self.ranges = dict()
+        for key, spec in ranges.items():
+            if isinstance(spec, dict):
+                if set(spec) != {'low', 'high'} or \
+                        not spec['low'] < spec['high']:
+                    raise ValueError("range of {} must have 'low' < "
+                                     .format(key) + "'high', not {}".format(
+                                         spec))
+                self.ranges[key] = (spec['low'], spec['high'])
+            else:
+                self.ranges[key] = list(spec)
+                assert self.ranges[key], "{} has no values".format(key)
+        self.seed_seq = np.random.SeedSequence(seed)
+        self.seed = self.seed_seq.entropy
+        rng = np.random.default_rng(self.seed_seq.spawn(1)[0])
+        dtype = np.int32 if self.n < 2 ** 31 else np.int64
+        self._strata = dict([(key, rng.permutation(self.n).astype(dtype))
+                             for key in self.keys])
+        self._block_idx = None
+        self._block = None
+
+    def __len__(self):
+        return self.n
+
+    def _jitter(self, i):
+        """Returns array of the position of point `i` within its stratum
+        along each key, in [0, 1).
+        """
+        block_idx, j = divmod(i, LHS_BLOCK_SIZE)
+        if block_idx != self._block_idx:
+            seed = np.random.SeedSequence([self.seed, block_idx])
+            self._block = np.random.default_rng(seed).random(
+                (LHS_BLOCK_SIZE, len(self.keys)))
+            self._block_idx = block_idx
+        return self._block[j]
+
+    def _point(self, i):
+        point = dict()
+        jitter = self._jitter(i)
+        for k, key in enumerate(self.keys):
+            # position in [0, 1) of the point along key
+            u = (self._strata[key][i] + jitter[k]) / self.n
+            spec = self.ranges[key]
+            if isinstance(spec, list):
+                point[key] = spec[int(u * len(spec))]
+            else:
+                low, high = spec
+                value = low + u * (high - low)
+                if isinstance(low, int) and isinstance(high, int):
+                    value = int(np.floor(value))
+                point[key] = value
+        return point
+
+
+class PosteriorDesign(ListDesign):
+    """Design of `n` draws from a weighted posterior sample, such as the
+    `posterior` of an ABC fit (see fit_to_data.abc): a pandas DataFrame
+    `particles` with a column for each key, and column `weight`.
+    Particles are drawn by systematic resampling, so that each is drawn
+    about n * weight times. Each point has the values of the `keys` of
+    its particle (every column but 'weight' and 'distance' by default),
+    and its index `posterior_sample`, so that a particle drawn more than
+    once gives distinct points.
+    """
+
+    def __init__(self, particles, n, keys=None, seed=None):
+        assert n > 0, "PosteriorDesign requires n > 0"
+        if keys is None:
+            keys = [key for key in particles.columns
+                    if key not in ('weight', 'distance')]
+        weights = np.asarray(particles['weight'], dtype=float)
+        if not len(weights) or (weights < 0).any() or not weights.sum() > 0:
+            raise ValueError("posterior weights must be non-negative, and " +
+                             "not all zero")
+        cdf = np.cumsum(weights / weights.sum())
+        offset = np.random.default_rng(seed).random()
+        idx = np.searchsorted(cdf, (np.arange(n) + offset) / n, side='right')
+        idx = np.minimum(idx, len(weights) - 1)
+        values = particles[list(keys)].to_dict('records')
+        super(PosteriorDesign, self).__init__([
+            dict([('posterior_sample', i)] + [
+                (key, values[j][key]) for key in keys])
+            for i, j in enumerate(idx)])
+        self.is_grid = False
+
+
+def _get_legacy_design(config, swept):
+    """Returns GridDesign over the sweep keys of `config` (see
+    LEGACY_SWEEP_KEYS) that are not in list of keys `swept`, or None if
+    every one of them is swept.
+    """
+    axes = [(key, list(config[config_key]))
+            for key, config_key in LEGACY_SWEEP_KEYS if key not in swept]
+    if not axes:
+        return None
+    return GridDesign(axes)
+
+
+def get_design(config):
+    """Returns the Design of the sweep defined by dictionary `config`.
+    By default, this is the grid of every combination of
+    GROWTH_RATE_LIST, CONTACT_REDUCTION, CLOSE_TRIGGER_LIST, and
+    REOPEN_TRIGGER_LIST, as in get_scenarios. Optional config key
+    `scenario_design` sweeps other keys of each Scenario, such as
+    `time_begin_sim`, `shift_week`, or epidemiological params (e.g.
+    ASYMP_RATE), in every combination with the sweep keys it does not
+    include. It is a dictionary with keys:
+
+        type: 'grid' (default), 'lhs', 'list', or 'posterior'
+        params: for 'grid', the list of values of each key. For 'lhs',
+            a dictionary {low: ..., high: ...} or list of values of
+            each key (see LatinHypercubeDesign). For 'posterior',
+            optional list of the keys to take from the posterior.
+        points: for 'list', the list of points, each a dictionary
+        fp: for 'posterior', the CSV of a weighted posterior sample,
+            such as that of an ABC fit (see PosteriorDesign)
+        n: for 'lhs' and 'posterior', the number of points
+        seed: for 'lhs' and 'posterior', optional seed of the sample
+    """
+    spec = config.get('scenario_design', None)
+    if not spec:
+        return _get_legacy_design(config, swept=tuple())
+    design_type = spec.get('type', 'grid')
+    if design_type == 'grid':
+        design = GridDesign(spec['params'])
+    elif design_type == 'lhs':
+        design = LatinHypercubeDesign(spec['params'], n=spec['n'],
+                                      seed=spec.get('seed', None))
+    elif design_type == 'list':
+        design = ListDesign(spec['points'])
+    elif design_type == 'posterior':
+        design = PosteriorDesign(pd.read_csv(spec['fp']), n=spec['n'],
+                                 keys=spec.get('params', None),
+                                 seed=spec.get('seed', None))
+    else:
+        raise ValueError("scenario_design type must be one of 'grid', " +
+                         "'lhs', 'list', or 'posterior', not {}".format(
+                             design_type))
+    unsweepable = [key for key in design.keys if key in UNSWEEPABLE_KEYS]
+    if unsweepable:
+        raise ValueError("{} cannot be swept, since every outcome of a "
+                         .format(unsweepable) + "sweep must have the same " +
+                         "shape")
+    inert = [key for key in design.keys if key in INERT_KEYS]
+    if inert:
+        raise ValueError("{} cannot be swept, since they do not change ".format(
+            inert) + "the simulation. Sweep beta0 instead")
+    legacy = _get_legacy_design(config, swept=design.keys)
+    if legacy is None:
+        return design
+    return ProductDesign([legacy, design])
+
+
+def get_param_dims(config, default=None):
+    """Returns tuple of the param dims of the outcomes of the sweep
+    defined by `config`: the `default` param dims (see
+    OutcomeHandler.DEFAULT_PARAM_DIMS), followed by any other key swept
+    by its `scenario_design`.
+    """
+    if default is None:
+        from .outcome_handler import OutcomeHandler
+        default = OutcomeHandler.DEFAULT_PARAM_DIMS
+    design = get_design(config)
+    return tuple(default) + tuple([key for key in design.keys
+                                   if key not in default])
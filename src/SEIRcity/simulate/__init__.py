@@ -7,7 +7,8 @@ SEIR_HOME = os.path.dirname(PARENT)
 sys.path.append(SEIR_HOME)
 
 
-from .simulate_one import simulate_one
+from .simulate_one import simulate_one, simulate_hosp
+from .worker_pool import WorkerPool, get_pool
 from .multiple_serial import multiple_serial
 from .multiple_pool import multiple_pool
 from .simulate_multiple import simulate_multiple
@@ -0,0 +1,300 @@
+#!/usr/bin/env python
+"""File system work queue for running a sweep on more than one node.
+A coordinator writes every task to a shared directory (`enqueue`),
+workers on any number of hosts claim tasks and write the outcome of each
+as a shard (`work`), and a reducer compiles the shards into an
+OutcomeHandler (`reduce`). The queue directory is laid out as:
+
+    queue_dir/
+        config.pckl        config shared by every task
+        manifest.pckl      tasks, replicates, and time coords
+        pending/           tasks that have not been claimed
+        claimed/           tasks being run, suffixed by host and PID
+        shards/            outcome of each finished task, as .npy
+        failed/            error of each task that failed, as .json
+
+Claiming a task is a rename from pending/ to claimed/, which is atomic
+on POSIX file systems (including NFS and Lustre), so each task is run
+by exactly one worker.
+"""
+import os
+import json
+import time
+import pickle
+import random
+import socket
+import tempfile
+import traceback
+from multiprocessing import Pool
+
+import numpy as np
+
+from SEIRcity.scenario import to_scenario
+from .simulate_one import simulate_one
+from .task_cache import save_atomic
+from .multiple_pool import (get_tasks, new_store, get_outcome_adder,
+                            record_failures)
+
+SUBDIRS = ('pending', 'claimed', 'shards', 'failed')
+# separates the task filename from the host and PID of the claimant
+CLAIM_SEP = '@'
+
+
+def _task_name(task_idx):
+    return "{:08d}.pckl".format(task_idx)
+
+
+def _dump_atomic(obj, fp):
+    """Pickles `obj` to `fp` via a temporary file in the same
+    directory, so that `fp` is never seen partially written.
+    """
+    fd, tmp_fp = tempfile.mkstemp(dir=os.path.dirname(fp), suffix='.tmp')
+    with os.fdopen(fd, 'wb') as f:
+        pickle.dump(obj, f)
+    os.replace(tmp_fp, fp)
+
+
+def queue_status(queue_dir):
+    """Returns a dictionary with the number of tasks in each state."""
+    status = dict()
+    for subdir in SUBDIRS:
+        names = os.listdir(os.path.join(queue_dir, subdir))
+        status[subdir] = len([n for n in names if not n.endswith('.tmp')])
+    return status
+
+
+def enqueue(config, queue_dir):
+    """Writes every task of the sweep defined by dictionary `config` to
+    directory `queue_dir`, which must be empty or not yet exist.
+    Returns the number of tasks.
+    """
+    if os.path.isdir(queue_dir) and os.listdir(queue_dir):
+        raise FileExistsError("Queue directory {} is not empty".format(
+            queue_dir))
+    for subdir in SUBDIRS:
+        os.makedirs(os.path.join(queue_dir, subdir), exist_ok=True)
+
+    tasks, replicates, time_coords = get_tasks(config)
+    with open(os.path.join(queue_dir, 'config.pckl'), 'wb') as f:
+        pickle.dump(config, f)
+    with open(os.path.join(queue_dir, 'manifest.pckl'), 'wb') as f:
+        pickle.dump({'tasks': tasks, 'replicates': replicates,
+                     'time_coords': time_coords}, f)
+    # pending tasks are written last, so that workers never see a task
+    # before the config
+    for task_idx, task in enumerate(tasks):
+        _dump_atomic({'task_index': task_idx, 'task': task, 'attempts': 0},
+                     os.path.join(queue_dir, 'pending', _task_name(task_idx)))
+    print("Enqueued {} tasks in {}".format(len(tasks), queue_dir))
+    return len(tasks)
+
+
+def _claim(queue_dir, claimant):
+    """Claims one pending task, returning the path of the claim, or None
+    if there are no pending tasks left.
+    """
+    pending_dir = os.path.join(queue_dir, 'pending')
+    while True:
+        names = [n for n in os.listdir(pending_dir) if not n.endswith('.tmp')]
+        if not names:
+            return None
+        # workers try tasks in different orders, to avoid contention
+        random.shuffle(names)
+        for name in names:
+            claim_fp = os.path.join(queue_dir, 'claimed',
+                                    name + CLAIM_SEP + claimant)
+            try:
+                os.rename(os.path.join(pending_dir, name), claim_fp)
+            except FileNotFoundError:
+                # claimed by another worker in the meantime
+                continue
+            # rename keeps the mtime of the pending file, but
+            # requeue_stale needs the time of the claim
+            os.utime(claim_fp)
+            return claim_fp
+
+
+def requeue_stale(queue_dir, stale_after):
+    """Moves tasks that were claimed more than `stale_after` seconds ago
+    back to pending, e.g. after the node running them was lost. Returns
+    the number of requeued tasks.
+    """
+    claimed_dir = os.path.join(queue_dir, 'claimed')
+    now = time.time()
+    n_requeued = 0
+    for name in os.listdir(claimed_dir):
+        claim_fp = os.path.join(claimed_dir, name)
+        try:
+            if now - os.path.getmtime(claim_fp) < stale_after:
+                continue
+            os.rename(claim_fp, os.path.join(
+                queue_dir, 'pending', name.split(CLAIM_SEP)[0]))
+        except FileNotFoundError:
+            # finished, or requeued by another worker
+            continue
+        n_requeued += 1
+    if n_requeued:
+        print("Requeued {} stale tasks".format(n_requeued))
+    return n_requeued
+
+
+def _is_running(pid):
+    """Returns True if a process with `pid` is running on this host"""
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # running, as another user
+        return True
+    return True
+
+
+def requeue_dead(queue_dir):
+    """Moves tasks that were claimed by processes on this host which are
+    no longer running back to pending, e.g. after `work` was killed.
+    Tasks claimed on other hosts are left to requeue_stale. Returns the
+    number of requeued tasks.
+    """
+    claimed_dir = os.path.join(queue_dir, 'claimed')
+    host = socket.gethostname()
+    n_requeued = 0
+    for name in os.listdir(claimed_dir):
+        task_name, _, claimant = name.partition(CLAIM_SEP)
+        claim_host, _, pid = claimant.rpartition('.')
+        if claim_host != host or not pid.isdigit() or \
+                _is_running(int(pid)):
+            continue
+        try:
+            os.rename(os.path.join(claimed_dir, name),
+                      os.path.join(queue_dir, 'pending', task_name))
+        except FileNotFoundError:
+            # requeued by another worker
+            continue
+        n_requeued += 1
+    if n_requeued:
+        print("Requeued {} tasks of dead workers on {}".format(
+            n_requeued, host))
+    return n_requeued
+
+
+def _work_loop(args):
+    """Claims and runs tasks from the queue until none are left.
+    Returns the number of tasks that this worker ran.
+    """
+    queue_dir, max_tasks, stale_after = args
+    claimant = "{}.{}".format(socket.gethostname(), os.getpid())
+    with open(os.path.join(queue_dir, 'config.pckl'), 'rb') as f:
+        config = pickle.load(f)
+    retries = config.get('task_retries', 1)
+
+    n_run = 0
+    while max_tasks is None or n_run < max_tasks:
+        claim_fp = _claim(queue_dir, claimant)
+        if claim_fp is None:
+            if stale_after is not None and requeue_stale(queue_dir,
+                                                         stale_after):
+                continue
+            break
+        with open(claim_fp, 'rb') as f:
+            entry = pickle.load(f)
+        task_idx = entry['task_index']
+        entry['attempts'] += 1
+        scenario = to_scenario(entry['task'])
+        scenario['config'] = config
+        try:
+            outcome = simulate_one(scenario)
+        except Exception as err:
+            error = "".join(traceback.format_exception_only(
+                type(err), err)).strip()
+            print("Task {} failed (attempt {}): {}".format(
+                task_idx, entry['attempts'], error))
+            if entry['attempts'] <= retries:
+                _dump_atomic(entry, os.path.join(
+                    queue_dir, 'pending', _task_name(task_idx)))
+            else:
+                failed_fp = os.path.join(queue_dir, 'failed',
+                                         "{:08d}.json".format(task_idx))
+                with open(failed_fp, 'w') as f:
+                    json.dump({'attempts': entry['attempts'],
+                               'error': error}, f)
+        else:
+            save_atomic(os.path.join(queue_dir, 'shards',
+                                     "{:08d}.npy".format(task_idx)), outcome)
+        try:
+            os.remove(claim_fp)
+        except FileNotFoundError:
+            # presumed lost, and requeued by requeue_stale
+            pass
+        n_run += 1
+    return n_run
+
+
+def work(queue_dir, threads=1, max_tasks=None, stale_after=None):
+    """Runs tasks from the queue in `queue_dir` using `threads` worker
+    processes on this host, until no pending tasks are left. Any number
+    of hosts may run `work` on the same (shared) `queue_dir` at once.
+    Each worker process stops after `max_tasks` tasks, if specified. If
+    `stale_after` is specified, tasks claimed more than `stale_after`
+    seconds ago are presumed lost and are run again. Tasks claimed by
+    dead worker processes on this host are requeued first (see
+    requeue_dead). Returns the number of tasks that were run.
+    """
+    requeue_dead(queue_dir)
+    payload = [(queue_dir, max_tasks, stale_after)] * threads
+    if threads == 1:
+        n_run = _work_loop(payload[0])
+    else:
+        with Pool(processes=threads) as pool:
+            n_run = sum(pool.map(_work_loop, payload))
+    print("Ran {} tasks from {}".format(n_run, queue_dir))
+    return n_run
+
+
+def reduce(queue_dir, out_fp=None, allow_incomplete=False):
+    """Writes the shards in `queue_dir` into an OutcomeStore, which is
+    returned. If `out_fp` is specified, outcomes are written to it as
+    a pickled xarray.DataArray, or streamed to a Zarr store if `out_fp`
+    ends with '.zarr', and failed tasks are listed in
+    `<out_fp>.failures.json`. Raises RuntimeError if tasks are still
+    pending or claimed, unless `allow_incomplete`, in which case they
+    are treated as failed.
+    """
+    status = queue_status(queue_dir)
+    if not allow_incomplete and (status['pending'] or status['claimed']):
+        raise RuntimeError(
+            "{} tasks are pending and {} are claimed in {}. ".format(
+                status['pending'], status['claimed'], queue_dir) +
+            "Wait for the workers to finish, or pass allow_incomplete.")
+    with open(os.path.join(queue_dir, 'config.pckl'), 'rb') as f:
+        config = pickle.load(f)
+    with open(os.path.join(queue_dir, 'manifest.pckl'), 'rb') as f:
+        manifest = pickle.load(f)
+
+    tasks = manifest['tasks']
+    replicates = manifest['replicates']
+    store = new_store(tasks, config, out_fp=out_fp)
+    add_outcome = get_outcome_adder(store, config, manifest['time_coords'])
+    failures = dict()
+    for task_idx in range(len(tasks)):
+        shard_fp = os.path.join(queue_dir, 'shards',
+                                "{:08d}.npy".format(task_idx))
+        failed_fp = os.path.join(queue_dir, 'failed',
+                                 "{:08d}.json".format(task_idx))
+        if os.path.isfile(shard_fp):
+            add_outcome(tasks[task_idx],
+                        np.load(shard_fp, allow_pickle=False),
+                        replicates[task_idx])
+        elif os.path.isfile(failed_fp):
+            with open(failed_fp, 'r') as f:
+                failed = json.load(f)
+            failures[task_idx] = (failed['attempts'], failed['error'])
+        else:
+            failures[task_idx] = (0, "not run")
+    record_failures(store, tasks, replicates, failures)
+
+    if out_fp is not None:
+        store.to_file(out_fp=out_fp)
+        if store.failures:
+            store.failures_to_json(out_fp=out_fp + '.failures.json')
+    return store
@@ -4,70 +4,132 @@ import sys
 import numpy as np
 import pickle
 import datetime as dt
-from multiprocessing import Pool
 
-from SEIRcity.scenario import BaseScenario as Scenario
-from SEIRcity.get_scenarios import get_scenarios
+from SEIRcity.scenario import Task, to_scenario
+from SEIRcity.get_scenarios import iter_scenarios
+from SEIRcity.scenario_design import get_design, get_param_dims
 from .simulate_one import simulate_one
+from .worker_pool import get_pool
+from .scheduler import run_tasks
+from .task_cache import TaskCache
 from SEIRcity import param_parser, utils
 from SEIRcity import param as SEIR_param_publish
-from SEIRcity.outcome_handler import OutcomeHandler
+from SEIRcity.outcome_handler import (OutcomeStore, SparseOutcomeStore,
+                                      SummaryOutcomeStore,
+                                      SparseSummaryOutcomeStore)
+from SEIRcity import outcome_io
 
 # DEV
 from SEIRcity import dev_utils
 
+# dims of the array returned by simulate_one
+OUTCOME_DIMS = ('compartment', 'time', 'age_group', 'risk_group')
+# compartments of the array returned by simulate_one, in order
+COMPARTMENTS = ['S', 'E2Iy', 'E2I', 'Iy2Ih', 'H2D', 'Ia', 'Iy', 'Ih', 'R',
+                'E', 'D', 'SchoolCloseArr', 'SchoolReopenArr', 'R0_baseline']
+# number of leading compartments that are time series. The rest are
+# school closure and reopening events (1 at a single step), and R0
+# (constant), which are stored as per-task scalars with config key
+# `compact_outcomes` (see split_events)
+N_SERIES = 11
 
-def multiple_pool(config, threads=48):
-    """Simulate multiple scenarios with multiprocessing support. Given
-    dictionary of parameters `config` from configuration YAML, retrieves
-    a list of unique scenarios from get_scenarios. A multiprocessing.Pool
-    instance with `threads` number of threads is used to generate a list
-    of outcomes (each outcome is a numpy array returned by simulate_one),
-    which is passed to the OutcomeHandler for "compilation" into
-    parameter space. Returns the OutcomeHandler instance.
+
+def _simulate_shared(args):
+    """Runs simulate_one in a worker process. `args` is a tuple of
+    SharedObject referencing the config, and the Task (or Scenario) to
+    simulate.
     """
-    # TODO: validate that slicing by n_sim chunks produces
-    # list of equivalent scenarios (same Scenario objects)
+    shared_config, task = args
+    scenario = to_scenario(task)
+    scenario['config'] = shared_config.resolve()
+    return simulate_one(scenario)
 
-    # get scenarios from yaml_fp
-    scenarios_tup = get_scenarios(config=config)
 
-    # For now, for the sake of output formatting, assert NUM_SIM is
-    # same for all Scenarios. This is checked later by OutcomeHandler
-    n_sims_lst = [s.get("NUM_SIM", None) for s in scenarios_tup]
-    assert len(set(n_sims_lst)) == 1
-    n_sim = n_sims_lst[0]
-    assert n_sim is not None
+def _simulate_indexed(args):
+    """Same as _simulate_shared, but `args` is prepended with the
+    integer task index, which is returned along with the outcome.
+    """
+    task_idx, shared_config, scenario = args
+    return task_idx, _simulate_shared((shared_config, scenario))
+
+
+def derive_seed(entropy, scenario, replicate):
+    """Returns a reproducible uint32 seed for `replicate` of
+    `scenario`, given integer `entropy` (config key `seed`). The seed
+    does not depend on the other scenarios in the sweep, so adding
+    scenarios or replicates to a config does not change the seeds of
+    existing tasks.
+    """
+    scenario_params = {k: v for k, v in scenario.items()
+                       if k not in ('config', 'NUM_SIM', 'verbosity')}
+    scenario_int = int(utils.fingerprint(scenario_params)[:15], 16)
+    seed_seq = np.random.SeedSequence([int(entropy), scenario_int,
+                                       int(replicate)])
+    return seed_seq.generate_state(1)[0]
+
+
+def get_time_coords(scenario):
+    """Returns datetime64 coords of the 'time' dim of the outcome of
+    `scenario`.
+    """
+    return utils.get_dt64_coords(
+        time_begin_sim=scenario['time_begin_sim'],
+        total_time=scenario['total_time'],
+        shift_week=scenario['shift_week'],
+        interval_per_day=scenario['interval_per_day'])
 
-    # get datetime64 coords for 'time' dimension
-    first_s = scenarios_tup[0]
-    time_coords = utils.get_dt64_coords(
-        time_begin_sim=first_s['time_begin_sim'],
-        total_time=first_s['total_time'],
-        shift_week=first_s['shift_week'],
-        interval_per_day=first_s['interval_per_day'])
 
-    # New OutcomeHandler
-    oh = OutcomeHandler()
+def get_tasks(config):
+    """Returns a tuple of (tasks, replicates, time_coords) for the sweep
+    defined by dictionary `config`. `tasks` is a list of
+    scenario.Task records, one for each replicate of each point of the
+    scenario design (see scenario_design.get_design), which share the
+    Scenario of the point instead of copying it, and `replicates` is
+    the replicate number of each task. Each task has a `seed`, but no
+    `config`. If the design sweeps the start of the simulation
+    (`time_begin_sim` or `shift_week`), `time_coords` is the time
+    elapsed since the start of each simulation, since it differs
+    between scenarios.
+    """
+    design = get_design(config)
+    n_sim = config.get('NUM_SIM', None)
+    assert n_sim is not None
 
     # generate int64 seeds for each thread
-    expected_n_tasks = n_sim * len(scenarios_tup)
+    expected_n_tasks = n_sim * len(design)
     if expected_n_tasks < 4:
         pool_size = 4
     else:
         pool_size = expected_n_tasks
     seed_gen = np.random.SeedSequence(pool_size=pool_size)
+    # seeds are only reproducible between runs if config has a `seed`
+    entropy = config.get('seed', None)
 
-    # generate list of tasks (Scenario objects with NUM_SIM replicates)
+    # generate list of tasks (NUM_SIM replicates of each Scenario).
+    # Scenarios are made one point at a time, from the design
     tasks = list()
+    replicates = list()
+    starts = set()
+    time_coords = None
     task_idx = 0
-    for unique_scenario in scenarios_tup:
+    for unique_scenario in iter_scenarios(config, design=design):
+        start = (unique_scenario['time_begin_sim'],
+                 unique_scenario['shift_week'])
+        if start not in starts:
+            starts.add(start)
+            if time_coords is None:
+                time_coords = get_time_coords(unique_scenario)
         for replicate in range(n_sim):
-            task = Scenario(unique_scenario.copy())
-            task['config'] = config
-            task['seed'] = seed_gen.pool[task_idx]
-            tasks.append(task)
+            if entropy is None:
+                seed = seed_gen.pool[task_idx]
+            else:
+                seed = derive_seed(entropy, unique_scenario, replicate)
+            tasks.append(Task(unique_scenario, replicate=replicate,
+                              seed=seed))
+            replicates.append(replicate)
             task_idx += 1
+    if len(starts) > 1:
+        time_coords = time_coords - time_coords[0]
 
     # assert that the number of tasks equals number of
     # unique scenarios times the number of replicates
@@ -77,26 +139,243 @@ def multiple_pool(config, threads=48):
             "Assigned {} tasks but expected ".format(n_tasks) +
             "{} (number unique scenarios ".format(expected_n_tasks) +
             "* replicates (AKA NUM_SIM) = " +
-            "{} * {} = {}).".format(len(scenarios_tup), n_sim, expected_n_tasks))
+            "{} * {} = {}).".format(len(design), n_sim, expected_n_tasks))
+
+    return tasks, replicates, time_coords
+
+
+def get_outcome_coords(time_coords, compact=False):
+    """Returns coords of the outcome returned by simulate_one, which has
+    dims OUTCOME_DIMS, given datetime64 `time_coords` from get_tasks.
+    If `compact`, only the time series compartments (see split_events).
+    """
+    return dict({
+        # TODO: ingest these dynamically
+        'compartment': COMPARTMENTS[:N_SERIES] if compact
+        else list(COMPARTMENTS),
+        'age_group': ['0-4', '5-17', '18-49', '50-64', '65+'],
+        'time': time_coords
+    })
+
+
+def split_events(outcome, time_coords):
+    """Splits `outcome` returned by simulate_one into its time series
+    compartments, and a dictionary of per-task scalars: the step index
+    (-1 if it did not happen) and date (NaT) of school closure and
+    reopening, and R0 (NaN if it was not computed). Dates are elapsed
+    times if `time_coords` are (see get_tasks).
+    """
+    scalars = dict()
+    times = np.asarray(time_coords)
+    for name, idx in (('school_close', N_SERIES),
+                      ('school_reopen', N_SERIES + 1)):
+        steps = np.flatnonzero(outcome[idx, :, 0, 0] == 1.)
+        step = int(steps[0]) if len(steps) else -1
+        scalars[name + '_step'] = step
+        scalars[name + '_date'] = times[step] if step >= 0 \
+            else np.array('NaT', dtype=times.dtype)[()]
+    scalars['R0'] = float(outcome[N_SERIES + 2, 0, 0, 0])
+    return outcome[:N_SERIES], scalars
+
+
+def get_outcome_adder(store, config, time_coords):
+    """Returns function `add(task, outcome, replicate)`, which adds
+    `outcome` of `task` returned by simulate_one to OutcomeStore
+    `store`. If config key `compact_outcomes` is true, the event and
+    R0 compartments are stored as per-task scalar coords instead (see
+    split_events), which makes outcomes about 20% smaller.
+    """
+    compact = bool(config.get('compact_outcomes', False))
+    coords = get_outcome_coords(time_coords, compact=compact)
+
+    def add(task, outcome, replicate):
+        scalars = None
+        if compact:
+            outcome, scalars = split_events(outcome, time_coords)
+        store.add_outcome(task, outcome, dims=OUTCOME_DIMS, coords=coords,
+                          replicate=replicate, scalars=scalars)
+    return add
 
-    # run simulate_one for each task
-    with Pool(processes=threads) as pool:
-        outcomes_flat_lst = pool.map(simulate_one, tasks)
 
-    # load flat outcomes list into the OutcomeHandler
-    assert len(tasks) == len(outcomes_flat_lst)
-    for task_idx in range(len(tasks)):
+def new_store(tasks, config, out_fp=None):
+    """Returns an empty OutcomeStore spanning the parameter space of
+    list `tasks` from get_tasks. Outcomes of tasks are added with
+    store.add_outcome as they become available. If config key
+    `sparse_outcomes` is true, a SparseOutcomeStore is returned, which
+    only allocates the scenarios in `tasks`. If config key
+    `summary_outcomes` is true, or a dictionary of keyword arguments to
+    SummaryOutcomeStore (e.g. compartments, time_freq), only summary
+    statistics of the replicates of each scenario are kept, in memory
+    even if `out_fp` is a Zarr store. Otherwise, if `out_fp` is a Zarr
+    store (ends with '.zarr'), outcomes are written to it as they are
+    added, instead of being held in memory (see outcome_io). `config`
+    is kept as `store.config`, and is not set on the tasks.
+
+    Param dims are those of OutcomeStore, and any other key swept by
+    config key `scenario_design`. Unless `sparse_outcomes` is set,
+    designs that are not grids (e.g. Latin hypercubes) use sparse
+    stores, since most points of their dense grid would be empty.
+    """
+    design = get_design(config)
+    sparse = config.get('sparse_outcomes', None)
+    if sparse is None:
+        sparse = not design.is_grid
+    kwargs = {'param_dims': get_param_dims(config)}
+    summary = config.get('summary_outcomes', None)
+    if summary:
+        if isinstance(summary, dict):
+            kwargs.update(summary)
+        if out_fp is not None and outcome_io.is_zarr(out_fp):
+            print("WARNING: summary_outcomes are held in memory, and " +
+                  "written to {} when done instead of ".format(out_fp) +
+                  "as they are added")
+        if sparse:
+            store = SparseSummaryOutcomeStore(tasks, **kwargs)
+        else:
+            store = SummaryOutcomeStore(tasks, **kwargs)
+    elif out_fp is not None and outcome_io.is_zarr(out_fp):
+        if sparse:
+            store = outcome_io.SparseZarrOutcomeStore(tasks, out_fp=out_fp,
+                                                      **kwargs)
+        else:
+            store = outcome_io.ZarrOutcomeStore(tasks, out_fp=out_fp,
+                                                **kwargs)
+    elif sparse:
+        store = SparseOutcomeStore(tasks, **kwargs)
+    else:
+        store = OutcomeStore(tasks, **kwargs)
+    # the config is kept by the store, not by the tasks, which are sent
+    # to the workers without it (see multiple_pool)
+    store.config = config
+    return store
+
+
+def record_failures(store, tasks, replicates, failures):
+    """Lists the tasks in dictionary `failures`, which maps the index of
+    each task that failed to a tuple of (attempts, error), in the
+    failure manifest `store.failures`. The outcomes of these tasks are
+    left as NaN. Raises RuntimeError if no task succeeded.
+    """
+    if store.n_filled == 0:
+        raise RuntimeError("All {} tasks failed. First error: {}".format(
+            len(tasks), failures[min(failures.keys())][1]
+            if failures else None))
+    for task_idx in sorted(failures.keys()):
+        attempts, error = failures[task_idx]
         scenario = tasks[task_idx]
-        outcome = outcomes_flat_lst[task_idx]
-        dims = ('compartment', 'time', 'age_group', 'risk_group')
-        coords = dict({
-            # TODO: ingest these dynamically
-            'compartment': ['S', 'E2Iy', 'E2I', 'Iy2Ih', 'H2D', 'Ia',
-                            'Iy', 'Ih', 'R', 'E', 'D', 'SchoolReopenArr',
-                            'SchoolCloseArr', 'R0_baseline'],
-            'age_group': ['0-4', '5-17', '18-49', '50-64', '65+'],
-            'time': time_coords
-        })
-        oh.add_outcome(scenario, outcome, dims=dims, coords=coords)
-    oh._compile()
-    return oh
+        store.failures.append({
+            'task_index': task_idx,
+            'replicate': replicates[task_idx],
+            'seed': int(scenario['seed']),
+            'scenario': {k: scenario[k] for k in store.param_dims
+                         if k in scenario},
+            'attempts': attempts,
+            'error': error})
+    if store.failures:
+        print("WARNING: {} of {} tasks failed, and were filled with NaN"
+              .format(len(store.failures), len(tasks)))
+
+
+def multiple_pool(config, threads=48, pool=None, cache_dir=None,
+                  timeout=None, retries=None, out_fp=None):
+    """Simulate multiple scenarios with multiprocessing support. Given
+    dictionary of parameters `config` from configuration YAML, retrieves
+    a list of unique scenarios from get_scenarios. A WorkerPool
+    instance `pool` is used to generate outcomes (each outcome is a
+    numpy array returned by simulate_one), which are written into an
+    OutcomeStore spanning the parameter space. If `pool` is
+    None, the process-wide WorkerPool with `threads` number of threads
+    is used (see worker_pool.get_pool), so that repeated calls reuse
+    the same worker processes. If `cache_dir` (or config key
+    `cache_dir`) is set, every outcome is persisted in a TaskCache as
+    soon as it is received, and tasks already in the cache are not
+    simulated again.
+
+    A task that raises, runs longer than `timeout` seconds (config key
+    `task_timeout`), or whose worker process dies, is retried on a fresh
+    worker up to `retries` times (config key `task_retries`, default 1).
+    Each worker is sent config key `chunksize` tasks at a time (default
+    1; see plan.plan_sweep).
+    Tasks that still fail are filled with NaN, and are listed in the
+    failure manifest `oh.failures`. Returns an OutcomeStore, into which
+    each outcome was written in place as it arrived. If `out_fp` is a
+    Zarr store, each outcome is written to disk instead (see new_store);
+    call `to_file(out_fp)` or `close` on the returned store when done.
+    """
+    tasks, replicates, time_coords = get_tasks(config)
+    n_tasks = len(tasks)
+
+    # run simulate_one for each task. The config is written to disk
+    # once and loaded at most once by each worker, instead of being
+    # pickled along with every task
+    if pool is None:
+        pool = get_pool(threads)
+    shared_config = pool.share(config)
+
+    # outcomes are written in place into the store as they arrive
+    store = new_store(tasks, config, out_fp=out_fp)
+    add_task_outcome = get_outcome_adder(store, config, time_coords)
+
+    def add_outcome(task_idx, outcome):
+        add_task_outcome(tasks[task_idx], outcome, replicates[task_idx])
+
+    # load outcomes of tasks that already ran from the TaskCache
+    done = [False] * n_tasks
+    if cache_dir is None:
+        cache_dir = config.get('cache_dir', None)
+    if cache_dir is None:
+        cache = None
+        keys = [None] * n_tasks
+    else:
+        cache = TaskCache(cache_dir)
+        if config.get('seed', None) is None and \
+                not config.get('deterministic', False):
+            print("WARNING: config has no `seed`, so stochastic tasks " +
+                  "cannot be reused from cache_dir in later runs")
+        keys = [cache.key(task, config, replicate=replicate)
+                for task, replicate in zip(tasks, replicates)]
+        for task_idx, key in enumerate(keys):
+            outcome = cache.get(key)
+            if outcome is not None:
+                add_outcome(task_idx, outcome)
+                done[task_idx] = True
+
+    # tasks that share a key (e.g. deterministic replicates) run once
+    todo = dict()
+    for task_idx in range(n_tasks):
+        if not done[task_idx]:
+            todo.setdefault(keys[task_idx] or task_idx, list()).append(task_idx)
+    if cache is not None:
+        print("Loaded {} of {} tasks from {}".format(
+            n_tasks - sum([len(v) for v in todo.values()]), n_tasks,
+            cache_dir))
+
+    # run simulate_one for each remaining task, persisting each
+    # outcome as soon as it arrives
+    if timeout is None:
+        timeout = config.get('task_timeout', None)
+    if retries is None:
+        retries = config.get('task_retries', 1)
+    payload = [(same[0], shared_config, tasks[same[0]])
+               for same in todo.values()]
+
+    def on_result(payload_idx, result):
+        task_idx, outcome = result
+        key = keys[task_idx]
+        if cache is not None:
+            cache.put(key, outcome)
+        for same_idx in todo[key or task_idx]:
+            add_outcome(same_idx, outcome)
+
+    _, failed = run_tasks(pool, _simulate_indexed, payload, timeout=timeout,
+                          retries=retries, on_result=on_result,
+                          chunksize=config.get('chunksize', 1))
+
+    # failed tasks are filled with NaN, and recorded in the manifest
+    failures = dict()
+    for failure in failed:
+        task_idx = payload[failure['task_index']][0]
+        for same_idx in todo[keys[task_idx] or task_idx]:
+            failures[same_idx] = (failure['attempts'], failure['error'])
+    record_failures(store, tasks, replicates, failures)
+    return store
@@ -52,8 +52,8 @@ def multiple_serial(config):
             dims = ('compartment', 'time', 'age_group', 'risk_group')
             coords = dict({
                 'compartment': ['S', 'E2Iy', 'E2I', 'Iy2Ih', 'H2D', 'Ia',
-                                'Iy', 'Ih', 'R', 'E', 'D', 'SchoolReopenArr',
-                                'SchoolCloseArr', 'R0_baseline'],
+                                'Iy', 'Ih', 'R', 'E', 'D', 'SchoolCloseArr',
+                                'SchoolReopenArr', 'R0_baseline'],
                 'age_group': ['0-4', '5-17', '18-49', '50-64', '65+'],
                 'time': time_coords
             })
@@ -0,0 +1,199 @@
+#!/usr/bin/env python
+import os
+import json
+import math
+from time import time
+
+import numpy as np
+
+from SEIRcity.scenario import to_scenario
+from SEIRcity import utils
+from SEIRcity.scenario_design import get_design, get_param_dims
+from .simulate_one import simulate_one
+from .multiple_pool import get_tasks, COMPARTMENTS, N_SERIES
+
+# number of arrays returned by simulate_one (see its return statement)
+N_COMPARTMENTS = len(COMPARTMENTS)
+# bytes per element of the compiled outcomes (float64)
+ITEMSIZE = np.dtype(float).itemsize
+# stream to disk if the estimated peak memory exceeds this fraction
+# of the memory on the host
+MAX_MEMORY_FRACTION = 0.5
+# target seconds of work per chunk of tasks sent to a worker
+TARGET_CHUNK_SECONDS = 1.
+# recommend sparse_outcomes if less than this fraction of the dense
+# outcomes array would be filled
+MIN_FILL_FRACTION = 0.5
+
+
+def get_host_memory():
+    """Returns total physical memory of this host in bytes, or None if
+    it cannot be determined.
+    """
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    except (ValueError, AttributeError, OSError):
+        return None
+
+
+def _format_bytes(n_bytes):
+    for unit in ('B', 'KiB', 'MiB', 'GiB'):
+        if n_bytes < 1024.:
+            return "{:.1f} {}".format(n_bytes, unit)
+        n_bytes /= 1024.
+    return "{:.1f} TiB".format(n_bytes)
+
+
+def plan_sweep(config, threads=48, calibrate=True, memory=None):
+    """Estimates the cost of the sweep defined by dictionary `config`,
+    without running it. Enumerates the tasks that multiple_pool would
+    run, estimates the size of the compiled outcomes and the peak memory
+    of compiling them, and (if `calibrate`) times one simulation of the
+    first scenario to estimate wall time on `threads` threads. `memory`
+    is the memory available to the job in bytes, and defaults to the
+    physical memory of this host.
+
+    Returns a dictionary with the estimates, and the recommended number
+    of `threads`, `chunksize` (tasks per worker round trip), whether
+    to `stream_to_disk` instead of holding all outcomes in memory, and
+    whether to store `sparse_outcomes` (config key of the same name).
+    """
+    tasks, replicates, time_coords = get_tasks(config)
+    n_tasks = len(tasks)
+    n_sim = max(replicates) + 1
+    # deterministic replicates are identical, and are simulated once
+    # (see multiple_pool)
+    deterministic = bool(config.get('deterministic', False))
+    n_runs = n_tasks // n_sim if deterministic else n_tasks
+
+    # shape of the compiled outcomes, from the output schema. With
+    # compact_outcomes, events and R0 are scalars (see split_events)
+    if config.get('compact_outcomes', False):
+        n_compartments = N_SERIES
+    else:
+        n_compartments = N_COMPARTMENTS
+    param_dims = get_param_dims(config)
+    dim_sizes = dict()
+    for dim in param_dims:
+        dim_sizes[dim] = len(set([task[dim] for task in tasks]))
+    dim_sizes['replicate'] = n_sim
+    dim_sizes['compartment'] = n_compartments
+    dim_sizes['time'] = len(time_coords)
+    dim_sizes['age_group'] = config['n_age']
+    dim_sizes['risk_group'] = config['n_risk']
+    task_bytes = n_compartments * len(time_coords) * config['n_age'] * \
+        config['n_risk'] * ITEMSIZE
+    output_bytes = int(np.prod(list(dim_sizes.values()))) * ITEMSIZE
+    # fraction of the dense N-D array that is filled with outcomes
+    fill_fraction = float(n_tasks * task_bytes) / output_bytes
+    sparse_output_bytes = n_tasks * task_bytes
+    # designs that are not grids are stored sparse (see new_store)
+    sparse_outcomes = config.get('sparse_outcomes', None)
+    if sparse_outcomes is None:
+        sparse_outcomes = not get_design(config).is_grid
+    sparse_outcomes = bool(sparse_outcomes)
+
+    # peak memory of multiple_pool: the array that outcomes are written
+    # into (OutcomeStore or SparseOutcomeStore), and its pickled copy.
+    # Zarr output (outcome_io) holds only the chunks being written
+    if sparse_outcomes:
+        peak_bytes = 2 * sparse_output_bytes
+    else:
+        peak_bytes = 2 * output_bytes
+
+    if memory is None:
+        memory = get_host_memory()
+    cpu_count = os.cpu_count() or 1
+
+    # time one simulation of the first scenario
+    seconds_per_task = None
+    if calibrate:
+        task = to_scenario(tasks[0])
+        task['config'] = config
+        start = time()
+        simulate_one(task)
+        seconds_per_task = time() - start
+
+    # recommendations
+    rec_threads = max(1, min(threads, n_runs, cpu_count))
+    if seconds_per_task is None or seconds_per_task <= 0:
+        rec_chunksize = 1
+    else:
+        rec_chunksize = min(
+            int(math.ceil(TARGET_CHUNK_SECONDS / seconds_per_task)),
+            n_runs // (4 * rec_threads))
+        rec_chunksize = max(1, rec_chunksize)
+    if memory is None:
+        stream_to_disk = False
+    else:
+        stream_to_disk = peak_bytes > MAX_MEMORY_FRACTION * memory
+    if seconds_per_task is None:
+        wall_seconds = None
+    else:
+        wall_seconds = int(math.ceil(float(n_runs) / rec_threads)) * \
+            seconds_per_task
+
+    return {
+        'n_scenarios': n_tasks // n_sim,
+        'n_replicates': n_sim,
+        'n_tasks': n_tasks,
+        'n_simulations': n_runs,
+        'dim_sizes': dim_sizes,
+        'task_bytes': task_bytes,
+        'output_bytes': output_bytes,
+        'sparse_output_bytes': sparse_output_bytes,
+        'fill_fraction': fill_fraction,
+        'peak_memory_bytes': peak_bytes,
+        'host_memory_bytes': memory,
+        'cpu_count': cpu_count,
+        'seconds_per_task': seconds_per_task,
+        'estimated_wall_seconds': wall_seconds,
+        'threads': rec_threads,
+        'chunksize': rec_chunksize,
+        'stream_to_disk': stream_to_disk,
+        'sparse_outcomes': fill_fraction < MIN_FILL_FRACTION,
+    }
+
+
+def print_plan(plan):
+    """Prints a human readable summary of dictionary `plan`, as returned
+    by plan_sweep.
+    """
+    print("Sweep plan")
+    print("  scenarios:        {}".format(plan['n_scenarios']))
+    print("  replicates:       {}".format(plan['n_replicates']))
+    print("  tasks:            {} ({} simulations)".format(
+        plan['n_tasks'], plan['n_simulations']))
+    print("  output shape:     {}".format(", ".join(
+        ["{}: {}".format(k, v) for k, v in plan['dim_sizes'].items()])))
+    print("  output size:      {} ({:.0%} filled), or {} sparse".format(
+        _format_bytes(plan['output_bytes']), plan['fill_fraction'],
+        _format_bytes(plan['sparse_output_bytes'])))
+    print("  peak memory:      {}".format(
+        _format_bytes(plan['peak_memory_bytes'])))
+    if plan['host_memory_bytes'] is not None:
+        print("  host memory:      {}".format(
+            _format_bytes(plan['host_memory_bytes'])))
+    if plan['seconds_per_task'] is not None:
+        print("  seconds per task: {:.2f}".format(plan['seconds_per_task']))
+        print("  est. wall time:   {:.1f} min on {} threads".format(
+            plan['estimated_wall_seconds'] / 60., plan['threads']))
+    print("Recommended")
+    print("  --threads {}".format(plan['threads']))
+    print("  chunksize: {} (config key)".format(plan['chunksize']))
+    if plan['stream_to_disk']:
+        print("  stream to disk: peak memory exceeds {:.0%} of host memory;"
+              .format(MAX_MEMORY_FRACTION) +
+              " use an --out-fp ending in .zarr, set `cache_dir`, or" +
+              " use --mode enqueue")
+    else:
+        print("  stream to disk: not needed")
+    if plan['sparse_outcomes']:
+        print("  sparse_outcomes: true")
+
+
+def plan_to_json(plan, out_fp):
+    """Writes dictionary `plan` as JSON to output filepath `out_fp`."""
+    print("Writing sweep plan to: {}".format(out_fp))
+    with open(out_fp, 'w') as f:
+        json.dump(plan, f, indent=2, default=utils.to_builtin)
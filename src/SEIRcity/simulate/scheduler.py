@@ -0,0 +1,213 @@
+#!/usr/bin/env python
+import os
+import time
+import queue
+import traceback
+from collections import deque
+from multiprocessing import Manager
+
+
+def _worker_pids(pool):
+    """Returns the set of process IDs of the workers in WorkerPool
+    `pool`. multiprocessing.Pool silently replaces workers that die
+    (e.g. at the hands of the OOM killer), so a change in this set means
+    that a worker was lost.
+    """
+    return set([p.pid for p in pool.pool._pool])
+
+
+def _run_chunk(args):
+    """Runs `func` on each of `args` in a worker process. Before each
+    task, puts its generation and index, the process ID of the worker,
+    and the time on queue `started`, so that run_tasks knows which task
+    a worker that died or hung was running. Returns list of tuples of
+    the result of each task and None, or None and the exception it
+    raised, so that one failed task does not fail the others.
+    """
+    func, chunk_args, gen, chunk, started = args
+    results = list()
+    for arg, idx in zip(chunk_args, chunk):
+        started.put((gen, idx, os.getpid(), time.time()))
+        try:
+            results.append((func(arg), None))
+        except Exception as err:
+            results.append((None, err))
+    return results
+
+
+def run_tasks(pool, func, payload, timeout=None, retries=1,
+              on_result=None, verbosity=1, chunksize=1):
+    """Fault-tolerant replacement for `pool.map(func, payload)`. Runs
+    `func` on every element of sequence `payload` using WorkerPool
+    `pool`, with at most one chunk of `chunksize` tasks in flight per
+    worker. Larger chunks save a round trip per task for short tasks.
+
+    A task that raises an exception, runs longer than `timeout` seconds,
+    or was running on a worker that died, is retried up to `retries`
+    times. Timeouts and dead workers restart the worker processes, so
+    that retries run on a fresh worker. The other tasks interrupted by a
+    restart are run again without counting an attempt. Tasks that fail
+    every attempt do not interrupt the other tasks; they are reported in
+    the returned failure manifest instead.
+
+    If specified, `on_result(index, result)` is called in this process
+    as soon as the chunk of the task at `index` in `payload` succeeds.
+
+    Returns a tuple of (results, failures): `results` is a list with
+    the return value of each task (None for failed tasks), and
+    `failures` is a list of dictionaries with keys `task_index`,
+    `attempts`, and `error`, sorted by task_index.
+    """
+    assert isinstance(chunksize, int) and chunksize > 0, \
+        "arg `chunksize` must be a positive integer, not {}".format(chunksize)
+    n_tasks = len(payload)
+    results = [None] * n_tasks
+    attempts = [0] * n_tasks
+    failures = dict()
+    pending = deque(range(n_tasks))
+    # tasks submitted and not yet returned, and the number of chunks
+    # they were submitted in
+    running = set()
+    n_chunks = [0]
+    # task index -> start time of the tasks running now, and worker
+    # process ID -> index of the task it is running, as reported by the
+    # workers
+    start_of = dict()
+    task_of = dict()
+    # completed chunks are put here by the Pool's result handler thread
+    done = queue.Queue()
+    # tasks submitted to a Pool that was since restarted report to an
+    # obsolete generation, and are ignored
+    generation = [0]
+    # workers report the task they start here (see _run_chunk)
+    manager = Manager()
+    started = manager.Queue()
+
+    def submit(chunk):
+        gen = generation[0]
+        for idx in chunk:
+            attempts[idx] += 1
+            running.add(idx)
+        n_chunks[0] += 1
+        pool.pool.apply_async(
+            _run_chunk, ((func, [payload[idx] for idx in chunk], gen,
+                          chunk, started),),
+            callback=lambda r: done.put((gen, chunk, r, None)),
+            error_callback=lambda e: done.put((gen, chunk, None, e)))
+
+    def fail_or_retry(idx, error):
+        running.discard(idx)
+        start_of.pop(idx, None)
+        if attempts[idx] <= retries:
+            if verbosity:
+                print("Retrying task {} (attempt {} failed: {})".format(
+                    idx, attempts[idx], error))
+            pending.append(idx)
+        else:
+            failures[idx] = {
+                'task_index': idx,
+                'attempts': attempts[idx],
+                'error': error}
+            if verbosity:
+                print("Task {} failed after {} attempts: {}".format(
+                    idx, attempts[idx], error))
+
+    def restart(reason):
+        """Kill every worker and requeue the tasks they were running."""
+        if verbosity:
+            print("Restarting worker processes: {}".format(reason))
+        pool.terminate()
+        generation[0] += 1
+        n_chunks[0] = 0
+        start_of.clear()
+        task_of.clear()
+        for idx in sorted(running, reverse=True):
+            # tasks interrupted by the restart get their attempt back
+            attempts[idx] -= 1
+            pending.appendleft(idx)
+        running.clear()
+
+    def update_started():
+        """Records the start time and worker of each task that started.
+        A worker that starts a task has finished the task before it in
+        its chunk, which no longer counts toward the timeout.
+        """
+        while True:
+            try:
+                gen, idx, pid, start = started.get_nowait()
+            except queue.Empty:
+                return
+            if gen != generation[0]:
+                continue
+            start_of.pop(task_of.get(pid), None)
+            if idx in running:
+                start_of[idx] = start
+                task_of[pid] = idx
+
+    def format_error(err):
+        return "".join(traceback.format_exception_only(
+            type(err), err)).strip()
+
+    pids = None
+    try:
+        while pending or running:
+            while pending and n_chunks[0] < pool.threads:
+                submit([pending.popleft()
+                        for _ in range(min(chunksize, len(pending)))])
+            if pids is None:
+                pids = _worker_pids(pool)
+            try:
+                gen, chunk, chunk_results, err = done.get(timeout=0.1)
+            except queue.Empty:
+                gen = None
+            if gen is not None and gen == generation[0]:
+                n_chunks[0] -= 1
+                if err is not None:
+                    # e.g. the results could not be pickled
+                    chunk_results = [(None, err)] * len(chunk)
+                for idx, (result, task_err) in zip(chunk, chunk_results):
+                    if idx not in running:
+                        continue
+                    if task_err is None:
+                        running.discard(idx)
+                        start_of.pop(idx, None)
+                        results[idx] = result
+                        if on_result is not None:
+                            on_result(idx, result)
+                    else:
+                        fail_or_retry(idx, format_error(task_err))
+                continue
+
+            # a worker was lost: only the task it was running counts as
+            # a failed attempt
+            update_started()
+            dead = pids - _worker_pids(pool)
+            if dead:
+                lost = [task_of[pid] for pid in dead if pid in task_of and
+                        task_of[pid] in running]
+                restart("worker process died")
+                pids = None
+                for idx in lost:
+                    attempts[idx] += 1
+                    pending.remove(idx)
+                    fail_or_retry(idx, "worker process died")
+                continue
+
+            # tasks that exceeded the timeout
+            if timeout is not None:
+                now = time.time()
+                timed_out = [idx for idx, start in start_of.items()
+                             if now - start > timeout]
+                if timed_out:
+                    restart("{} task(s) exceeded timeout of {} s".format(
+                        len(timed_out), timeout))
+                    pids = None
+                    for idx in timed_out:
+                        attempts[idx] += 1
+                        pending.remove(idx)
+                        fail_or_retry(idx, "timed out after {} s".format(
+                            timeout))
+    finally:
+        manager.shutdown()
+
+    return results, [failures[idx] for idx in sorted(failures.keys())]
@@ -17,15 +17,21 @@ from . import multiple_serial, multiple_pool
 from SEIRcity import dev_utils
 
 
-def simulate_multiple(config, out_fp=None, threads=48, verbosity=0):
-    """"""
+def simulate_multiple(config, out_fp=None, threads=48, verbosity=0,
+                      pool=None):
+    """Run every scenario in `config` in parallel, and write outcomes to
+    `out_fp`. Pass a WorkerPool instance `pool` to reuse its worker
+    processes between calls; otherwise the process-wide WorkerPool with
+    `threads` number of threads is used. If `out_fp` ends with '.zarr',
+    outcomes are streamed to a chunked, compressed Zarr store as they
+    arrive, and a lazily loaded DataArray is returned (see outcome_io);
+    otherwise they are written as a pickled xarray.DataArray. If any
+    tasks failed, their manifest is written to
+    `<out_fp>.failures.json`.
+    """
     # pull parameters from config YAML file `yaml_fp`
     #config = param_module.aggregate_params_and_data(yaml_fp=yaml_fp)
 
-    # run Scenarios in parallel, returning an instance of OutcomeHandler
-    oh = multiple_pool(config=config, threads=threads)
-
-    # write outcomes to pickled xarray.DataArray
     if out_fp is None:
         raise ValueError('Output file path not provided.')
         # basename for output filepath
@@ -33,7 +39,15 @@ def simulate_multiple(config, out_fp=None, threads=48, verbosity=0):
         #out_fp = os.path.join("outputs",  basename + ".pckl")
     #else:
     #    basename = os.path.splitext(os.path.basename(out_fp))[0]
-    oh.to_pickle(out_fp=out_fp)
+
+    # run Scenarios in parallel, returning an instance of OutcomeHandler
+    oh = multiple_pool(config=config, threads=threads, pool=pool,
+                       out_fp=out_fp)
+
+    # write outcomes to Zarr store or pickled xarray.DataArray
+    oh.to_file(out_fp=out_fp)
+    if oh.failures:
+        oh.failures_to_json(out_fp=out_fp + '.failures.json')
 
     # write to CSV as well, in the same directory
     # csv_fp = os.path.join(os.path.dirname(out_fp), basename + '.csv')
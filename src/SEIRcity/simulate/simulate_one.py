@@ -4,7 +4,8 @@ from SEIRcity import model
 from SEIRcity.utils import R0_arr_to_float, assert_has_keys
 from SEIRcity.get_phi import get_phi
 from SEIRcity.scenario import BaseScenario
-from SEIRcity.param import SEIR_get_param
+from SEIRcity.param import SEIR_get_param, EPI_PARAM_KEYS, \
+    override_epi_params
 
 # DEV
 from SEIRcity.dev_utils import base_decorator
@@ -14,6 +15,58 @@ def simulate_one(scenario):
     """Given an instance of BaseScenario `scenario`, run a simulation
     using the SEIR model. Returns a stacked numpy array.
     """
+    S, E, Ia, Iy, Ih, R, D, E2Iy, E2I, Iy2Ih, H2D, SchoolCloseTime, \
+        SchoolReopenTime = run_model(scenario)
+
+    compute_R0 = bool(scenario['c_reduction'] == 0 and
+                          scenario['close_trigger'].split('_')[-1] == '20220101')
+    if compute_R0:
+        R0_float = model.compute_R0(E2I, scenario['interval_per_day'],
+                                    scenario['Para'], scenario['g_rate'])
+        R0 = R0_float * np.ones_like(E2Iy)
+    else:
+        R0 = np.nan * np.ones_like(E2Iy)
+
+    return np.stack([
+            S,
+            E2Iy,
+            E2I,
+            Iy2Ih,
+            H2D,
+            Ia,
+            Iy,
+            Ih,
+            R,
+            E,
+            D,
+            SchoolCloseTime,
+            SchoolReopenTime,
+            R0
+        ], axis=0)
+
+
+def simulate_hosp(scenario, n_days=None):
+    """Same as simulate_one, but only simulates the first `n_days` days
+    (all of `total_time` by default), and only returns the
+    hospitalized (Ih) compartment at the first step of each day, an
+    array of shape (n_days, n_age, n_risk). These are the same as in
+    the outcome of simulate_one, e.g. for fitting to daily data that
+    covers the first weeks of a much longer `total_time`.
+    """
+    interval_per_day = scenario['interval_per_day']
+    n_steps = None
+    if n_days is not None:
+        # the first step of the last day
+        n_steps = (n_days - 1) * interval_per_day + 1
+    Ih = run_model(scenario, n_steps=n_steps)[4]
+    return Ih[::interval_per_day][:n_days]
+
+
+def run_model(scenario, n_steps=None):
+    """Runs the SEIR model for BaseScenario `scenario`, for `n_steps`
+    time steps if specified. Returns the tuple of compartments returned
+    by model.SEIR_model_publish_w_risk.
+    """
     assert isinstance(scenario, BaseScenario), "arg `scenario` is type " + \
         "{}, must be an instance of scenario.BaseScenario".format(type(scenario))
 
@@ -23,8 +76,13 @@ def simulate_one(scenario):
     # print("seed is: {}".format(seed))
     np.random.seed(seed)
 
-    # get epi parameters
-    scenario.update(SEIR_get_param(scenario['config']))
+    # get epi parameters. Those swept by the scenario design override
+    # the config
+    config = scenario['config']
+    overrides = {k: scenario[k] for k in EPI_PARAM_KEYS if k in scenario}
+    if overrides:
+        config = override_epi_params(config, overrides)
+    scenario.update(SEIR_get_param(config))
 
     # ------------------------------------------------------------------
 
@@ -76,34 +134,8 @@ def simulate_one(scenario):
     }
 
     # run model
-    S, E, Ia, Iy, Ih, R, D, E2Iy, E2I, Iy2Ih, H2D, SchoolCloseTime, \
-        SchoolReopenTime = model.SEIR_model_publish_w_risk(**model_kwargs_filtered)
-
-    compute_R0 = bool(scenario['c_reduction'] == 0 and
-                          scenario['close_trigger'].split('_')[-1] == '20220101')
-    if compute_R0:
-        R0_float = model.compute_R0(E2I, scenario['interval_per_day'],
-                                    scenario['Para'], scenario['g_rate'])
-        R0 = R0_float * np.ones_like(E2Iy)
-    else:
-        R0 = np.nan * np.ones_like(E2Iy)
-
-    return np.stack([
-            S,
-            E2Iy,
-            E2I,
-            Iy2Ih,
-            H2D,
-            Ia,
-            Iy,
-            Ih,
-            R,
-            E,
-            D,
-            SchoolCloseTime,
-            SchoolReopenTime,
-            R0
-        ], axis=0)
+    return model.SEIR_model_publish_w_risk(n_steps=n_steps,
+                                           **model_kwargs_filtered)
 
     # else:
     #     compute_R0 = bool(scenario['c_reduction'] == 0 and
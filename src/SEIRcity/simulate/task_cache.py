@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+import os
+import tempfile
+import numpy as np
+
+from SEIRcity import utils
+from SEIRcity.version import version as SEIRcity_version
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+PARENT = os.path.dirname(HERE)
+
+# source files whose contents determine the outcome of simulate_one.
+# Editing any of these invalidates every cached outcome.
+CODE_FILES = (
+    os.path.join(PARENT, 'model.py'),
+    os.path.join(PARENT, 'school_closure.py'),
+    os.path.join(PARENT, 'param.py'),
+    os.path.join(HERE, 'simulate_one.py'),
+)
+
+# config keys that define the sweep, or that do not affect the outcome
+# of any single task. These are left out of the task key, so that
+# adding a scenario or replicates to a config reuses cached tasks.
+NON_EFFECTIVE_KEYS = (
+    'NUM_SIM', 'NUM_SIM_FIT', 'GROWTH_RATE_LIST', 'CONTACT_REDUCTION',
+    'CLOSE_TRIGGER_LIST', 'REOPEN_TRIGGER_LIST', 'beta0_dict',
+    'RESULTS_DIR', 'verbose', 'is_fitting', 'cache_dir', 'seed',
+    'task_timeout', 'task_retries', 'chunksize', 'sparse_outcomes',
+    'summary_outcomes', 'compact_outcomes', 'scenario_design',
+)
+
+
+def save_atomic(fp, arr):
+    """Writes numpy array `arr` to .npy file `fp`, such that readers
+    never see a partially written file, even on a shared file system.
+    """
+    os.makedirs(os.path.dirname(fp), exist_ok=True)
+    fd, tmp_fp = tempfile.mkstemp(dir=os.path.dirname(fp), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            np.save(f, arr, allow_pickle=False)
+        os.replace(tmp_fp, fp)
+    except BaseException as err:
+        if os.path.exists(tmp_fp):
+            os.remove(tmp_fp)
+        raise err
+
+
+def code_version():
+    """Returns a digest of the package version and the source of the
+    modules that simulate_one depends on.
+    """
+    sources = list()
+    for code_fp in CODE_FILES:
+        with open(code_fp, 'rb') as f:
+            sources.append(f.read().decode('utf-8'))
+    return utils.fingerprint([SEIRcity_version, sources])
+
+
+class TaskCache(object):
+    """Content-addressed store for simulate_one outcomes on disk. Each
+    outcome is saved as a .npy file, named after a digest of the
+    effective parameters of the task, its seed (stochastic runs only),
+    and the code version. Outcomes are written as soon as they are
+    received, so that an interrupted sweep can be resumed by rerunning
+    it with the same `cache_dir`.
+    """
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        os.makedirs(cache_dir, exist_ok=True)
+        self._code_version = code_version()
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, task, config, replicate=None):
+        """Returns the cache key for Scenario `task`, which will be run
+        with configuration dictionary `config`. Deterministic tasks
+        ignore `replicate` and seed, since every replicate is identical.
+        """
+        task_params = {k: v for k, v in task.items()
+                       if k not in NON_EFFECTIVE_KEYS and
+                       k not in ('config', 'verbosity')}
+        config_params = {k: v for k, v in config.items()
+                         if k not in NON_EFFECTIVE_KEYS}
+        if task.get('deterministic', config.get('deterministic')):
+            stochastic = None
+        else:
+            stochastic = [replicate, task.get('seed', None)]
+        return utils.fingerprint([self._code_version, task_params,
+                                  config_params, stochastic])
+
+    def _fp(self, key):
+        return os.path.join(self.cache_dir, key[:2], key + '.npy')
+
+    def __contains__(self, key):
+        return os.path.isfile(self._fp(key))
+
+    def get(self, key):
+        """Returns the cached outcome for `key`, or None if there is no
+        outcome cached under `key`.
+        """
+        try:
+            outcome = np.load(self._fp(key), allow_pickle=False)
+        except (FileNotFoundError, ValueError):
+            # missing, or truncated by a crash mid-write
+            self.misses += 1
+            return None
+        self.hits += 1
+        return outcome
+
+    def put(self, key, outcome):
+        """Atomically writes numpy array `outcome` under `key`"""
+        save_atomic(self._fp(key), outcome)
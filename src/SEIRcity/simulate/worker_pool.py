@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+import os
+import atexit
+import pickle
+import shutil
+import tempfile
+from collections import OrderedDict
+from multiprocessing import Pool
+
+from SEIRcity import utils
+
+# Objects shared with workers via WorkerPool.share, keyed by fingerprint.
+# Each worker process has its own copy of this cache, which is
+# populated the first time the worker resolves a SharedObject.
+_WORKER_CACHE = OrderedDict()
+# maximum number of shared objects to keep in each worker's cache
+WORKER_CACHE_SIZE = 4
+
+# process-wide WorkerPool returned by get_pool
+_DEFAULT_POOL = None
+
+
+def _init_worker():
+    """Initializer for each worker process. Imports the modules that
+    simulate_one needs, so that the first task sent to a fresh worker
+    does not pay for importing pandas, scipy, and xarray.
+    """
+    from SEIRcity import model, param, outcome_handler
+    from SEIRcity.simulate import simulate_one
+
+
+class SharedObject(object):
+    """Lightweight, picklable reference to an object that was written
+    to disk once by WorkerPool.share. Tasks carry this reference instead
+    of the object itself, and each worker loads the object at most once
+    (see `resolve`).
+    """
+
+    def __init__(self, key, fp):
+        self.key = key
+        self.fp = fp
+
+    def resolve(self):
+        """Returns the shared object, loading it from disk if this
+        process has not seen it yet.
+        """
+        if self.key in _WORKER_CACHE:
+            _WORKER_CACHE.move_to_end(self.key)
+            return _WORKER_CACHE[self.key]
+        with open(self.fp, 'rb') as f:
+            obj = pickle.load(f)
+        _WORKER_CACHE[self.key] = obj
+        while len(_WORKER_CACHE) > WORKER_CACHE_SIZE:
+            _WORKER_CACHE.popitem(last=False)
+        return obj
+
+
+class WorkerPool(object):
+    """Long-lived wrapper around multiprocessing.Pool. The underlying
+    Pool is created lazily on first use, and is reused by every
+    subsequent sweep or fit that is passed this WorkerPool instance, so
+    that worker startup (imports, shared data) is paid only once per
+    process. Use `get_pool` to retrieve a process-wide instance.
+    """
+
+    def __init__(self, threads=48):
+        assert isinstance(threads, int) and threads > 0, \
+            "arg `threads` must be a positive integer, not {}".format(threads)
+        self.threads = threads
+        self._pool = None
+        self._shared_dir = None
+        self._shared = dict()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    @property
+    def pool(self):
+        """The multiprocessing.Pool instance, created on first access."""
+        if self._pool is None:
+            self._pool = Pool(processes=self.threads,
+                              initializer=_init_worker)
+        return self._pool
+
+    @property
+    def is_running(self):
+        return self._pool is not None
+
+    def map(self, func, iterable, chunksize=None):
+        """Same as multiprocessing.Pool.map"""
+        return self.pool.map(func, iterable, chunksize=chunksize)
+
+    def imap_unordered(self, func, iterable, chunksize=1):
+        """Same as multiprocessing.Pool.imap_unordered"""
+        return self.pool.imap_unordered(func, iterable, chunksize=chunksize)
+
+    def share(self, obj):
+        """Write `obj` to disk once, and return a SharedObject that can
+        be sent to workers in place of `obj`. Objects with the same
+        contents (see utils.fingerprint) are written only once per
+        WorkerPool.
+        """
+        key = utils.fingerprint(obj)
+        if key not in self._shared:
+            if self._shared_dir is None:
+                self._shared_dir = tempfile.mkdtemp(prefix='SEIRcity_shared_')
+            fp = os.path.join(self._shared_dir, key + '.pckl')
+            with open(fp, 'wb') as f:
+                pickle.dump(obj, f)
+            self._shared[key] = SharedObject(key=key, fp=fp)
+        return self._shared[key]
+
+    def terminate(self):
+        """Kill the worker processes immediately, without waiting for
+        running tasks. Shared objects are kept, and a new Pool will be
+        created on next use.
+        """
+        if self._pool is not None:
+            self._pool.terminate()
+            self._pool.join()
+            self._pool = None
+
+    def close(self):
+        """Shut down the worker processes and remove shared objects
+        from disk. The WorkerPool can still be used afterwards; a new
+        Pool will be created on next use.
+        """
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+        if self._shared_dir is not None:
+            shutil.rmtree(self._shared_dir, ignore_errors=True)
+            self._shared_dir = None
+        self._shared = dict()
+
+
+def get_pool(threads=48):
+    """Returns the process-wide WorkerPool, creating it if necessary.
+    If the existing WorkerPool has a different number of `threads`,
+    it is closed and replaced.
+    """
+    global _DEFAULT_POOL
+    if _DEFAULT_POOL is not None and _DEFAULT_POOL.threads != threads:
+        _DEFAULT_POOL.close()
+        _DEFAULT_POOL = None
+    if _DEFAULT_POOL is None:
+        _DEFAULT_POOL = WorkerPool(threads=threads)
+    return _DEFAULT_POOL
+
+
+@atexit.register
+def _close_default_pool():
+    if _DEFAULT_POOL is not None:
+        _DEFAULT_POOL.close()
@@ -1,6 +1,7 @@
 #!/usr/bin/env python
 
 import os
+import hashlib
 import numpy as np
 import pandas as pd
 import datetime as dt
@@ -215,3 +216,65 @@ def are_objects_equal(o1, o2, max_depth=20, verbose=False):
         else:
             raise ValueError("compare_objects does not support " +
                              "comparisions of type '{}'".format(type(o1)))
+
+
+def to_builtin(obj):
+    """Converts numpy scalars and arrays to the equivalent built-in
+    Python objects, e.g. for serialization to JSON. Other objects are
+    converted to str.
+    """
+    if isinstance(obj, (np.generic, np.ndarray)):
+        return obj.tolist()
+    return str(obj)
+
+
+def fingerprint(obj, hasher=None):
+    """Returns a hex digest that uniquely identifies the contents of
+    Python object `obj`. Supports (nested) dictionaries, sequences,
+    sets, numpy arrays, numbers, strings, datetimes, and None. Dictionary
+    and set ordering does not affect the digest. Numbers are hashed by
+    kind and exact value, so numpy and Python numbers of the same kind
+    share a digest, but True, 1, and 1.0 do not. Other types are hashed
+    by their repr.
+    """
+    top_level = hasher is None
+    if top_level:
+        hasher = hashlib.sha256()
+
+    def update(*tokens):
+        for token in tokens:
+            hasher.update(str(token).encode('utf-8'))
+
+    if isinstance(obj, np.ndarray):
+        update('ndarray', obj.dtype.str, obj.shape)
+        if obj.dtype == object:
+            for item in obj.ravel():
+                fingerprint(item, hasher=hasher)
+        else:
+            hasher.update(np.ascontiguousarray(obj).tobytes())
+    elif isinstance(obj, dict):
+        update('dict', len(obj))
+        for k in sorted(obj.keys(), key=repr):
+            update(repr(k))
+            fingerprint(obj[k], hasher=hasher)
+    elif isinstance(obj, (set, frozenset)):
+        update('set', len(obj))
+        for item in sorted(obj, key=repr):
+            fingerprint(item, hasher=hasher)
+    elif isinstance(obj, (list, tuple)):
+        update(type(obj).__name__, len(obj))
+        for item in obj:
+            fingerprint(item, hasher=hasher)
+    elif isinstance(obj, (bool, np.bool_)):
+        update('bool', bool(obj))
+    elif isinstance(obj, (int, np.integer)):
+        # exact, unlike a float above 2 ** 53
+        update('int', int(obj))
+    elif isinstance(obj, (float, np.floating)):
+        # same digest for 3. and np.float64(3.)
+        update('float', repr(float(obj)))
+    else:
+        update(type(obj).__name__, repr(obj))
+
+    if top_level:
+        return hasher.hexdigest()
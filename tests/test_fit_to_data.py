@@ -5,9 +5,338 @@ import numpy as np
 from pprint import pprint as pp
 from .pytest_utils import fp, md5sum, assert_objects_equal, \
     call_with_legacy_params, are_objects_equal, compare_dicts
+import pandas as pd
+from scipy.optimize._numdiff import approx_derivative
 from SEIRcity import fit_to_data
+from SEIRcity.fit_to_data.fitting_workflow import calc_residual, \
+    fit_to_data as fit, ParallelJacobian, SimulationCache, FitTrace, nrmsd_t
+from SEIRcity.fit_to_data.emulator import GaussianProcess, fit_emulator
+from SEIRcity.fit_to_data.global_fit import fit_global
+from SEIRcity.fit_to_data.uncertainty import bootstrap, \
+    bootstrap_datasets, profile, profile_interval, summarize, uncertainty_fp
+from SEIRcity.fit_to_data.joint_fit import JointProblem, fit_joint, \
+    data_weight
+from SEIRcity.fit_to_data.abc import fit_abc
+from SEIRcity.fit_to_data.batch_fit import batch_fitting_workflow, \
+    split_chains
+from SEIRcity.scenario import BaseScenario
+from SEIRcity.simulate.worker_pool import WorkerPool
 from SEIRcity.param import aggregate_params_and_data
 
+FIT_VAR_NAMES = ['beta0', 'c_reduction']
+BOUNDS = np.array([[0., 0.], [1., 1.]])
+
+
+def toy_sim(scenario):
+    """Stand-in for simulate_one, with hospitalizations (index 7) that
+    grow at rate beta0 from (1 - c_reduction) * 100
+    """
+    n_steps = scenario['total_time'] * scenario['interval_per_day']
+    days = np.arange(n_steps) / scenario['interval_per_day']
+    ih = (1 - scenario['c_reduction']) * 100 * \
+        np.exp(scenario['beta0'][0] * days)
+    out = np.zeros((8, n_steps, scenario['n_age'], scenario['n_risk']))
+    out[7] = ih[:, None, None] / (scenario['n_age'] * scenario['n_risk'])
+    return out
+
+
+@pytest.fixture()
+def toy_scenario():
+    yield BaseScenario({'n_age': 2, 'n_risk': 1, 'total_time': 30,
+                        'interval_per_day': 2, 'beta0': 0.05,
+                        'c_reduction': 0.2})
+
+
+@pytest.fixture()
+def toy_data(toy_scenario):
+    truth = calc_residual([0.1, 0.4], FIT_VAR_NAMES, toy_sim, toy_scenario,
+                          np.zeros(25), 2)
+    rng = np.random.default_rng(0)
+    yield truth + rng.normal(scale=0.5, size=truth.shape)
+
+
+def test_residual_does_not_modify_scenario(toy_scenario, toy_data):
+    calc_residual([0.3, 0.1], FIT_VAR_NAMES, toy_sim, toy_scenario,
+                  toy_data, 2)
+    assert toy_scenario['beta0'] == 0.05
+    assert toy_scenario['c_reduction'] == 0.2
+
+
+def test_simulation_cache(toy_scenario, toy_data):
+    calls = list()
+
+    def counting_sim(scenario):
+        calls.append(scenario['c_reduction'])
+        return toy_sim(scenario)
+
+    cache = SimulationCache(maxsize=2)
+    args = (FIT_VAR_NAMES, counting_sim, toy_scenario, toy_data, 2)
+    first = calc_residual([0.1, 0.4], *args, cache=cache)
+    # the same params, up to rounding
+    again = calc_residual([0.1, 0.4 + 1e-15], *args, cache=cache)
+    assert np.array_equal(first, again)
+    assert calls == [0.4]
+    # least recently used simulations are dropped
+    calc_residual([0.1, 0.5], *args, cache=cache)
+    calc_residual([0.1, 0.6], *args, cache=cache)
+    calc_residual([0.1, 0.4], *args, cache=cache)
+    assert calls == [0.4, 0.5, 0.6, 0.4]
+    assert len(cache) == 2
+    assert (cache.hits, cache.misses) == (1, 4)
+    assert cache.hit_rate == 0.2
+    # a different scenario is not the same simulation
+    other = BaseScenario(toy_scenario, n_risk=2)
+    calc_residual([0.1, 0.6], FIT_VAR_NAMES, counting_sim, other, toy_data,
+                  2, cache=cache)
+    assert len(calls) == 5
+
+
+@pytest.mark.parametrize("x0", [
+    [0.1, 0.4],
+    # steps that would leave the bounds are reversed
+    [1., 0.4],
+    [0.5, 1. - 1e-9],
+])
+def test_parallel_jacobian_matches_scipy(toy_scenario, toy_data, x0):
+    args = (FIT_VAR_NAMES, toy_sim, toy_scenario, toy_data, 2)
+    expected = approx_derivative(calc_residual, np.array(x0),
+                                 method='2-point', bounds=BOUNDS, args=args)
+    with WorkerPool(threads=2) as pool:
+        jac = ParallelJacobian(pool, BOUNDS, *args)
+        assert np.array_equal(jac(np.array(x0)), expected)
+        # the residual at x0 is not simulated again
+        jac.residual(np.array(x0), *args)
+        assert np.array_equal(jac(np.array(x0)), expected)
+
+
+def test_parallel_fit_matches_serial(toy_scenario, toy_data):
+    kwargs = {'fit_var_names': FIT_VAR_NAMES,
+              'fit_guess': {'beta0': 0.05, 'c_reduction': 0.5},
+              'fit_bounds': {'beta0': [0., 1.], 'c_reduction': [0., 1.]},
+              'sim_func': toy_sim, 'scenario': toy_scenario,
+              'data': toy_data, 'offset': 2}
+    serial = fit(**kwargs)
+    with WorkerPool(threads=3) as pool:
+        parallel = fit(pool=pool, **kwargs)
+    for key in FIT_VAR_NAMES + ['final_rmsd', 'n_simulations']:
+        assert parallel[key] == serial[key]
+    assert abs(serial['beta0'] - 0.1) < 0.01
+
+
+def test_fit_trace(toy_scenario, toy_data):
+    kwargs = {'fit_var_names': FIT_VAR_NAMES,
+              'fit_guess': {'beta0': 0.05, 'c_reduction': 0.5},
+              'fit_bounds': {'beta0': [0., 1.], 'c_reduction': [0., 1.]},
+              'sim_func': toy_sim, 'scenario': toy_scenario,
+              'data': toy_data, 'offset': 2}
+    untraced = fit(**kwargs)
+    trace = FitTrace()
+    traced = fit(trace=trace, **kwargs)
+    for key in FIT_VAR_NAMES + ['final_rmsd', 'n_simulations']:
+        assert traced[key] == untraced[key]
+    table = trace.to_frame()
+    summary = trace.summary()
+    assert summary['n_evaluations'] == len(table)
+    assert summary['n_simulations'] == traced['n_simulations']
+    assert summary['n_cache_hits'] == table['cached'].sum()
+    # one forward step per param in each Jacobian
+    assert (table['kind'] == 'jacobian').sum() == \
+        len(FIT_VAR_NAMES) * summary['n_iterations']
+    assert (table.loc[table['cached'], 'seconds'] == 0).all()
+    best = table.loc[table['residual_norm'].idxmin()]
+    assert np.isclose(best['beta0'], traced['beta0'], atol=1e-6)
+    with WorkerPool(threads=3) as pool:
+        parallel_trace = FitTrace()
+        fit(pool=pool, trace=parallel_trace, **kwargs)
+    columns = ['kind', 'cached', 'residual_norm'] + FIT_VAR_NAMES
+    assert parallel_trace.to_frame()[columns].equals(table[columns])
+
+
+def test_gaussian_process_interpolates():
+    rng = np.random.default_rng(1)
+    X = rng.random((20, 2))
+
+    def f(X):
+        return np.sin(6 * X[:, 0]) + (X[:, 1] - 0.3) ** 2
+
+    gp = GaussianProcess(seed=0).fit(X, f(X))
+    mean, std = gp.predict(X)
+    assert np.allclose(mean, f(X), atol=1e-2)
+    assert (std < 0.05).all()
+    test_X = rng.random((100, 2))
+    mean, std = gp.predict(test_X)
+    assert np.abs(mean - f(test_X)).max() < 0.2
+    # more uncertain away from the training points
+    assert gp.predict([[3., 3.]])[1][0] > std.max()
+
+
+def test_emulator_fit(toy_scenario, toy_data):
+    kwargs = {'fit_var_names': FIT_VAR_NAMES,
+              'fit_guess': {'beta0': 0.05, 'c_reduction': 0.5},
+              'fit_bounds': {'beta0': [0., 0.3], 'c_reduction': [0., 1.]},
+              'sim_func': toy_sim, 'scenario': toy_scenario,
+              'data': toy_data, 'offset': 2}
+    expected = fit(**kwargs)
+    with WorkerPool(threads=2) as pool:
+        soln = fit_emulator(pool=pool, emulator={'batch_size': 2}, **kwargs)
+    assert soln['final_rmsd'] < 1.01 * expected['final_rmsd']
+    assert abs(soln['beta0'] - expected['beta0']) < 1e-3
+    assert soln['n_simulations'] < expected['n_simulations']
+    assert np.array_equal(soln['final_error'], calc_residual(
+        [soln[name] for name in FIT_VAR_NAMES], FIT_VAR_NAMES, toy_sim,
+        toy_scenario, toy_data, 2))
+
+
+def test_global_fit(toy_scenario, toy_data):
+    kwargs = {'fit_var_names': FIT_VAR_NAMES,
+              'fit_guess': {'beta0': 0.9, 'c_reduction': 0.9},
+              'fit_bounds': {'beta0': [0., 1.], 'c_reduction': [0., 1.]},
+              'sim_func': toy_sim, 'scenario': toy_scenario,
+              'data': toy_data, 'offset': 2,
+              'global_fit': {'maxiter': 10}}
+    serial = fit_global(**kwargs)
+    with WorkerPool(threads=2) as pool:
+        parallel = fit_global(pool=pool, **kwargs)
+    for key in FIT_VAR_NAMES + ['final_rmsd', 'n_simulations']:
+        assert parallel[key] == serial[key]
+    assert serial['global_n_generations'] == 11
+    assert serial['n_simulations'] > serial['global_n_simulations']
+    assert abs(serial['beta0'] - 0.1) < 0.01
+    assert abs(serial['c_reduction'] - 0.4) < 0.05
+
+
+@pytest.mark.parametrize("method", ['residual', 'parametric'])
+def test_bootstrap_datasets(method):
+    data = np.arange(10.)
+    residual = np.array([1., -1.] * 5)
+    datasets = bootstrap_datasets(residual, data, 50, method=method, seed=0)
+    assert datasets.shape == (50, 10)
+    noise = datasets - (data + residual)
+    if method == 'residual':
+        assert set(np.unique(noise)) == {-1., 1.}
+    else:
+        assert abs(noise.std() - 1.) < 0.1
+    assert np.array_equal(
+        datasets, bootstrap_datasets(residual, data, 50, method, seed=0))
+
+
+def test_profile_interval():
+    values = np.linspace(-2., 2., 9)
+    # quadratic profile, which crosses the 95% threshold of 3.84 at +/-1
+    lr_stat = 3.841458820694124 * values ** 2
+    low, high = profile_interval(values, lr_stat)
+    assert np.isclose(low, -1.) and np.isclose(high, 1.)
+    # not reached within the profile
+    assert np.isnan(profile_interval(values, lr_stat / 10.)[0])
+
+
+def test_uncertainty(toy_scenario, toy_data, tmp_path):
+    fit_bounds = {'beta0': [0., 1.], 'c_reduction': [0., 1.]}
+    solution = fit(FIT_VAR_NAMES, {'beta0': 0.05, 'c_reduction': 0.5},
+                   fit_bounds, toy_sim, toy_scenario, toy_data, 2)
+    args = (solution, FIT_VAR_NAMES, fit_bounds, toy_sim, toy_scenario,
+            toy_data, 2)
+    boot_table = bootstrap(*args, n_bootstrap=8, seed=0)
+    with WorkerPool(threads=2) as pool:
+        assert boot_table.equals(bootstrap(*args, pool=pool, n_bootstrap=8,
+                                           seed=0))
+        profile_table = profile(*args, pool=pool, n_points=5,
+                                width={'beta0': 0.002, 'c_reduction': 0.02})
+    assert list(boot_table['replicate']) == list(range(8))
+    assert len(profile_table) == 2 * 5
+    at_estimate = profile_table[profile_table['value'].isin(
+        [solution[name] for name in FIT_VAR_NAMES])]
+    assert np.allclose(at_estimate['lr_stat'], 0., atol=1e-6)
+
+    summary = summarize(solution, FIT_VAR_NAMES, boot_table, profile_table)
+    for row in summary.to_dict('records'):
+        assert row['boot_low'] < row['estimate'] < row['boot_high']
+        assert row['profile_low'] < row['estimate'] < row['profile_high']
+    assert uncertainty_fp(str(tmp_path / 'fit.csv'), 'profile') == \
+        str(tmp_path / 'fit_profile.csv')
+
+
+@pytest.fixture()
+def toy_cities(toy_scenario):
+    """Two cities that share c_reduction 0.4, with beta0 0.1 and 0.15"""
+    cities = list()
+    for name, n_age, beta0 in (('a', 2, 0.1), ('b', 3, 0.15)):
+        scenario = BaseScenario(toy_scenario, n_age=n_age)
+        data = calc_residual([beta0, 0.4], FIT_VAR_NAMES, toy_sim, scenario,
+                             np.zeros(20), 1)
+        cities.append({'name': name, 'scenario': scenario, 'data': data,
+                       'offset': 1, 'fit_var_names': ['beta0']})
+    yield cities
+
+
+def test_joint_jacobian_matches_scipy(toy_cities):
+    problem = JointProblem(toy_cities, ['c_reduction'], toy_sim)
+    assert problem.names == ['c_reduction', 'a.beta0', 'b.beta0']
+    x0 = np.array([0.3, 0.12, 0.12])
+    bounds = np.array([[0.] * 3, [1.] * 3])
+    expected = approx_derivative(problem.residual, x0, method='2-point',
+                                 bounds=bounds)
+    with WorkerPool(threads=2) as pool:
+        problem.pool = pool
+        jac = problem.jacobian(x0, bounds)
+    assert np.array_equal(jac, expected)
+    # beta0 of each city does not change the other city
+    assert (jac[:20, 2] == 0).all() and (jac[20:, 1] == 0).all()
+
+
+def test_joint_fit(toy_cities):
+    args = (toy_cities, ['c_reduction'],
+            {'c_reduction': 0.5, 'a.beta0': 0.05, 'b.beta0': 0.05},
+            {'c_reduction': [0., 1.], 'a.beta0': [0., 1.],
+             'b.beta0': [0., 1.]}, toy_sim)
+    serial = fit_joint(*args)
+    with WorkerPool(threads=3) as pool:
+        parallel = fit_joint(*args, pool=pool)
+    for key in ('c_reduction', 'a.beta0', 'b.beta0', 'final_cost',
+                'n_simulations'):
+        assert parallel[key] == serial[key]
+    assert np.isclose(serial['c_reduction'], 0.4, atol=1e-4)
+    assert np.isclose(serial['a.beta0'], 0.1, atol=1e-4)
+    assert np.isclose(serial['b.beta0'], 0.15, atol=1e-4)
+    assert serial['b.final_rmsd'] < 1e-6
+    with pytest.raises(ValueError):
+        JointProblem(toy_cities, ['beta0'], toy_sim)
+
+
+@pytest.mark.parametrize("data,weight", [
+    ([1., 3., 5.], 0.25),
+    ([4., 4., 4.], 0.25),
+    ([-2., -2.], 0.5),
+    ([0., 0., 0.], 1.),
+])
+def test_data_weight(data, weight):
+    """Flat data are weighted by their magnitude, not by a zero range"""
+    assert data_weight(np.array(data)) == weight
+    # so is the normalized rmsd of a fit to flat data
+    assert nrmsd_t(2., np.array(data)) == 2. * weight
+
+
+def test_abc(toy_scenario, toy_data):
+    args = (FIT_VAR_NAMES, {'beta0': [0., 0.3], 'c_reduction': [0., 1.]},
+            toy_sim, toy_scenario, toy_data, 2)
+    settings = {'n_particles': 50, 'n_generations': 5, 'batch_size': 25}
+    soln = fit_abc(*args, abc=settings)
+    posterior, generations = soln['posterior'], soln['generations']
+    assert len(posterior) == 50
+    assert np.isclose(posterior['weight'].sum(), 1.)
+    assert (posterior['distance'] <= generations['tolerance'].iloc[-1]).all()
+    assert (np.diff(generations['tolerance']) < 0).all()
+    assert soln['n_simulations'] == generations['n_simulations'].sum()
+    assert abs(soln['beta0'] - 0.1) < 0.01
+    # proposals are drawn in the main process
+    with WorkerPool(threads=2) as pool:
+        parallel = fit_abc(*args, pool=pool, abc=settings)
+    assert parallel['posterior'].equals(posterior)
+    # the posterior is the uncertainty of an ABC fit
+    with pytest.raises(ValueError):
+        fit_to_data.fitting_workflow(
+            {'fit_method': 'abc', 'fit_uncertainty': True})
+
 
 def test_can_import():
     """"""
@@ -71,3 +400,60 @@ class TestFittingWorkflow(object):
         diff_allowed = 1e-8
         assert diff_allowed > percent_diff(soln['c_reduction'], 0.8497231717065995)
         assert diff_allowed > percent_diff(soln['final_nrmsd_t'], 0.22376477708630133)
+
+
+@pytest.fixture()
+def batch_config(tmp_path):
+    """Fit config of beta0 to hospitalizations of toy_sim started on
+    20200216, with beta0 0.1 and the c_reduction 0.5 of the config, from
+    20200220. Since c_reduction is not fitted, only the fit that starts
+    on 20200216 is exact.
+    """
+    config = aggregate_params_and_data(
+        fp("tests/data/configs/fit_to_data1.yaml"))
+    days = np.arange(4, 24)
+    pd.DataFrame({
+        'date': pd.date_range('2020-02-20', periods=len(days)).strftime(
+            '%Y-%m-%d'),
+        'hospitalized': 50. * np.exp(0.1 * days)
+    }).to_csv(str(tmp_path / "hosp.csv"), index=False)
+    config.update({
+        'hosp_data_fp': str(tmp_path / "hosp.csv"),
+        'total_time': 30,
+        'interval_per_day': 2,
+        'fit_var_names': ['beta0'],
+        'fit_guess': {'beta0': 0.05},
+        'fit_bounds': {'beta0': [0., 1.]},
+        'fit_batch': {'time_begin_sim': [20200215, 20200216, 20200217]}})
+    yield config
+
+
+def test_split_chains():
+    assert split_chains(5, 2) == [[0, 1, 2], [3, 4]]
+    assert split_chains(2, 4) == [[0], [1]]
+
+
+def test_batch_fit(batch_config, tmp_path):
+    out_fp = str(tmp_path / "batch.csv")
+    serial = batch_fitting_workflow(batch_config, out_fp=out_fp,
+                                    sim_func=toy_sim)
+    assert serial['time_begin_sim'].tolist() == [20200215, 20200216,
+                                                 20200217]
+    assert list(serial.columns) == ['time_begin_sim', 'beta0',
+                                    'final_rmsd', 'final_nrmsd_t',
+                                    'n_simulations', 'cache_hit_rate']
+    assert abs(serial['beta0'][1] - 0.1) < 1e-4
+    assert serial['final_rmsd'][1] < 1e-3
+    # starting a day early or late cannot be made up by beta0 alone
+    assert (serial['final_rmsd'][[0, 2]] > 100 * serial['final_rmsd'][1] +
+            0.1).all()
+    pd.testing.assert_frame_equal(pd.read_csv(out_fp), serial)
+    # fits of the same points on 2 workers, in chains [0, 1] and [2]
+    with WorkerPool(threads=2) as pool:
+        parallel = batch_fitting_workflow(batch_config, pool=pool,
+                                          sim_func=toy_sim)
+    columns = ['time_begin_sim', 'beta0', 'final_rmsd']
+    np.testing.assert_allclose(parallel[columns].values,
+                               serial[columns].values, rtol=1e-4, atol=1e-8)
+    # the last point starts a chain, so is not warm started
+    assert parallel['n_simulations'][2] > serial['n_simulations'][2]
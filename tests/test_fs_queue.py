@@ -0,0 +1,162 @@
+import os
+import sys
+import json
+import time
+import pickle
+import socket
+import pytest
+import subprocess
+import numpy as np
+import xarray as xr
+from multiprocessing import Process
+from .pytest_utils import fp, SEIR_HOME
+from SEIRcity.simulate import fs_queue
+from SEIRcity.simulate.worker_pool import WorkerPool
+from SEIRcity.simulate.multiple_pool import multiple_pool
+from SEIRcity.param import aggregate_params_and_data
+
+
+@pytest.fixture()
+def config():
+    config = aggregate_params_and_data(
+        yaml_fp=fp("tests/data/configs/austin_short0.yaml"))
+    config['seed'] = 42
+    yield config
+
+
+def test_enqueue(config, tmp_path):
+    queue_dir = str(tmp_path / "queue")
+    n_tasks = fs_queue.enqueue(config, queue_dir)
+    assert n_tasks == 4
+    assert fs_queue.queue_status(queue_dir) == {
+        'pending': 4, 'claimed': 0, 'shards': 0, 'failed': 0}
+    # refuses to overwrite an existing queue
+    with pytest.raises(FileExistsError):
+        fs_queue.enqueue(config, queue_dir)
+
+
+def test_claim_is_exclusive(config, tmp_path):
+    queue_dir = str(tmp_path / "queue")
+    fs_queue.enqueue(config, queue_dir)
+    claims = [fs_queue._claim(queue_dir, "worker{}".format(i))
+              for i in range(5)]
+    assert claims[-1] is None
+    names = [os.path.basename(c).split(fs_queue.CLAIM_SEP)[0]
+             for c in claims[:-1]]
+    assert len(set(names)) == 4
+
+
+def test_requeue_stale(config, tmp_path):
+    queue_dir = str(tmp_path / "queue")
+    fs_queue.enqueue(config, queue_dir)
+    fs_queue._claim(queue_dir, "lost_worker")
+    assert fs_queue.requeue_stale(queue_dir, stale_after=60) == 0
+    time.sleep(0.1)
+    assert fs_queue.requeue_stale(queue_dir, stale_after=0.05) == 1
+    assert fs_queue.queue_status(queue_dir)['pending'] == 4
+
+
+def test_requeue_dead(config, tmp_path):
+    queue_dir = str(tmp_path / "queue")
+    fs_queue.enqueue(config, queue_dir)
+    host = socket.gethostname()
+    dead = Process(target=time.sleep, args=(0,))
+    dead.start()
+    dead.join()
+    fs_queue._claim(queue_dir, "{}.{}".format(host, dead.pid))
+    fs_queue._claim(queue_dir, "{}.{}".format(host, os.getpid()))
+    fs_queue._claim(queue_dir, "other_host.{}".format(dead.pid))
+    assert fs_queue.requeue_dead(queue_dir) == 1
+    assert fs_queue.queue_status(queue_dir)['claimed'] == 2
+
+
+def test_several_workers(config, tmp_path):
+    """Outcomes from three worker processes sharing a queue match
+    a run on one host
+    """
+    queue_dir = str(tmp_path / "queue")
+    fs_queue.enqueue(config, queue_dir)
+    with pytest.raises(RuntimeError):
+        fs_queue.reduce(queue_dir)
+
+    workers = [Process(target=fs_queue.work, args=(queue_dir,))
+               for _ in range(3)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+        assert worker.exitcode == 0
+    assert fs_queue.queue_status(queue_dir) == {
+        'pending': 0, 'claimed': 0, 'shards': 4, 'failed': 0}
+
+    out_fp = str(tmp_path / "out.pckl")
+    reduced = fs_queue.reduce(queue_dir, out_fp=out_fp).outcomes
+    assert os.path.isfile(out_fp)
+    assert not os.path.isfile(out_fp + '.failures.json')
+    with WorkerPool(threads=2) as pool:
+        expected = multiple_pool(config, pool=pool).outcomes
+    xr.testing.assert_equal(reduced, expected)
+
+
+def test_failed_task(config, tmp_path):
+    """A task that fails on every attempt is filled with NaN"""
+    queue_dir = str(tmp_path / "queue")
+    fs_queue.enqueue(config, queue_dir)
+    # corrupt one task, such that simulate_one raises
+    task_fp = os.path.join(queue_dir, 'pending', fs_queue._task_name(0))
+    with open(task_fp, 'rb') as f:
+        entry = pickle.load(f)
+    entry['task']['interval_per_day'] = None
+    with open(task_fp, 'wb') as f:
+        pickle.dump(entry, f)
+
+    assert fs_queue.work(queue_dir) == 5
+    status = fs_queue.queue_status(queue_dir)
+    assert (status['shards'], status['failed']) == (3, 1)
+    oh = fs_queue.reduce(queue_dir)
+    assert [f['task_index'] for f in oh.failures] == [0]
+    assert oh.failures[0]['attempts'] == 2
+
+
+def test_cli(config, tmp_path):
+    """enqueue, work, and reduce modes of the command line interface"""
+    yaml_fp = fp("tests/data/configs/austin_short0.yaml")
+    queue_dir = str(tmp_path / "queue")
+    out_fp = str(tmp_path / "out.pckl")
+    base = [sys.executable, '-m', 'src.SEIRcity', '--queue-dir', queue_dir]
+    for args in (['--mode', 'enqueue', '--config-yaml', yaml_fp],
+                 ['--mode', 'work', '--threads', '2'],
+                 ['--mode', 'reduce', '--out-fp', out_fp]):
+        subprocess.run(base + args, cwd=SEIR_HOME, check=True,
+                       stdout=subprocess.DEVNULL)
+    with open(out_fp, 'rb') as f:
+        outcomes = pickle.load(f)
+    assert outcomes.sizes['c_reduction'] == 2
+
+
+def test_cli_incomplete(config, tmp_path):
+    """A lost claim is run again with --stale-after, and reduce writes
+    outcomes of an incomplete queue with --allow-incomplete
+    """
+    yaml_fp = fp("tests/data/configs/austin_short0.yaml")
+    queue_dir = str(tmp_path / "queue")
+    out_fp = str(tmp_path / "out.pckl")
+    base = [sys.executable, '-m', 'src.SEIRcity', '--queue-dir', queue_dir]
+    subprocess.run(base + ['--mode', 'enqueue', '--config-yaml', yaml_fp],
+                   cwd=SEIR_HOME, check=True, stdout=subprocess.DEVNULL)
+    fs_queue._claim(queue_dir, "lost_node.1")
+    assert fs_queue.work(queue_dir, max_tasks=2) == 2
+    reduce = base + ['--mode', 'reduce', '--out-fp', out_fp]
+    assert subprocess.run(reduce, cwd=SEIR_HOME,
+                          stdout=subprocess.DEVNULL,
+                          stderr=subprocess.DEVNULL).returncode != 0
+    subprocess.run(reduce + ['--allow-incomplete'], cwd=SEIR_HOME,
+                   check=True, stdout=subprocess.DEVNULL)
+    with open(out_fp + '.failures.json') as f:
+        assert len(json.load(f)) == 2
+    time.sleep(0.1)
+    subprocess.run(base + ['--mode', 'work', '--threads', '1',
+                           '--stale-after', '0.05'],
+                   cwd=SEIR_HOME, check=True, stdout=subprocess.DEVNULL)
+    assert fs_queue.queue_status(queue_dir) == {
+        'pending': 0, 'claimed': 0, 'shards': 4, 'failed': 0}
@@ -0,0 +1,62 @@
+import os
+import pickle
+import pytest
+import numpy as np
+from .pytest_utils import fp
+from SEIRcity.get_initial_state import InitialModelState
+from SEIRcity.outcome_handler import decode_params
+from SEIRcity.simulate.worker_pool import WorkerPool
+from SEIRcity.simulate.multiple_pool import multiple_pool
+from SEIRcity.param import aggregate_params_and_data
+
+
+@pytest.mark.parametrize("yaml_fp", [
+    fp("tests/data/configs/austin_short0.yaml"),
+])
+def test_instantaneous_state(yaml_fp, tmp_path):
+    """Initial state can be read from integer-coded outcomes, as well
+    as from label-indexed outcomes
+    """
+    config = aggregate_params_and_data(yaml_fp=yaml_fp)
+    config['CONTACT_REDUCTION'] = [0.0]
+    with WorkerPool(threads=2) as pool:
+        outcomes = multiple_pool(config, pool=pool).outcomes
+    states = list()
+    for da in (outcomes, decode_params(outcomes)):
+        outcomes_fp = str(tmp_path / "outcomes.pckl")
+        with open(outcomes_fp, 'wb') as f:
+            pickle.dump(da, f)
+        init_state = InitialModelState(
+            config['total_time'], config['interval_per_day'],
+            config['n_age'], config['n_risk'], outcomes_fp,
+            config['metro_pop'])
+        states.append(init_state.instantaneous_state(min_hosp=1))
+        assert init_state.start_day is not None
+    assert sorted(states[0].keys()) == sorted(states[1].keys())
+    for compartment in states[0]:
+        np.testing.assert_array_equal(states[0][compartment],
+                                      states[1][compartment])
+    assert states[0]['S'].shape == (config['n_age'], config['n_risk'])
+
+
+@pytest.mark.parametrize("yaml_fp", [
+    fp("tests/data/configs/austin_short0.yaml"),
+])
+def test_instantaneous_state_zarr(yaml_fp, tmp_path):
+    """Initial state can be read lazily from a Zarr store"""
+    pytest.importorskip('zarr')
+    config = aggregate_params_and_data(yaml_fp=yaml_fp)
+    config['CONTACT_REDUCTION'] = [0.0]
+    states = list()
+    with WorkerPool(threads=2) as pool:
+        for out_fp in ("outcomes.pckl", "outcomes.zarr"):
+            outcomes_fp = str(tmp_path / out_fp)
+            multiple_pool(config, pool=pool).to_file(outcomes_fp)
+            init_state = InitialModelState(
+                config['total_time'], config['interval_per_day'],
+                config['n_age'], config['n_risk'], outcomes_fp,
+                config['metro_pop'])
+            states.append(init_state.instantaneous_state(min_hosp=1))
+    for compartment in states[0]:
+        np.testing.assert_array_equal(states[0][compartment],
+                                      states[1][compartment])
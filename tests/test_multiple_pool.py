@@ -7,7 +7,9 @@ import xarray as xr
 from .pytest_utils import fp, md5sum, call_with_legacy_params, assert_objects_equal
 from SEIRcity.simulate.multiple_pool import multiple_pool
 from SEIRcity.simulate.multiple_serial import multiple_serial
+from SEIRcity.simulate.worker_pool import WorkerPool
 from SEIRcity.param import aggregate_params_and_data
+from SEIRcity.outcome_handler import select
 
 
 class TestPool(object):
@@ -57,3 +59,115 @@ class TestPool(object):
         # print("new: ", new_result.outcomes)
         print("legacy coords: ", legacy_result.outcomes.coords)
         print("new coords: ", new_result.outcomes.coords)
+
+
+@pytest.mark.parametrize("yaml_fp", [
+    fp("tests/data/configs/austin_short0.yaml"),
+])
+def test_sparse_outcomes(yaml_fp):
+    """With config key sparse_outcomes, only the scenarios that were run
+    are stored, and the dense outcomes can be recovered
+    """
+    config = aggregate_params_and_data(yaml_fp=yaml_fp)
+    # beta0 is tied to g_rate, so half of the dense grid is empty
+    config['GROWTH_RATE_LIST'] = ['high', 'low']
+    config['beta0_dict'] = {'high': 0.0345, 'low': 0.02}
+    with WorkerPool(threads=2) as pool:
+        dense = multiple_pool(config, pool=pool)
+        config['sparse_outcomes'] = True
+        sparse = multiple_pool(config, pool=pool)
+    assert sparse.outcomes.sizes['scenario'] == 4
+    assert sparse.outcomes.nbytes * 2 == dense.outcomes.nbytes
+    xr.testing.assert_identical(sparse.to_dense(allow_missing=True),
+                                dense.outcomes)
+
+
+@pytest.mark.parametrize("yaml_fp", [
+    fp("tests/data/configs/austin_short0.yaml"),
+])
+def test_summary_outcomes(yaml_fp):
+    """With config key summary_outcomes, daily summary statistics of
+    the selected compartments are kept instead of every replicate
+    """
+    config = aggregate_params_and_data(yaml_fp=yaml_fp)
+    config['deterministic'] = False
+    config['NUM_SIM'] = 4
+    config['seed'] = 7
+    with WorkerPool(threads=2) as pool:
+        full = multiple_pool(config, pool=pool).outcomes
+        config['summary_outcomes'] = {'compartments': ['Ih', 'D'],
+                                      'time_freq': '1D'}
+        summary = multiple_pool(config, pool=pool).outcomes
+    daily = full.sel(compartment=['Ih', 'D']).resample(time='1D').first()
+    assert summary.sizes['time'] == daily.sizes['time']
+    np.testing.assert_allclose(
+        summary.sel(statistic='q0.5').values,
+        daily.median('replicate').transpose(*[
+            d for d in summary.dims if d != 'statistic']).values)
+    assert (summary['n_replicates'] == 4).all()
+
+
+@pytest.mark.parametrize("yaml_fp", [
+    fp("tests/data/configs/austin_short0.yaml"),
+])
+def test_compact_outcomes(yaml_fp):
+    """With config key compact_outcomes, school closure and reopening
+    events and R0 are per-task scalars instead of compartments
+    """
+    config = aggregate_params_and_data(yaml_fp=yaml_fp)
+    # close and reopen within the 14 days simulated, or never
+    config['CLOSE_TRIGGER_LIST'] = ['date__20200220', 'date__20200315']
+    config['REOPEN_TRIGGER_LIST'] = ['no_na_20200225']
+    with WorkerPool(threads=2) as pool:
+        full = multiple_pool(config, pool=pool).outcomes
+        config['compact_outcomes'] = True
+        compact = multiple_pool(config, pool=pool).outcomes
+    assert compact.sizes['compartment'] == 11
+    assert (compact['school_close_step'] >= 0).any()
+    assert (compact['school_close_step'] == -1).any()
+    assert 'SchoolCloseArr' not in compact['compartment'].values
+    xr.testing.assert_identical(
+        compact.reset_coords(drop=True),
+        full.isel(compartment=slice(0, 11)).reset_coords(drop=True))
+    for name, compartment in (('school_close', 'SchoolCloseArr'),
+                              ('school_reopen', 'SchoolReopenArr')):
+        # first step at which the event array is 1, or -1
+        event = full.sel(compartment=compartment).isel(
+            age_group=0, risk_group=0)
+        steps = xr.where(event.max('time') == 1, event.argmax('time'), -1)
+        np.testing.assert_array_equal(compact[name + '_step'], steps)
+        dates = compact[name + '_date'].values
+        assert (np.isnat(dates) == (steps.values == -1)).all()
+    np.testing.assert_array_equal(
+        compact['R0'], full.sel(compartment='R0_baseline').isel(
+            time=0, age_group=0, risk_group=0))
+
+
+@pytest.mark.parametrize("yaml_fp", [
+    fp("tests/data/configs/austin_short0.yaml"),
+])
+def test_scenario_design(yaml_fp):
+    """Keys swept by config key scenario_design, including the start
+    date and epidemiological params, are param dims of the outcomes
+    """
+    config = aggregate_params_and_data(yaml_fp=yaml_fp)
+    config['CONTACT_REDUCTION'] = [0.5]
+    with WorkerPool(threads=2) as pool:
+        baseline = multiple_pool(config, pool=pool).outcomes
+        config['scenario_design'] = {
+            'type': 'grid',
+            'params': {'time_begin_sim': [20200215, 20200222],
+                       'ASYMP_RATE': [0.179, 0.5]}}
+        swept = multiple_pool(config, pool=pool).outcomes
+    assert swept.dims[:7] == ('close_trigger', 'reopen_trigger', 'g_rate',
+                              'c_reduction', 'beta0', 'time_begin_sim',
+                              'ASYMP_RATE')
+    # start dates differ, so times are elapsed since the start
+    assert swept.get_index('time')[0] == np.timedelta64(0)
+    same = select(swept, time_begin_sim=20200215, ASYMP_RATE=0.179)
+    np.testing.assert_array_equal(same.values.squeeze(),
+                                  baseline.values.squeeze())
+    asymp = select(swept, time_begin_sim=20200215, ASYMP_RATE=0.5,
+                   compartment='Ia')
+    assert not np.allclose(asymp.values,
+                           select(same, compartment='Ia').values)
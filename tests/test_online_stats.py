@@ -0,0 +1,129 @@
+import pytest
+import numpy as np
+import pandas as pd
+import xarray as xr
+from SEIRcity.online_stats import (RunningStats, QuantileSketch,
+                                   ReplicateSummary, TimeAggregator,
+                                   get_statistic_labels)
+
+
+@pytest.fixture()
+def samples():
+    rng = np.random.RandomState(0)
+    yield rng.lognormal(size=(1000, 3, 4))
+
+
+def test_running_stats(samples):
+    stats = RunningStats(samples.shape[1:])
+    for arr in samples:
+        stats.add(arr)
+    assert stats.count == len(samples)
+    np.testing.assert_allclose(stats.mean, samples.mean(axis=0))
+    np.testing.assert_allclose(stats.var, samples.var(axis=0, ddof=1))
+    np.testing.assert_array_equal(stats.min, samples.min(axis=0))
+    np.testing.assert_array_equal(stats.max, samples.max(axis=0))
+
+
+def test_running_stats_merge(samples):
+    """Merged RunningStats match a single pass over every sample"""
+    parts = [RunningStats(samples.shape[1:]) for _ in range(3)]
+    for i, arr in enumerate(samples):
+        parts[i % 7 % 3].add(arr)
+    merged = parts[0]
+    merged.merge(parts[1])
+    merged.merge(parts[2])
+    assert merged.count == len(samples)
+    np.testing.assert_allclose(merged.mean, samples.mean(axis=0))
+    np.testing.assert_allclose(merged.var, samples.var(axis=0, ddof=1))
+
+
+@pytest.mark.parametrize("q", [[0.025, 0.5, 0.975], [0., 1.]])
+def test_sketch_exact(samples, q):
+    """Quantiles are exact for up to `size` replicates"""
+    sketch = QuantileSketch(samples.shape[1:], size=128)
+    for arr in samples[:128]:
+        sketch.add(arr)
+    assert sketch.is_exact
+    np.testing.assert_array_equal(sketch.quantile(q),
+                                  np.quantile(samples[:128], q, axis=0))
+
+
+def test_sketch_approximate(samples):
+    """Rank error of each quantile is small, and memory is bounded"""
+    sketch = QuantileSketch(samples.shape[1:], size=64)
+    for arr in samples:
+        sketch.add(arr)
+    assert not sketch.is_exact
+    assert sum([len(items) for items in sketch._levels]) < 4 * 64
+    q = [0.05, 0.25, 0.5, 0.75, 0.95]
+    estimate = sketch.quantile(q)
+    # rank of each estimate among the samples
+    ranks = (samples[np.newaxis] <= estimate[:, np.newaxis]).mean(axis=1)
+    assert np.abs(ranks - np.array(q)[:, None, None]).max() < 0.05
+
+
+def test_sketch_merge(samples):
+    first = QuantileSketch(samples.shape[1:], size=64)
+    second = QuantileSketch(samples.shape[1:], size=64)
+    for arr in samples[:600]:
+        first.add(arr)
+    for arr in samples[600:]:
+        second.add(arr)
+    first.merge(second)
+    assert first.count == len(samples)
+    median = first.quantile([0.5])[0]
+    ranks = (samples <= median).mean(axis=0)
+    assert np.abs(ranks - 0.5).max() < 0.05
+
+
+def test_summary_labels(samples):
+    summary = ReplicateSummary(samples.shape[1:])
+    for arr in samples[:10]:
+        summary.add(arr)
+    summarized = summary.summarize(quantiles=(0.5,))
+    assert get_statistic_labels((0.5,)) == ['mean', 'std', 'min', 'max',
+                                            'q0.5']
+    assert summarized.shape == (5,) + samples.shape[1:]
+    np.testing.assert_allclose(summarized[4],
+                               np.median(samples[:10], axis=0))
+
+
+@pytest.mark.parametrize("freq, how", [
+    ('1D', 'first'), ('1D', 'last'), ('1D', 'mean'), ('1D', 'sum'),
+    ('1D', 'max'), ('1W', 'min'),
+])
+def test_time_aggregator(freq, how):
+    """Same as resampling with xarray"""
+    times = pd.date_range('2020-03-01', periods=50, freq='7H')
+    da = xr.DataArray(np.random.RandomState(1).rand(2, 50, 3),
+                      dims=('compartment', 'time', 'age_group'),
+                      coords={'time': times})
+    aggregate = TimeAggregator(times, freq=freq, how=how, axis=1)
+    expected = getattr(da.resample(time=freq), how)()
+    np.testing.assert_allclose(aggregate(da.values), expected.values)
+    assert (aggregate.times == expected.get_index('time')).all()
+
+
+@pytest.mark.parametrize("freq, fixed", [('1D', '1D'), ('1W', '7D')])
+def test_time_aggregator_timedelta(freq, fixed):
+    """Times since the start, as when start dates are swept, are
+    aggregated to periods from the start, with weeks of 7 days
+    """
+    times = pd.date_range('2020-03-01', periods=50, freq='7H')
+    da = xr.DataArray(np.random.RandomState(1).rand(50, 2),
+                      dims=('time', 'age_group'), coords={'time': times})
+    aggregate = TimeAggregator(times - times[0], freq=freq, how='sum')
+    expected = da.resample(time=fixed).sum()
+    np.testing.assert_allclose(aggregate(da.values), expected.values)
+    assert (aggregate.times ==
+            expected.get_index('time') - times[0]).all()
+
+
+def test_time_aggregator_raises():
+    with pytest.raises(ValueError):
+        TimeAggregator(pd.date_range('2020-03-01', periods=3), freq='1D',
+                       how='median')
+    # months have no fixed length to count from the start
+    with pytest.raises(ValueError):
+        TimeAggregator(pd.timedelta_range(0, periods=3, freq='1D'),
+                       freq='1M')
@@ -7,7 +7,10 @@ import pandas as pd
 import xarray as xr
 from attrdict import AttrDict
 from .pytest_utils import fp, md5sum, call_with_legacy_params, assert_objects_equal
-from SEIRcity.outcome_handler import OutcomeHandler
+from SEIRcity.outcome_handler import (OutcomeHandler, OutcomeStore,
+                                      SparseOutcomeStore, SummaryOutcomeStore,
+                                      SparseSummaryOutcomeStore, select,
+                                      decode_params, get_label_table)
 from SEIRcity.scenario import BaseScenario
 from SEIRcity.utils import all_same, all_unique
 
@@ -148,6 +151,283 @@ def test_can_compile(oh_w_replicates):
     # print(compiled)
 
 
+def grid_scenarios():
+    """Every combination of param1 and param3, in a fixed order"""
+    return [BaseScenario({"NUM_SIM": 2, "param1": p1,
+                          "param2": "constant value", "param3": p3})
+            for p1 in range(3) for p3 in (0.5, 0.25)]
+
+
+def test_store_matches_handler(oh, outcome):
+    """OutcomeStore compiles to the same DataArray as OutcomeHandler"""
+    scenarios = grid_scenarios()
+    store = OutcomeStore(scenarios, param_dims=oh.param_dims)
+    i = 0
+    for s in scenarios:
+        for replicate in range(2):
+            oh.add_outcome(s, outcome.arr * i, dims=outcome.dims)
+            store.add_outcome(s, outcome.arr * i, dims=outcome.dims)
+            i += 1
+    expected = oh._compile()
+    compiled = decode_params(store._compile())
+    assert store.n_filled == 12
+    xr.testing.assert_identical(compiled.sortby(list(compiled.dims)),
+                                expected.sortby(list(expected.dims)))
+
+
+def test_store_fills_in_place(outcome):
+    """Outcomes can be added in any order, with explicit replicates,
+    and unfilled slots are NaN
+    """
+    scenarios = grid_scenarios()
+    store = OutcomeStore(scenarios, param_dims=('param1', 'param2', 'param3'))
+    store.add_outcome(scenarios[3], outcome.arr, dims=outcome.dims,
+                      replicate=1)
+    compiled = store.outcomes
+    point = dict(param1=1, param2="constant value", param3=0.25)
+    assert select(compiled, replicate=1, **point).values.tolist() == \
+        outcome.arr.tolist()
+    assert np.isnan(select(compiled, replicate=0)).all()
+    # outcomes DataArray is a view of the store
+    store.add_outcome(scenarios[0], outcome.arr, dims=outcome.dims,
+                      replicate=0)
+    assert select(compiled, param1=0, param3=0.5, replicate=0).notnull().all()
+
+
+@pytest.mark.parametrize("kwargs", [
+    # already filled
+    dict(replicate=1),
+    # NUM_SIM is 2
+    dict(replicate=2),
+    # not in the parameter space
+    dict(scenario=BaseScenario({"NUM_SIM": 2, "param1": 5,
+                                "param2": "constant value", "param3": 0.5})),
+    # wrong shape
+    dict(arr=np.arange(10)),
+])
+def test_store_add_outcome_raises(outcome, kwargs):
+    scenarios = grid_scenarios()
+    store = OutcomeStore(scenarios, param_dims=('param1', 'param2', 'param3'))
+    store.add_outcome(scenarios[0], outcome.arr, dims=outcome.dims,
+                      replicate=1)
+    with pytest.raises(ValueError):
+        store.add_outcome(kwargs.get('scenario', scenarios[0]),
+                          kwargs.get('arr', outcome.arr),
+                          dims=outcome.dims if 'arr' not in kwargs
+                          else ('time',),
+                          replicate=kwargs.get('replicate', 0))
+
+
+@pytest.fixture()
+def coded(outcome):
+    scenarios = grid_scenarios()
+    store = OutcomeStore(scenarios, param_dims=('param3', 'param2', 'param1'))
+    for i, s in enumerate(scenarios):
+        store.add_outcome(s, outcome.arr * i, dims=outcome.dims,
+                          replicate=0)
+    yield store.outcomes
+
+
+def test_param_dims_are_coded(coded):
+    """Param dims have integer codes, and sorted labels"""
+    assert coded['param3'].values.tolist() == [0, 1]
+    assert coded['param3_label'].values.tolist() == [0.25, 0.5]
+    assert get_label_table(coded)['param1'] == [0, 1, 2]
+
+
+def test_layout_is_deterministic(outcome):
+    """Order in which scenarios are passed does not change the layout"""
+    scenarios = grid_scenarios()
+    first = OutcomeStore(scenarios, param_dims=('param1', 'param3'))
+    second = OutcomeStore(list(reversed(scenarios)),
+                          param_dims=('param1', 'param3'))
+    for store in (first, second):
+        store.add_outcome(scenarios[0], outcome.arr, dims=outcome.dims)
+    xr.testing.assert_identical(first.outcomes, second.outcomes)
+
+
+@pytest.mark.parametrize("labels", [
+    dict(param3=0.5),
+    dict(param1=2, param3=0.25, replicate=0),
+    dict(param1=[2, 0], param2="constant value"),
+])
+def test_select(coded, labels):
+    """Positional select by label is equivalent to label-based sel
+    on the decoded outcomes
+    """
+    expected = decode_params(coded).sel(**labels)
+    selected = decode_params(select(coded, **labels))
+    xr.testing.assert_identical(selected, expected)
+
+
+def test_select_raises(coded):
+    with pytest.raises(KeyError):
+        select(coded, param3=0.75)
+    with pytest.raises(ValueError):
+        select(coded, param4=0)
+
+
+def diagonal_scenarios():
+    """param3 is tied to param1, so only 3 of the 9 points in the dense
+    grid are sampled
+    """
+    return [BaseScenario({"NUM_SIM": 2, "param1": p1, "param3": p1 / 10.})
+            for p1 in range(3)]
+
+
+def fill(store, scenarios, outcome):
+    for i, s in enumerate(scenarios):
+        for replicate in range(2):
+            store.add_outcome(s, outcome.arr * i, dims=outcome.dims)
+
+
+def test_sparse_store(outcome):
+    scenarios = diagonal_scenarios()
+    store = SparseOutcomeStore(scenarios, param_dims=('param1', 'param3'))
+    fill(store, scenarios, outcome)
+    sparse = store.outcomes
+    assert sparse.dims[:2] == ('scenario', 'replicate')
+    assert sparse.sizes['scenario'] == 3
+    assert not store.is_full
+    assert not np.isnan(sparse).any()
+    # select by param coords along the scenario dim
+    selected = select(sparse, param3=0.2)
+    assert selected['param1'].values.tolist() == [2]
+    assert (selected.values == outcome.arr * 2).all()
+
+
+def test_sparse_to_dense(outcome):
+    """to_dense matches OutcomeStore, with NaN at points not sampled"""
+    scenarios = diagonal_scenarios()
+    sparse = SparseOutcomeStore(scenarios, param_dims=('param1', 'param3'))
+    dense = OutcomeStore(scenarios, param_dims=('param1', 'param3'))
+    fill(sparse, scenarios, outcome)
+    fill(dense, scenarios, outcome)
+    with pytest.raises(ValueError):
+        sparse.to_dense()
+    xr.testing.assert_identical(sparse.to_dense(allow_missing=True),
+                                dense.outcomes)
+
+
+def test_full_sparse_to_dense(outcome):
+    scenarios = grid_scenarios()
+    param_dims = ('param1', 'param2', 'param3')
+    sparse = SparseOutcomeStore(scenarios, param_dims=param_dims)
+    dense = OutcomeStore(scenarios, param_dims=param_dims)
+    fill(sparse, scenarios, outcome)
+    fill(dense, scenarios, outcome)
+    assert sparse.is_full
+    xr.testing.assert_identical(sparse.to_dense(), dense.outcomes)
+
+
+def test_store_scalars(outcome):
+    """Per-task scalars are coords along the param dims and replicate,
+    and unfilled slots are NaN, NaT, or -1
+    """
+    scenarios = grid_scenarios()
+    store = OutcomeStore(scenarios, param_dims=('param1', 'param3'))
+    for i, s in enumerate(scenarios[:3]):
+        scalars = {'step': i, 'R0': 2.5,
+                   'date': np.datetime64('2020-03-0{}'.format(i + 1), 'ns')}
+        if i:
+            scalars['late'] = i
+        store.add_outcome(s, outcome.arr, dims=outcome.dims, replicate=0,
+                          scalars=scalars)
+        if not i:
+            store.outcomes
+    # scalars added after a read of the outcomes are in the next read
+    compiled = store.outcomes
+    assert int(select(compiled, param1=1, param3=0.5,
+                      replicate=0)['late']) == 2
+    assert compiled['step'].dims == ('param1', 'param3', 'replicate')
+    point = select(compiled, param1=1, param3=0.5, replicate=0)
+    assert int(point['step']) == 2
+    assert point['date'].values == np.datetime64('2020-03-03')
+    assert select(compiled, param1=2, replicate=1)['step'].values.tolist() \
+        == [-1, -1]
+    assert np.isnat(select(compiled, param1=2)['date'].values).all()
+    assert np.isnan(select(compiled, param1=2)['R0'].values).all()
+
+
+def test_sparse_to_dense_scalars(outcome):
+    scenarios = diagonal_scenarios()
+    sparse = SparseOutcomeStore(scenarios, param_dims=('param1', 'param3'))
+    dense = OutcomeStore(scenarios, param_dims=('param1', 'param3'))
+    for store in (sparse, dense):
+        for i, s in enumerate(scenarios):
+            store.add_outcome(s, outcome.arr, dims=outcome.dims,
+                              scalars={'step': i})
+    assert sparse.outcomes['step'].dims == ('scenario', 'replicate')
+    xr.testing.assert_identical(sparse.to_dense(allow_missing=True),
+                                dense.outcomes)
+
+
+def replicate_scenarios():
+    return [BaseScenario({"NUM_SIM": 5, "param1": p1, "param3": 0.5})
+            for p1 in range(2)]
+
+
+def fill_replicates(store, scenarios, outcome):
+    for i, s in enumerate(scenarios):
+        for replicate in range(5):
+            store.add_outcome(s, outcome.arr * (i + 1) + replicate ** 2,
+                              dims=outcome.dims)
+
+
+@pytest.mark.parametrize("store_cls", [
+    SummaryOutcomeStore,
+    SparseSummaryOutcomeStore,
+])
+def test_summary_store(outcome, store_cls):
+    """Summary statistics match those of the full outcomes"""
+    scenarios = replicate_scenarios()
+    param_dims = ('param1', 'param3')
+    full = OutcomeStore(scenarios, param_dims=param_dims)
+    summary = store_cls(scenarios, param_dims=param_dims,
+                        compartments=[3, 1], quantiles=(0.1, 0.5))
+    fill_replicates(full, scenarios, outcome)
+    fill_replicates(summary, scenarios, outcome)
+    assert summary.n_filled == full.n_filled == 10
+    with pytest.raises(ValueError):
+        summary.add_outcome(scenarios[0], outcome.arr, dims=outcome.dims)
+    summarized = summary.outcomes
+    assert summarized.dims[-3:] == ('statistic', 'compartment', 'time')
+    assert list(summarized['statistic'].values) == [
+        'mean', 'std', 'min', 'max', 'q0.1', 'q0.5']
+    assert (summarized['n_replicates'] == 5).all()
+
+    expected = select(full.outcomes, param1=1, param3=0.5, compartment=[3, 1])
+    selected = select(summarized, param1=1, param3=0.5)
+    if 'scenario' in selected.dims:
+        selected = selected.isel(scenario=0)
+    np.testing.assert_allclose(
+        select(selected, statistic='mean'), expected.mean('replicate'))
+    np.testing.assert_allclose(
+        select(selected, statistic='std'), expected.std('replicate', ddof=1))
+    np.testing.assert_allclose(
+        select(selected, statistic='q0.1'),
+        expected.quantile(0.1, dim='replicate'))
+    np.testing.assert_allclose(
+        select(selected, statistic='max'), expected.max('replicate'))
+
+
+def test_summary_store_merge(outcome):
+    """Summaries of replicates split across stores can be merged"""
+    scenarios = replicate_scenarios()
+    whole = SummaryOutcomeStore(scenarios, param_dims=('param1', 'param3'))
+    fill_replicates(whole, scenarios, outcome)
+    parts = [SummaryOutcomeStore(scenarios, param_dims=('param1', 'param3'))
+             for _ in range(2)]
+    arr = outcome.arr
+    for i, s in enumerate(scenarios):
+        for replicate in range(5):
+            parts[replicate % 2].add_outcome(
+                s, arr * (i + 1) + replicate ** 2, dims=outcome.dims)
+    parts[0].merge(parts[1])
+    assert parts[0].n_filled == 10
+    xr.testing.assert_allclose(parts[0].outcomes, whole.outcomes)
+
+
 @pytest.mark.skip
 @pytest.mark.parametrize("legacy_pickle", [
     fp("tests/data/single_scenario_flat_to_da_result0.pckl"),
@@ -0,0 +1,138 @@
+import os
+import json
+import pytest
+import numpy as np
+import xarray as xr
+from .pytest_utils import fp
+from SEIRcity.outcome_handler import OutcomeStore, SparseOutcomeStore, select
+from SEIRcity.scenario import BaseScenario
+from SEIRcity.simulate.worker_pool import WorkerPool
+from SEIRcity.simulate.simulate_multiple import simulate_multiple
+from SEIRcity.simulate.multiple_pool import multiple_pool
+from SEIRcity.param import aggregate_params_and_data
+
+zarr = pytest.importorskip('zarr')
+from SEIRcity import outcome_io
+
+
+def grid_scenarios():
+    """Every combination of param1 and param3, in a fixed order"""
+    return [BaseScenario({"NUM_SIM": 2, "param1": p1, "param3": p3})
+            for p1 in range(3) for p3 in (0.5, 0.25)]
+
+
+def diagonal_scenarios():
+    return [BaseScenario({"NUM_SIM": 2, "param1": p1, "param3": p1 / 10.})
+            for p1 in range(3)]
+
+
+def fill(store, scenarios):
+    arr = np.arange(40, dtype=float).reshape((4, 10))
+    for i, s in enumerate(scenarios):
+        for replicate in range(2):
+            store.add_outcome(s, arr * i + replicate,
+                              dims=('compartment', 'time'))
+
+
+@pytest.mark.parametrize("store_cls, zarr_cls, scenarios", [
+    (OutcomeStore, outcome_io.ZarrOutcomeStore, grid_scenarios()),
+    (SparseOutcomeStore, outcome_io.SparseZarrOutcomeStore,
+     diagonal_scenarios()),
+])
+def test_zarr_store_matches_memory(store_cls, zarr_cls, scenarios, tmp_path):
+    """Outcomes streamed to a Zarr store are identical to the outcomes
+    held in memory, and are chunked by scenario, replicate, and
+    compartment
+    """
+    out_fp = str(tmp_path / "out.zarr")
+    param_dims = ('param1', 'param3')
+    in_memory = store_cls(scenarios, param_dims=param_dims)
+    on_disk = zarr_cls(scenarios, out_fp=out_fp, param_dims=param_dims)
+    fill(in_memory, scenarios)
+    fill(on_disk, scenarios)
+    on_disk.close()
+
+    opened = outcome_io.open_outcomes(out_fp)
+    xr.testing.assert_equal(opened.load(), in_memory.outcomes)
+    arr = zarr.open_group(out_fp, mode='r')[outcome_io.OUTCOMES_VAR]
+    assert arr.chunks == (1,) * (arr.ndim - 1) + (10,)
+    assert arr.attrs['param_dims'] == list(param_dims)
+
+
+def test_open_is_lazy(tmp_path):
+    """Selecting from opened outcomes reads only the selected chunks"""
+    out_fp = str(tmp_path / "out.zarr")
+    scenarios = grid_scenarios()
+    store = outcome_io.ZarrOutcomeStore(scenarios, out_fp=out_fp,
+                                        param_dims=('param1', 'param3'))
+    fill(store, scenarios)
+    store.close()
+    opened = outcome_io.open_outcomes(out_fp)
+    assert not isinstance(opened.variable._data, np.ndarray)
+    selected = select(opened, param1=2, param3=0.5, replicate=1,
+                      compartment=3)
+    expected = np.arange(30, 40, dtype=float) * 4 + 1
+    assert selected.values.tolist() == expected.tolist()
+
+
+def test_missing_outcomes_are_nan(tmp_path):
+    out_fp = str(tmp_path / "out.zarr")
+    scenarios = grid_scenarios()
+    store = outcome_io.ZarrOutcomeStore(scenarios, out_fp=out_fp,
+                                        param_dims=('param1', 'param3'))
+    fill(store, scenarios[:1])
+    store.close()
+    opened = outcome_io.open_outcomes(out_fp)
+    assert np.isnan(select(opened, param1=2)).all()
+    assert not np.isnan(select(opened, param1=0, param3=0.5)).any()
+
+
+def test_scalars(tmp_path):
+    """Per-task scalars are written as coords of the Zarr store"""
+    out_fp = str(tmp_path / "out.zarr")
+    scenarios = grid_scenarios()
+    store = outcome_io.ZarrOutcomeStore(scenarios, out_fp=out_fp,
+                                        param_dims=('param1', 'param3'))
+    arr = np.ones((4, 10))
+    for i, s in enumerate(scenarios):
+        store.add_outcome(s, arr, dims=('compartment', 'time'), replicate=0,
+                          scalars={'step': i, 'date': np.datetime64(
+                              '2020-03-01T06', 'ns') if i else
+                              np.datetime64('NaT', 'ns')})
+    store.close()
+    opened = outcome_io.open_outcomes(out_fp)
+    assert opened['step'].dims == ('param1', 'param3', 'replicate')
+    assert select(opened, param1=2, param3=0.5, replicate=0)['step'] == 4
+    assert select(opened, replicate=1)['step'].values.max() == -1
+    dates = select(opened, replicate=0)['date'].values
+    assert np.isnat(dates).sum() == 1
+    assert dates[~np.isnat(dates)].max() == np.datetime64('2020-03-01T06')
+
+
+def test_write_zarr(tmp_path):
+    """In-memory stores are written to Zarr by to_file"""
+    out_fp = str(tmp_path / "out.zarr")
+    scenarios = grid_scenarios()
+    store = OutcomeStore(scenarios, param_dims=('param1', 'param3'))
+    fill(store, scenarios)
+    store.to_file(out_fp)
+    xr.testing.assert_equal(outcome_io.open_outcomes(out_fp).load(),
+                            store.outcomes)
+
+
+@pytest.mark.parametrize("yaml_fp", [
+    fp("tests/data/configs/austin_short0.yaml"),
+])
+def test_simulate_multiple_zarr(yaml_fp, tmp_path):
+    """simulate_multiple streams outcomes to a Zarr store, with the
+    config as metadata
+    """
+    config = aggregate_params_and_data(yaml_fp=yaml_fp)
+    out_fp = str(tmp_path / "out.zarr")
+    with WorkerPool(threads=2) as pool:
+        outcomes = simulate_multiple(config, out_fp=out_fp, pool=pool)
+        expected = multiple_pool(config, pool=pool).outcomes
+    assert os.path.isdir(out_fp)
+    xr.testing.assert_equal(outcomes.load(), expected)
+    metadata = json.loads(outcomes.attrs['config'])
+    assert metadata['n_age'] == config['n_age']
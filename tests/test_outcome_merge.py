@@ -0,0 +1,177 @@
+import pytest
+import numpy as np
+import pandas as pd
+import xarray as xr
+from SEIRcity.outcome_handler import OutcomeStore, SparseOutcomeStore, \
+    SummaryOutcomeStore, select
+from SEIRcity.scenario import BaseScenario
+from SEIRcity.outcome_merge import read_schema, plan_merge, merge_outcomes
+
+PARAM_DIMS = ('param1', 'param3')
+TIMES = pd.date_range('2020-03-01', periods=10, freq='6H')
+
+
+def grid_scenarios(param1=(0, 1, 2), n_sim=2):
+    return [BaseScenario({"NUM_SIM": n_sim, "param1": p1, "param3": p3})
+            for p1 in param1 for p3 in (0.5, 0.25)]
+
+
+def diagonal_scenarios(param1=(0, 1, 2)):
+    return [BaseScenario({"NUM_SIM": 2, "param1": p1, "param3": p1 / 10.})
+            for p1 in param1]
+
+
+def fill(store, scenarios, first_replicate=0):
+    """Fills every replicate of every scenario with an outcome that
+    depends on its params and replicate, but not on the store
+    """
+    arr = np.arange(40, dtype=float).reshape((4, 10))
+    for s in scenarios:
+        for i in range(s['NUM_SIM']):
+            replicate = first_replicate + i
+            store.add_outcome(s, arr * s['param1'] + s['param3'] + replicate,
+                              dims=('compartment', 'time'),
+                              coords={'time': TIMES},
+                              replicate=i if first_replicate else None,
+                              scalars={'step': replicate})
+    return store
+
+
+def write(store, fp):
+    store.to_file(str(fp))
+    return str(fp)
+
+
+@pytest.fixture(params=['.pckl', '.zarr'])
+def ext(request):
+    if request.param == '.zarr':
+        pytest.importorskip('zarr')
+    yield request.param
+
+
+def test_merge_param_dim(ext, tmp_path):
+    """Shards of a sweep split by param1 merge to the outcomes of the
+    whole sweep
+    """
+    scenarios = grid_scenarios()
+    expected = fill(OutcomeStore(scenarios, param_dims=PARAM_DIMS),
+                    scenarios).outcomes
+    fps = list()
+    # shards out of order, and of different sizes
+    for i, param1 in enumerate([(2,), (0, 1)]):
+        shard_scenarios = grid_scenarios(param1)
+        shard = fill(OutcomeStore(shard_scenarios, param_dims=PARAM_DIMS),
+                     shard_scenarios)
+        fps.append(write(shard, tmp_path / "shard{}{}".format(i, ext)))
+    merged = merge_outcomes(fps, str(tmp_path / ("merged" + ext)),
+                            dim='param1')
+    xr.testing.assert_equal(merged.load(), expected)
+
+
+def test_merge_replicates(ext, tmp_path):
+    """Replicates of each shard are numbered after those of the previous
+    shards, and per-task scalars are kept
+    """
+    scenarios = grid_scenarios(n_sim=4)
+    expected = fill(OutcomeStore(scenarios, param_dims=PARAM_DIMS),
+                    scenarios).outcomes
+    fps = list()
+    for i in range(2):
+        shard_scenarios = grid_scenarios(n_sim=2)
+        shard = fill(OutcomeStore(shard_scenarios, param_dims=PARAM_DIMS),
+                     shard_scenarios, first_replicate=2 * i)
+        fps.append(write(shard, tmp_path / "shard{}{}".format(i, ext)))
+    merged = merge_outcomes(fps, str(tmp_path / ("merged" + ext)))
+    xr.testing.assert_equal(merged.load(), expected)
+    assert select(merged, param1=1, param3=0.5)['step'].values.tolist() == \
+        [0, 1, 2, 3]
+
+
+def test_merge_sparse(tmp_path):
+    """Shards of sparse outcomes are merged along 'scenario', in the
+    order of SparseOutcomeStore
+    """
+    scenarios = diagonal_scenarios()
+    expected = fill(SparseOutcomeStore(scenarios, param_dims=PARAM_DIMS),
+                    scenarios).outcomes
+    fps = list()
+    for i, param1 in enumerate([(1,), (2, 0)]):
+        shard_scenarios = diagonal_scenarios(param1)
+        shard = fill(SparseOutcomeStore(shard_scenarios,
+                                        param_dims=PARAM_DIMS),
+                     shard_scenarios)
+        fps.append(write(shard, tmp_path / "shard{}.pckl".format(i)))
+    merged = merge_outcomes(fps, str(tmp_path / "merged.pckl"), dim='param1')
+    xr.testing.assert_equal(merged, expected)
+
+
+def test_pad_replicates(tmp_path):
+    """Shards with fewer replicates are padded with NaN"""
+    fps = list()
+    for param1, n_sim in [(0, 2), (1, 3)]:
+        shard_scenarios = grid_scenarios((param1,), n_sim=n_sim)
+        shard = fill(OutcomeStore(shard_scenarios, param_dims=PARAM_DIMS),
+                     shard_scenarios)
+        fps.append(write(shard, tmp_path / "shard{}.pckl".format(param1)))
+    merged = merge_outcomes(fps, str(tmp_path / "merged.pckl"), dim='param1')
+    assert merged.sizes['replicate'] == 3
+    assert np.isnan(select(merged, param1=0, replicate=2)).all()
+    assert not np.isnan(select(merged, param1=1, replicate=2)).any()
+    assert select(merged, param1=0, replicate=2)['step'].values.tolist() == \
+        [-1, -1]
+
+
+def test_schema_does_not_read_outcomes(tmp_path):
+    """Schemas of Zarr stores are read from metadata and coords"""
+    zarr = pytest.importorskip('zarr')
+    scenarios = grid_scenarios()
+    fp = write(fill(OutcomeStore(scenarios, param_dims=PARAM_DIMS),
+                    scenarios), tmp_path / "shard.zarr")
+    # outcomes that cannot be read
+    group = zarr.open_group(fp, mode='r+')
+    for key in list(group['outcomes'].store):
+        if key.startswith('outcomes/') and not key.split('/')[-1] \
+                .startswith('.'):
+            del group['outcomes'].store[key]
+    schema = read_schema(fp)
+    assert schema['dims'] == PARAM_DIMS + ('replicate', 'compartment',
+                                           'time')
+    assert schema['labels']['param1'] == [0, 1, 2]
+    assert schema['aux_coords']['step'][0] == PARAM_DIMS + ('replicate',)
+
+
+def shard_schemas(tmp_path, stores):
+    return [read_schema(write(store, tmp_path / "shard{}.pckl".format(i)))
+            for i, store in enumerate(stores)]
+
+
+def test_overlapping_labels_raise(tmp_path):
+    stores = [fill(OutcomeStore(grid_scenarios(param1),
+                                param_dims=PARAM_DIMS),
+                   grid_scenarios(param1))
+              for param1 in [(0, 1), (1, 2)]]
+    with pytest.raises(ValueError, match="Label 1 of param1"):
+        plan_merge(shard_schemas(tmp_path, stores), dim='param1')
+
+
+def test_different_labels_raise(tmp_path):
+    """Shards must have the same labels of every other dim"""
+    first = fill(OutcomeStore(grid_scenarios((0,)), param_dims=PARAM_DIMS),
+                 grid_scenarios((0,)))
+    second = OutcomeStore(grid_scenarios((1,)), param_dims=PARAM_DIMS)
+    for s in grid_scenarios((1,)):
+        second.add_outcome(s, np.ones((4, 10)), dims=('compartment', 'time'),
+                           coords={'time': TIMES + pd.Timedelta('1D')},
+                           scalars={'step': 0})
+    with pytest.raises(ValueError, match="labels of time"):
+        plan_merge(shard_schemas(tmp_path, [first, second]), dim='param1')
+
+
+def test_summary_replicates_raise(tmp_path):
+    scenarios = grid_scenarios()
+    store = SummaryOutcomeStore(scenarios, param_dims=PARAM_DIMS)
+    for s in scenarios:
+        store.add_outcome(s, np.ones((4, 10)), dims=('compartment', 'time'),
+                          coords={'time': TIMES})
+    with pytest.raises(ValueError, match="summary statistics"):
+        plan_merge(shard_schemas(tmp_path, [store, store]), dim='replicate')
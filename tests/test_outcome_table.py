@@ -0,0 +1,97 @@
+import pytest
+import numpy as np
+import pandas as pd
+from SEIRcity.outcome_handler import (OutcomeStore, SparseOutcomeStore,
+                                      decode_params)
+from SEIRcity.scenario import BaseScenario
+
+pq = pytest.importorskip('pyarrow.parquet')
+from SEIRcity.outcome_table import write_parquet
+
+TIMES = pd.date_range('2020-03-01', periods=8, freq='6H')
+
+
+def grid_scenarios():
+    return [BaseScenario({"NUM_SIM": 2, "param1": p1, "param3": p3})
+            for p1 in ('low', 'high') for p3 in (0.5, 0.25)]
+
+
+def diagonal_scenarios():
+    return [BaseScenario({"NUM_SIM": 2, "param1": p1, "param3": p1 / 10.})
+            for p1 in range(3)]
+
+
+def fill(store, scenarios):
+    arr = np.arange(24, dtype=float).reshape((3, 8))
+    for i, s in enumerate(scenarios):
+        for replicate in range(2):
+            store.add_outcome(s, arr * i + replicate,
+                              dims=('compartment', 'time'),
+                              coords={'compartment': ['S', 'Ih', 'D'],
+                                      'time': TIMES})
+    return store
+
+
+@pytest.fixture()
+def store():
+    scenarios = grid_scenarios()
+    yield fill(OutcomeStore(scenarios, param_dims=('param1', 'param3')),
+               scenarios)
+
+
+def test_matches_to_dataframe(store, tmp_path):
+    """Parquet rows are the same as the long-format DataFrame of the
+    decoded outcomes
+    """
+    out_fp = str(tmp_path / "out.parquet")
+    n_rows = store.to_parquet(out_fp)
+    expected = decode_params(store.outcomes).to_dataframe(
+        name='value').reset_index()
+    assert n_rows == len(expected)
+    # one row group per point in parameter space
+    assert pq.ParquetFile(out_fp).num_row_groups == 4
+
+    table = pq.read_table(out_fp)
+    assert str(table.schema.field('param1').type).startswith('dictionary')
+    assert str(table.schema.field('time').type) == 'timestamp[ns]'
+    df = table.to_pandas()
+    for col in ('param1', 'param3', 'compartment'):
+        df[col] = df[col].astype(object)
+    keys = ['param1', 'param3', 'replicate', 'compartment', 'time']
+    df = df.sort_values(keys).reset_index(drop=True)
+    expected = expected.sort_values(keys).reset_index(drop=True)
+    pd.testing.assert_frame_equal(df[expected.columns], expected,
+                                  check_dtype=False)
+
+
+def test_filter_and_aggregate(store, tmp_path):
+    out_fp = str(tmp_path / "out.parquet")
+    store.to_parquet(out_fp, compartments=['Ih'], time_freq='1D',
+                     time_how='max')
+    df = pq.read_table(out_fp).to_pandas()
+    assert set(df['compartment']) == {'Ih'}
+    assert len(set(df['time'])) == 2
+    point = df[(df['param1'] == 'high') & (df['param3'] == 0.25) &
+               (df['replicate'] == 1)].sort_values('time')
+    # outcome of the fourth scenario, i.e. 3 * arange + 1, at 6H steps
+    assert point['value'].tolist() == [3 * 11. + 1, 3 * 15. + 1]
+
+
+def test_sparse(tmp_path):
+    """Params of a SparseOutcomeStore are written as columns"""
+    scenarios = diagonal_scenarios()
+    store = fill(SparseOutcomeStore(scenarios,
+                                    param_dims=('param1', 'param3')),
+                 scenarios)
+    out_fp = str(tmp_path / "out.parquet")
+    store.to_parquet(out_fp)
+    df = pq.read_table(out_fp).to_pandas()
+    assert len(df) == store.outcomes.size
+    pairs = set(zip(df['param1'].astype(int), df['param3'].astype(float)))
+    assert pairs == {(0, 0.), (1, 0.1), (2, 0.2)}
+
+
+def test_bad_time_how(store, tmp_path):
+    with pytest.raises(ValueError):
+        store.to_parquet(str(tmp_path / "out.parquet"), time_freq='1D',
+                         time_how='median_of_means')
@@ -1,4 +1,5 @@
 import pickle
+from collections import OrderedDict
 from attrdict import AttrDict
 import os
 import sys
@@ -70,3 +71,37 @@ def test_get_param_legacy(legacy_pickle, yaml_fp):
     assert isinstance(legacy_result, dict)
     assert isinstance(new_result, dict)
     assert_objects_equal(legacy_result, new_result, verbose=False)
+
+
+def test_override_epi_params():
+    """Overriding ASYMP_RATE recomputes the ratios derived from it"""
+    config = param.aggregate_params_and_data(
+        yaml_fp=fp("tests/data/configs/austin_short0.yaml"))
+    same = param.override_epi_params(
+        config, {'ASYMP_RATE': config['ASYMP_RATE']})
+    assert (same['symp_h_ratio'] == config['symp_h_ratio']).all()
+    other = param.override_epi_params(
+        config, {'ASYMP_RATE': config['ASYMP_RATE'] + 0.2})
+    assert (other['symp_h_ratio'] > config['symp_h_ratio']).all()
+    assert (other['symp_h_ratio_overall'] >
+            config['symp_h_ratio_overall']).all()
+    # the config is not modified
+    assert config['ASYMP_RATE'] == same['ASYMP_RATE']
+    # overridden ratios are kept
+    ratio = config['hosp_f_ratio'] * 2
+    both = param.override_epi_params(
+        config, {'ASYMP_RATE': 0.5, 'hosp_f_ratio': ratio})
+    assert both['hosp_f_ratio'] is ratio
+
+
+def test_city_data_cache_is_bounded(monkeypatch):
+    """Least recently used city data is dropped from the cache"""
+    config = param.aggregate_params_and_data(
+        yaml_fp=fp("tests/data/configs/austin_short0.yaml"))
+    monkeypatch.setattr(param, 'CITY_DATA_CACHE_SIZE', 2)
+    monkeypatch.setattr(param, '_CITY_DATA_CACHE', OrderedDict())
+    configs = [dict(config, ASYMP_RATE=rate) for rate in (0.1, 0.2, 0.3)]
+    for c in configs[:2] + configs[:1] + configs[2:]:
+        param.get_data_cached(c)
+    keys = [param.get_data_cache_key(c) for c in configs]
+    assert list(param._CITY_DATA_CACHE) == [keys[0], keys[2]]
@@ -0,0 +1,55 @@
+import os
+import json
+import pytest
+import numpy as np
+from .pytest_utils import fp
+from SEIRcity.simulate.plan import plan_sweep
+from SEIRcity.simulate.worker_pool import WorkerPool
+from SEIRcity.simulate.multiple_pool import multiple_pool
+from SEIRcity.param import aggregate_params_and_data
+import SEIRcity as main
+
+
+@pytest.fixture()
+def config():
+    yield aggregate_params_and_data(
+        yaml_fp=fp("tests/data/configs/austin_short0.yaml"))
+
+
+def test_estimates_match_outcomes(config):
+    """Estimated output size matches the compiled outcomes"""
+    plan = plan_sweep(config, threads=2, calibrate=False)
+    assert plan['n_tasks'] == 4
+    # deterministic replicates are simulated once
+    assert plan['n_simulations'] == 2
+    assert plan['seconds_per_task'] is None
+    with WorkerPool(threads=2) as pool:
+        outcomes = multiple_pool(config, pool=pool).outcomes
+    assert plan['output_bytes'] == outcomes.nbytes
+    assert dict(outcomes.sizes) == plan['dim_sizes']
+    assert plan['fill_fraction'] == 1.
+
+
+@pytest.mark.parametrize("memory, stream_to_disk", [
+    (None, False),
+    (1024, True),
+])
+def test_recommendations(config, memory, stream_to_disk):
+    plan = plan_sweep(config, threads=48, calibrate=True, memory=memory)
+    assert plan['seconds_per_task'] > 0
+    assert plan['estimated_wall_seconds'] >= plan['seconds_per_task']
+    assert 1 <= plan['threads'] <= plan['n_simulations']
+    assert plan['chunksize'] == 1
+    if memory is not None:
+        assert plan['stream_to_disk'] == stream_to_disk
+
+
+def test_plan_mode(tmp_path):
+    out_fp = str(tmp_path / "plan.json")
+    main.main(config_yaml=fp("tests/data/configs/austin_short0.yaml"),
+              out_fp=out_fp, threads=2, mode='plan')
+    with open(out_fp, 'r') as f:
+        plan = json.load(f)
+    assert plan['n_tasks'] == 4
+    # nothing was written besides the plan
+    assert os.listdir(str(tmp_path)) == ["plan.json"]
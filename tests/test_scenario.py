@@ -1,11 +1,13 @@
 import os
 import sys
+import pickle
 import pytest
 import numpy as np
 from attrdict import AttrDict
 from copy import deepcopy
 from .pytest_utils import fp, md5sum, assert_objects_equal
-from SEIRcity.scenario import BaseScenario, _inject
+from SEIRcity.scenario import BaseScenario, Task, _inject, _get_template, \
+    get_template_keys, to_scenario
 
 HERE = os.path.dirname(os.path.abspath(__file__))
 CWD = os.getcwd()
@@ -78,6 +80,55 @@ class TestScenario(object):
         scenario.inject()
         assert getattr(scenario, attr_name) == getattr(scenario, attr_name, "dummy")
 
+    def test_inject_keys(self):
+        """Only the values of `keys` are injected"""
+        scenario = BaseScenario({'a': '{{c}}', 'b': ['x{{c}}'], 'c': 2},
+                                inject=False)
+        assert get_template_keys(scenario) == ('a', 'b')
+        scenario.inject(keys=['b'])
+        assert scenario == {'a': '{{c}}', 'b': ['x2'], 'c': 2}
+
+    def test_clone_is_not_injected(self):
+        scenario = BaseScenario({'a': '{{b}}', 'b': 'c'})
+        scenario['b'] = '{{a}}'
+        clone = scenario.clone(seed=3)
+        assert clone == {'a': 'c', 'b': '{{a}}', 'seed': 3}
+        assert 'seed' not in scenario
+
+
+class TestTask(object):
+
+    @pytest.fixture()
+    def task(self, base_scenario):
+        yield Task(base_scenario, replicate=2, seed=5)
+
+    def test_is_mapping(self, task, base_scenario):
+        assert dict(task) == dict(base_scenario, seed=5)
+        assert task.get('foo') == 'bar'
+        assert 'seed' in task and 'seed' not in base_scenario
+
+    def test_shares_scenario(self, base_scenario):
+        """Setting a key of a Task sets it for every replicate"""
+        tasks = [Task(base_scenario, replicate=i, seed=i) for i in range(3)]
+        tasks[0]['config'] = {'n_age': 5}
+        assert all([t['config'] == {'n_age': 5} for t in tasks])
+        assert [t['seed'] for t in tasks] == [0, 1, 2]
+
+    def test_pickle(self, base_scenario):
+        """Replicates pickle one copy of their Scenario"""
+        tasks = [Task(base_scenario, replicate=i, seed=i) for i in range(3)]
+        loaded = pickle.loads(pickle.dumps(tasks))
+        assert loaded[2].replicate == 2 and loaded[2]['seed'] == 2
+        assert loaded[0].scenario is loaded[2].scenario
+
+    def test_to_scenario(self, task):
+        scenario = to_scenario(task)
+        assert isinstance(scenario, BaseScenario)
+        assert scenario == dict(task)
+        scenario['foo'] = 'baz'
+        assert task['foo'] == 'bar'
+        assert to_scenario(scenario) is scenario
+
 
 class TestHiddenInject(object):
 
@@ -92,6 +143,15 @@ class TestHiddenInject(object):
         """Can support recursion in types str, set, tuple, list, and dict."""
         assert _inject(data, populate_with) == expected
 
+    def test_template_is_cached(self):
+        _get_template.cache_clear()
+        for _ in range(3):
+            assert _inject("x{{inject_me}}", {'inject_me': 1}) == "x1"
+        assert _get_template.cache_info().hits == 2
+        # strings that are not templates are not compiled
+        assert _inject("plain", {'inject_me': 1}) == "plain"
+        assert _get_template.cache_info().currsize == 1
+
     @pytest.mark.parametrize('data,expected', [
         ({'inject_test': 'foo bar{{inject_me}}', 'inject_me': 'beezbooz'},
          {'inject_test': 'foo barbeezbooz', 'inject_me': 'beezbooz'}),
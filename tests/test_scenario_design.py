@@ -0,0 +1,158 @@
+import itertools
+import pytest
+import numpy as np
+import pandas as pd
+from .pytest_utils import fp
+from SEIRcity.scenario_design import (GridDesign, ListDesign, ProductDesign,
+                                      LatinHypercubeDesign, PosteriorDesign,
+                                      get_design, get_param_dims)
+from SEIRcity.get_scenarios import get_scenarios, iter_scenarios
+from SEIRcity.simulate.multiple_pool import get_tasks, new_store
+from SEIRcity.outcome_handler import SparseOutcomeStore
+from SEIRcity.param import aggregate_params_and_data
+
+
+@pytest.fixture()
+def config():
+    config = aggregate_params_and_data(
+        yaml_fp=fp("tests/data/configs/austin_short0.yaml"))
+    yield config
+
+
+def test_grid_is_nested_loops():
+    axes = [('a', [1, 2, 3]), ('b', ['x', 'y']), ('c', [0.5])]
+    grid = GridDesign(axes)
+    expected = [{'a': a, 'b': b, 'c': c} for a, b, c in
+                itertools.product(*[values for _, values in axes])]
+    assert len(grid) == 6
+    assert list(grid) == expected
+    assert grid[4] == expected[4]
+    assert grid[-1] == expected[-1]
+    with pytest.raises(IndexError):
+        grid[6]
+
+
+def test_product_of_designs():
+    points = ListDesign([{'b': 1, 'c': 2}, {'b': 3, 'c': 4}])
+    design = ProductDesign([GridDesign({'a': [0, 1]}), points])
+    assert design.keys == ('a', 'b', 'c')
+    assert not design.is_grid
+    assert list(design) == [{'a': 0, 'b': 1, 'c': 2}, {'a': 0, 'b': 3, 'c': 4},
+                            {'a': 1, 'b': 1, 'c': 2}, {'a': 1, 'b': 3, 'c': 4}]
+    with pytest.raises(ValueError):
+        ProductDesign([GridDesign({'a': [0]}), GridDesign({'a': [1]})])
+
+
+def test_lhs_is_stratified():
+    n = 5000
+    design = LatinHypercubeDesign(
+        {'R0': {'low': 1.5, 'high': 3.5}, 'shift_week': {'low': 0, 'high': 4},
+         'g_rate': ['low', 'high']}, n=n, seed=1)
+    points = list(design)
+    r0 = np.array([p['R0'] for p in points])
+    assert ((r0 >= 1.5) & (r0 < 3.5)).all()
+    # one point in each of n strata
+    strata = np.floor((r0 - 1.5) / 2. * n).astype(int)
+    assert sorted(strata) == list(range(n))
+    weeks = [p['shift_week'] for p in points]
+    assert all([isinstance(w, int) for w in weeks])
+    assert np.bincount(weeks).tolist() == [n // 4] * 4
+    assert [p['g_rate'] for p in points].count('low') == n // 2
+
+
+def test_lhs_random_access():
+    """Any point can be computed without the others, and the same seed
+    gives the same design
+    """
+    ranges = {'R0': {'low': 1.5, 'high': 3.5}}
+    design = LatinHypercubeDesign(ranges, n=10000, seed=3)
+    points = list(design)
+    again = LatinHypercubeDesign(ranges, n=10000, seed=3)
+    for i in (9999, 0, 5000, 4095, 4096):
+        assert again[i] == points[i]
+    assert LatinHypercubeDesign(ranges, n=10000, seed=4)[0] != points[0]
+
+
+def test_default_design(config):
+    """Without scenario_design, scenarios are the grid of the sweep
+    lists of the config, in the same order as before
+    """
+    config['CONTACT_REDUCTION'] = [0.0, 0.5]
+    config['GROWTH_RATE_LIST'] = ['high', 'low']
+    config['beta0_dict'] = {'high': 0.0345, 'low': 0.02}
+    config['REOPEN_TRIGGER_LIST'] = ['no_na_20200818']
+    scenarios = get_scenarios(config)
+    expected = list(itertools.product(
+        config['GROWTH_RATE_LIST'], config['CONTACT_REDUCTION'],
+        config['CLOSE_TRIGGER_LIST'], config['REOPEN_TRIGGER_LIST']))
+    assert [(s['g_rate'], s['c_reduction'], s['close_trigger'],
+             s['reopen_trigger']) for s in scenarios] == expected
+    assert [s['beta0'] for s in scenarios] == [0.0345] * 2 + [0.02] * 2
+    assert get_param_dims(config) == ('close_trigger', 'reopen_trigger',
+                                      'g_rate', 'c_reduction', 'beta0')
+
+
+def test_swept_keys_override_config(config):
+    config['scenario_design'] = {
+        'type': 'list',
+        'points': [{'time_begin_sim': 20200301, 'c_reduction': 0.2},
+                   {'time_begin_sim': 20200308, 'c_reduction': 0.3}]}
+    scenarios = list(iter_scenarios(config))
+    # crossed with the one value of the sweep keys that are not swept
+    assert len(scenarios) == 2
+    assert [s['time_begin_sim'] for s in scenarios] == [20200301, 20200308]
+    assert [s['c_reduction'] for s in scenarios] == [0.2, 0.3]
+    assert scenarios[0]['g_rate'] == 'high'
+    assert 'time_begin_sim' in get_param_dims(config)
+
+
+def test_lhs_store_is_sparse(config):
+    config['scenario_design'] = {
+        'type': 'lhs', 'n': 3, 'seed': 2,
+        'params': {'c_reduction': {'low': 0., 'high': 0.9},
+                   'ASYMP_RATE': {'low': 0.1, 'high': 0.5}}}
+    tasks, replicates, time_coords = get_tasks(config)
+    assert len(tasks) == 3 * config['NUM_SIM']
+    store = new_store(tasks, config)
+    assert isinstance(store, SparseOutcomeStore)
+    assert store.param_dims[-1] == 'ASYMP_RATE'
+    # the config is not pickled with every task sent to a worker
+    assert store.config is config
+    assert 'config' not in tasks[0]
+
+
+def test_posterior_design(config, tmp_path):
+    posterior = pd.DataFrame({'beta0': [0.02, 0.03, 0.04],
+                              'c_reduction': [0.1, 0.2, 0.3],
+                              'weight': [0.5, 0.25, 0.25],
+                              'distance': [1., 2., 3.]})
+    design = PosteriorDesign(posterior, n=100, seed=0)
+    assert design.keys == ('posterior_sample', 'beta0', 'c_reduction')
+    points = list(design)
+    assert [p['posterior_sample'] for p in points] == list(range(100))
+    # systematic resampling draws each particle n * weight times
+    assert [p['beta0'] for p in points].count(0.02) == 50
+    assert [p['c_reduction'] for p in points].count(0.3) == 25
+
+    fp_ = str(tmp_path / 'fit_posterior.csv')
+    posterior.to_csv(fp_, index=False)
+    config['scenario_design'] = {'type': 'posterior', 'fp': fp_, 'n': 4}
+    scenarios = list(iter_scenarios(config))
+    assert len(scenarios) == 4
+    assert [s['c_reduction'] for s in scenarios] == [0.1, 0.1, 0.2, 0.3]
+    assert [s['beta0'] for s in scenarios] == [0.02, 0.02, 0.03, 0.04]
+    tasks, replicates, time_coords = get_tasks(config)
+    assert len(tasks) == 4 * config['NUM_SIM']
+    assert isinstance(new_store(tasks, config), SparseOutcomeStore)
+
+
+@pytest.mark.parametrize("spec", [
+    {'type': 'grid', 'params': {'total_time': [14, 28]}},
+    {'type': 'sobol', 'params': {'R0': [2.]}},
+    # does not change the simulation
+    {'type': 'lhs', 'n': 4, 'params': {'R0': {'low': 1.5, 'high': 3.5}}},
+])
+def test_bad_design_raises(config, spec):
+    config['scenario_design'] = spec
+    with pytest.raises(ValueError):
+        get_design(config)
@@ -0,0 +1,168 @@
+import os
+import json
+import time
+import pytest
+import importlib
+import numpy as np
+from .pytest_utils import fp
+from SEIRcity.simulate.scheduler import run_tasks
+from SEIRcity.simulate.worker_pool import WorkerPool
+from SEIRcity.simulate.simulate_multiple import simulate_multiple
+from SEIRcity.param import aggregate_params_and_data
+from SEIRcity.outcome_handler import select
+
+# SEIRcity.simulate.multiple_pool is shadowed by the function of the
+# same name in SEIRcity.simulate
+multiple_pool_module = importlib.import_module(
+    'SEIRcity.simulate.multiple_pool')
+
+
+@pytest.fixture()
+def pool():
+    wp = WorkerPool(threads=2)
+    yield wp
+    wp.close()
+
+
+def square_or_fail(x):
+    if x < 0:
+        raise ValueError("negative input {}".format(x))
+    return x * x
+
+
+def fail_once(args):
+    """Raises the first time it is called with `marker_fp`"""
+    x, marker_fp = args
+    if not os.path.exists(marker_fp):
+        open(marker_fp, 'w').close()
+        raise RuntimeError("transient failure")
+    return x
+
+
+def sleep_for(seconds):
+    time.sleep(seconds)
+    return seconds
+
+
+def exit_on_negative(x):
+    if x < 0:
+        os._exit(1)
+    return x
+
+
+def sleep_or_exit(x):
+    """Sleeps for `x` seconds, or kills its worker after a moment if `x`
+    is negative
+    """
+    if x < 0:
+        time.sleep(0.5)
+        os._exit(1)
+    time.sleep(x)
+    return x
+
+
+def simulate_or_fail(args):
+    """Same as _simulate_indexed, but fails for scenarios with
+    c_reduction 0.5
+    """
+    task_idx, shared_config, scenario = args
+    if scenario['c_reduction'] == 0.5:
+        raise RuntimeError("simulated failure")
+    return task_idx, multiple_pool_module._simulate_shared(
+        (shared_config, scenario))
+
+
+@pytest.mark.parametrize("chunksize", [1, 2])
+def test_failure_manifest(pool, chunksize):
+    """Failed tasks do not interrupt the others"""
+    results, failures = run_tasks(pool, square_or_fail, [1, -2, 3],
+                                  retries=2, verbosity=0,
+                                  chunksize=chunksize)
+    assert results == [1, None, 9]
+    assert len(failures) == 1
+    assert failures[0]['task_index'] == 1
+    assert failures[0]['attempts'] == 3
+    assert 'negative input -2' in failures[0]['error']
+
+
+def test_retry_succeeds(pool, tmp_path):
+    marker_fp = str(tmp_path / "marker")
+    received = dict()
+    results, failures = run_tasks(
+        pool, fail_once, [(5, marker_fp)], retries=1, verbosity=0,
+        on_result=lambda idx, r: received.update({idx: r}))
+    assert results == [5]
+    assert not failures
+    assert received == {0: 5}
+
+
+def test_timeout(pool):
+    """A hung task is killed, and the rest of the sweep completes"""
+    t0 = time.time()
+    results, failures = run_tasks(pool, sleep_for, [0, 60, 0, 0],
+                                  timeout=2, retries=1, verbosity=0)
+    assert time.time() - t0 < 30
+    assert results == [0, None, 0, 0]
+    assert [f['task_index'] for f in failures] == [1]
+    assert 'timed out' in failures[0]['error']
+    # pool is usable after the restart
+    assert pool.map(abs, [-1]) == [1]
+
+
+@pytest.mark.parametrize("chunksize", [1, 4])
+def test_timeout_per_task(pool, chunksize):
+    """The timeout applies to each task of a chunk, not to the chunk"""
+    results, failures = run_tasks(pool, sleep_for, [0.4] * 8, timeout=1.,
+                                  retries=0, verbosity=0,
+                                  chunksize=chunksize)
+    assert not failures
+    assert results == [0.4] * 8
+
+
+def test_worker_died(pool):
+    """A task that kills its worker is reported, not waited on forever"""
+    results, failures = run_tasks(pool, exit_on_negative, [1, -1, 2],
+                                  retries=0, verbosity=0)
+    failed = dict([(f['task_index'], f['error']) for f in failures])
+    assert failed[1] == "worker process died"
+    assert results[1] is None
+
+
+@pytest.mark.parametrize("chunksize", [1, 2])
+def test_worker_died_charges_its_task(pool, chunksize):
+    """Tasks running on other workers when a worker dies, or that were
+    run before it in its chunk, are run again without counting an
+    attempt
+    """
+    results, failures = run_tasks(pool, sleep_or_exit, [2, 0, -1, 0],
+                                  retries=0, verbosity=0,
+                                  chunksize=chunksize)
+    assert [f['task_index'] for f in failures] == [2]
+    assert results == [2, 0, None, 0]
+
+
+@pytest.mark.parametrize("yaml_fp", [
+    fp("tests/data/configs/austin_short0.yaml"),
+])
+@pytest.mark.parametrize("chunksize", [1, 3])
+def test_failed_scenarios_are_nan(pool, yaml_fp, chunksize, tmp_path,
+                                  monkeypatch):
+    """simulate_multiple fills failed tasks with NaN and writes a
+    manifest next to the output file
+    """
+    monkeypatch.setattr(multiple_pool_module, '_simulate_indexed',
+                        simulate_or_fail)
+    config = aggregate_params_and_data(yaml_fp=yaml_fp)
+    config['task_retries'] = 0
+    config['chunksize'] = chunksize
+    out_fp = str(tmp_path / "out.pckl")
+    outcomes = simulate_multiple(config, out_fp=out_fp, pool=pool)
+    assert np.isnan(select(outcomes, c_reduction=0.5)).all()
+    assert not np.isnan(select(outcomes, c_reduction=0.0,
+                               compartment='S')).any()
+    with open(out_fp + '.failures.json', 'r') as f:
+        failures = json.load(f)
+    # deterministic config: both replicates of the failed scenario
+    assert len(failures) == 2
+    assert all([f['scenario']['c_reduction'] == 0.5 for f in failures])
+    assert 'simulated failure' in failures[0]['error']
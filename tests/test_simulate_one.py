@@ -25,3 +25,38 @@ def test_return_shape(legacy_pickle, yaml_fp):
     result = simulate_one(scenario)
     assert isinstance(result, np.ndarray)
     assert len(result.shape) == 4
+
+
+@pytest.mark.parametrize("n_days", [5, None])
+def test_simulate_hosp(n_days):
+    """Daily Ih of simulate_hosp, which stops after n_days, is the same
+    as that of the full simulation
+    """
+    from SEIRcity.simulate.simulate_one import simulate_hosp
+    config = aggregate_params_and_data(
+        yaml_fp=fp("tests/data/configs/austin_short0.yaml"))
+    scenario = get_scenarios(config=config)[0]
+    scenario['config'] = config
+    full = simulate_one(scenario.clone())[7][::config['interval_per_day']]
+    hosp = simulate_hosp(scenario.clone(), n_days=n_days)
+    assert hosp.shape == (n_days or config['total_time'],) + full.shape[1:]
+    assert np.array_equal(hosp, full[:n_days])
+    assert hosp.sum() > 0
+
+
+def test_run_model_allocates_n_steps():
+    """A shorter simulation only allocates the steps it simulates, and
+    does not write into the initial state of the config
+    """
+    from SEIRcity.simulate.simulate_one import run_model
+    config = aggregate_params_and_data(
+        yaml_fp=fp("tests/data/configs/austin_short0.yaml"))
+    scenario = get_scenarios(config=config)[0]
+    scenario['config'] = config
+    initial_state = dict([(name, compt.copy()) for name, compt
+                          in config['initial_state'].items()])
+    compts = run_model(scenario, n_steps=11)
+    assert all([compt.shape[0] == 11 for compt in compts])
+    assert compts[7].sum() > 0
+    for name, compt in config['initial_state'].items():
+        assert np.array_equal(compt, initial_state[name])
@@ -0,0 +1,79 @@
+import os
+import sys
+import glob
+import pytest
+import numpy as np
+import xarray as xr
+from .pytest_utils import fp
+from SEIRcity.scenario import BaseScenario
+from SEIRcity.simulate.task_cache import TaskCache
+from SEIRcity.simulate.worker_pool import WorkerPool
+from SEIRcity.simulate.multiple_pool import multiple_pool, derive_seed
+from SEIRcity.param import aggregate_params_and_data
+from SEIRcity.outcome_handler import select, get_label_table
+
+
+@pytest.fixture()
+def cache(tmp_path):
+    yield TaskCache(str(tmp_path / "cache"))
+
+
+def task(**kwargs):
+    params = {'c_reduction': 0.5, 'NUM_SIM': 3, 'deterministic': False,
+              'seed': 7}
+    params.update(kwargs)
+    return BaseScenario(params)
+
+
+def test_put_get(cache):
+    arr = np.arange(12.).reshape((3, 4))
+    key = cache.key(task(), {})
+    assert cache.get(key) is None
+    cache.put(key, arr)
+    assert key in cache
+    np.testing.assert_array_equal(cache.get(key), arr)
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_key(cache):
+    """Key depends on effective params and seed, but not on NUM_SIM"""
+    config = {'NUM_SIM': 3, 'R0': 2.2}
+    key = cache.key(task(), config, replicate=0)
+    assert key == cache.key(task(NUM_SIM=10), dict(config, NUM_SIM=10),
+                            replicate=0)
+    assert key != cache.key(task(seed=8), config, replicate=0)
+    assert key != cache.key(task(c_reduction=0.6), config, replicate=0)
+    assert key != cache.key(task(), dict(config, R0=2.5), replicate=0)
+    # deterministic replicates share a key
+    det = task(deterministic=True)
+    assert cache.key(det, config, 0) == cache.key(det, config, 1)
+
+
+def test_derive_seed():
+    s = task()
+    assert derive_seed(1, s, 0) == derive_seed(1, s, 0)
+    assert derive_seed(1, s, 0) != derive_seed(1, s, 1)
+    assert derive_seed(1, s, 0) != derive_seed(2, s, 0)
+
+
+@pytest.mark.parametrize("yaml_fp", [
+    fp("tests/data/configs/austin_short0.yaml"),
+])
+def test_resume_from_cache(yaml_fp, tmp_path):
+    """A rerun with a larger sweep only simulates the new scenarios"""
+    cache_dir = str(tmp_path / "cache")
+    config = aggregate_params_and_data(yaml_fp=yaml_fp)
+    with WorkerPool(threads=2) as pool:
+        first = multiple_pool(config, pool=pool, cache_dir=cache_dir).outcomes
+        cached = sorted(glob.glob(os.path.join(cache_dir, '*', '*.npy')))
+        # deterministic: one file per scenario
+        assert len(cached) == 2
+        mtimes = [os.path.getmtime(f) for f in cached]
+
+        config['CONTACT_REDUCTION'] = config['CONTACT_REDUCTION'] + [0.75]
+        second = multiple_pool(config, pool=pool, cache_dir=cache_dir).outcomes
+    assert [os.path.getmtime(f) for f in cached] == mtimes
+    assert len(glob.glob(os.path.join(cache_dir, '*', '*.npy'))) == 3
+    for c_red in get_label_table(first)['c_reduction']:
+        xr.testing.assert_equal(select(first, c_reduction=c_red),
+                                select(second, c_reduction=c_red))
@@ -29,3 +29,21 @@ def test_get_dt64_coords(kwargs, expected):
     # print(r)
     assert isinstance(r, pd.DatetimeIndex)
     assert all([a == e for a, e in zip(r, expected)])
+
+
+@pytest.mark.parametrize("o1,o2,expected", [
+    ({'a': 1, 'b': [1., 'x']}, {'b': [1., 'x'], 'a': 1}, True),
+    ({'a': np.int64(1), 'b': np.float32(0.5)}, {'a': 1, 'b': 0.5}, True),
+    (1, 1., False),
+    (True, 1, False),
+    (2 ** 53, 2 ** 53 + 1, False),
+    ({'a': np.arange(3)}, {'a': np.arange(3)}, True),
+    ({'a': np.arange(3)}, {'a': np.arange(4)}, False),
+    ([1, 2], (1, 2), False),
+    ('20200215', 20200215, False),
+])
+def test_fingerprint(o1, o2, expected):
+    """Digest depends only on contents, not dict ordering or numpy
+    and Python representation of numbers.
+    """
+    assert (utils.fingerprint(o1) == utils.fingerprint(o2)) is expected
@@ -0,0 +1,68 @@
+import os
+import sys
+import pytest
+import numpy as np
+import xarray as xr
+from .pytest_utils import fp
+from SEIRcity.simulate import worker_pool
+from SEIRcity.simulate.worker_pool import WorkerPool, get_pool
+from SEIRcity.simulate.multiple_pool import multiple_pool
+from SEIRcity.param import aggregate_params_and_data
+
+
+@pytest.fixture()
+def pool():
+    wp = WorkerPool(threads=2)
+    yield wp
+    wp.close()
+
+
+def test_pool_is_lazy(pool):
+    """Worker processes are not started until the first task"""
+    assert not pool.is_running
+    assert pool.map(abs, [-1, -2]) == [1, 2]
+    assert pool.is_running
+
+
+def test_share_writes_once(pool):
+    """Objects with the same contents share one SharedObject"""
+    obj = {'foo': np.arange(3), 'bar': 'baz'}
+    shared = pool.share(obj)
+    assert pool.share(dict(obj)) is shared
+    assert os.path.isfile(shared.fp)
+    resolved = shared.resolve()
+    assert resolved['bar'] == 'baz'
+    # second call hits the process cache
+    assert shared.resolve() is resolved
+    assert shared.key in worker_pool._WORKER_CACHE
+
+
+def test_close_removes_shared(pool):
+    shared = pool.share([1, 2, 3])
+    pool.close()
+    assert not os.path.exists(shared.fp)
+    assert not pool.is_running
+
+
+def test_get_pool_is_reused():
+    p1 = get_pool(threads=2)
+    assert get_pool(threads=2) is p1
+    p2 = get_pool(threads=3)
+    assert p2 is not p1
+    p2.close()
+
+
+@pytest.mark.parametrize("yaml_fp", [
+    fp("tests/data/configs/austin_short0.yaml"),
+])
+def test_pool_reused_between_sweeps(pool, yaml_fp):
+    """Two sweeps on the same WorkerPool return the same outcomes"""
+    config = aggregate_params_and_data(yaml_fp=yaml_fp)
+    first = multiple_pool(config, pool=pool).outcomes
+    workers = list(pool.pool._pool)
+    second = multiple_pool(config, pool=pool).outcomes
+    assert isinstance(first, xr.DataArray)
+    # same worker processes served both sweeps
+    assert list(pool.pool._pool) == workers
+    xr.testing.assert_equal(first.sortby(list(first.dims)),
+                            second.sortby(list(second.dims)))